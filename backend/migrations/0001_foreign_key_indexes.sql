@@ -0,0 +1,6 @@
+-- Index the foreign keys used by every drill-down query
+-- (invoices by project, elements by invoice, subelements by element).
+CREATE INDEX IF NOT EXISTS idx_invoices_project_name ON invoices (project_name);
+CREATE INDEX IF NOT EXISTS idx_elements_invoice_id ON elements (invoice_id);
+-- (element_id, id) also serves the ORDER BY element_id, id of the Excel export
+CREATE INDEX IF NOT EXISTS idx_subelements_element_id ON subelements (element_id, id);
@@ -0,0 +1,5 @@
+-- Trigram GIN indexes so the '%keyword%' ILIKE filters stop seq-scanning
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_elements_name_trgm ON elements USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_invoices_file_name_trgm ON invoices USING gin (file_name gin_trgm_ops);
@@ -0,0 +1,97 @@
+-- Precompute per-element subelement stats so the elements grid no longer
+-- runs a correlated EXISTS against subelements for every row.
+ALTER TABLE elements
+    ADD COLUMN IF NOT EXISTS subelement_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS subelements_total NUMERIC NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS has_subelements BOOLEAN GENERATED ALWAYS AS (subelement_count > 0) STORED;
+
+-- Recompute the stats for the given elements, or for every element when NULL.
+-- Also run by `flask db-refresh-element-stats` after bulk loads.
+CREATE OR REPLACE FUNCTION refresh_element_subelement_stats(p_element_ids INTEGER[] DEFAULT NULL)
+RETURNS VOID AS $$
+BEGIN
+    IF p_element_ids IS NULL THEN
+        UPDATE elements e
+        SET subelement_count = COALESCE(stats.cnt, 0),
+            subelements_total = COALESCE(stats.total, 0)
+        FROM elements e2
+        LEFT JOIN (
+            SELECT element_id, count(*) AS cnt, sum(total_price) AS total
+            FROM subelements
+            GROUP BY element_id
+        ) stats ON stats.element_id = e2.id
+        WHERE e.id = e2.id
+          AND (e.subelement_count, e.subelements_total)
+              IS DISTINCT FROM (COALESCE(stats.cnt, 0), COALESCE(stats.total, 0));
+    ELSE
+        UPDATE elements e
+        SET subelement_count = stats.cnt,
+            subelements_total = stats.total
+        FROM (
+            SELECT ids.id, count(s.id) AS cnt, COALESCE(sum(s.total_price), 0) AS total
+            FROM unnest(p_element_ids) AS ids(id)
+            LEFT JOIN subelements s ON s.element_id = ids.id
+            GROUP BY ids.id
+        ) stats
+        WHERE e.id = stats.id
+          AND (e.subelement_count, e.subelements_total) IS DISTINCT FROM (stats.cnt, stats.total);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement-level triggers with transition tables: one refresh per statement,
+-- touching only the elements whose subelements changed.
+CREATE OR REPLACE FUNCTION subelements_refresh_element_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_element_subelement_stats(
+            ARRAY(SELECT DISTINCT element_id FROM new_rows WHERE element_id IS NOT NULL));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_element_subelement_stats(
+            ARRAY(SELECT DISTINCT element_id FROM old_rows WHERE element_id IS NOT NULL));
+    ELSE
+        PERFORM refresh_element_subelement_stats(
+            ARRAY(SELECT element_id FROM new_rows WHERE element_id IS NOT NULL
+                  UNION
+                  SELECT element_id FROM old_rows WHERE element_id IS NOT NULL));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION subelements_reset_element_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE elements
+    SET subelement_count = 0, subelements_total = 0
+    WHERE subelement_count <> 0 OR subelements_total <> 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subelements_stats_insert ON subelements;
+CREATE TRIGGER subelements_stats_insert
+    AFTER INSERT ON subelements
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION subelements_refresh_element_stats();
+
+DROP TRIGGER IF EXISTS subelements_stats_update ON subelements;
+CREATE TRIGGER subelements_stats_update
+    AFTER UPDATE ON subelements
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION subelements_refresh_element_stats();
+
+DROP TRIGGER IF EXISTS subelements_stats_delete ON subelements;
+CREATE TRIGGER subelements_stats_delete
+    AFTER DELETE ON subelements
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION subelements_refresh_element_stats();
+
+DROP TRIGGER IF EXISTS subelements_stats_truncate ON subelements;
+CREATE TRIGGER subelements_stats_truncate
+    AFTER TRUNCATE ON subelements
+    FOR EACH STATEMENT EXECUTE FUNCTION subelements_reset_element_stats();
+
+-- Backfill existing data
+SELECT refresh_element_subelement_stats();
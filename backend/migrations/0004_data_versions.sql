@@ -0,0 +1,44 @@
+-- Per-table data version counters. Report caches (and anything else that
+-- needs to know whether the data changed) key on these instead of
+-- re-reading the tables.
+CREATE TABLE IF NOT EXISTS data_versions (
+    table_name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO data_versions (table_name)
+VALUES ('projects'), ('invoices'), ('elements'), ('subelements')
+ON CONFLICT (table_name) DO NOTHING;
+
+-- Statement-level, so a bulk load bumps the version once rather than per row.
+CREATE OR REPLACE FUNCTION bump_data_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE data_versions
+    SET version = version + 1, changed_at = now()
+    WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS projects_data_version ON projects;
+CREATE TRIGGER projects_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON projects
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+DROP TRIGGER IF EXISTS invoices_data_version ON invoices;
+CREATE TRIGGER invoices_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON invoices
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+-- Also fires for the subelement stats refresh from 0003, which rewrites elements
+DROP TRIGGER IF EXISTS elements_data_version ON elements;
+CREATE TRIGGER elements_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON elements
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+DROP TRIGGER IF EXISTS subelements_data_version ON subelements;
+CREATE TRIGGER subelements_data_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON subelements
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
@@ -0,0 +1,16 @@
+-- Announce every data version bump on the data_changed channel as
+-- '<table>:<version>', so API workers can drop cached reads as soon as the
+-- writing transaction commits.
+CREATE OR REPLACE FUNCTION bump_data_version()
+RETURNS TRIGGER AS $$
+DECLARE
+    new_version BIGINT;
+BEGIN
+    UPDATE data_versions
+    SET version = version + 1, changed_at = now()
+    WHERE table_name = TG_TABLE_NAME
+    RETURNING version INTO new_version;
+    PERFORM pg_notify('data_changed', TG_TABLE_NAME || ':' || new_version);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
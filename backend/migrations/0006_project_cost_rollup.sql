@@ -0,0 +1,57 @@
+-- Pre-aggregated element costs per project, folder type and chapter hierarchy.
+-- grouping_id is GROUPING(project_name, folder_type, chapter_code, subchapter_code):
+-- a set bit means that column is rolled up at this level. Key columns are ''
+-- when rolled up (or missing in the data) so the unique index below covers
+-- every row, which REFRESH ... CONCURRENTLY requires.
+CREATE MATERIALIZED VIEW IF NOT EXISTS project_cost_rollup AS
+SELECT
+    GROUPING(project_name, folder_type, chapter_code, subchapter_code) AS grouping_id,
+    COALESCE(project_name, '') AS project_name,
+    COALESCE(folder_type, '') AS folder_type,
+    COALESCE(chapter_code, '') AS chapter_code,
+    COALESCE(subchapter_code, '') AS subchapter_code,
+    count(*) AS element_count,
+    count(DISTINCT invoice_id) AS invoice_count,
+    sum(subelement_count) AS subelement_count,
+    sum(quantity) AS quantity,
+    sum(total_price) AS total_price
+FROM (
+    SELECT
+        COALESCE(i.project_name, '') AS project_name,
+        COALESCE(i.folder_type, '') AS folder_type,
+        COALESCE(e.chapter_code, '') AS chapter_code,
+        COALESCE(e.subchapter_code, '') AS subchapter_code,
+        e.invoice_id,
+        e.subelement_count,
+        e.quantity,
+        e.total_price
+    FROM elements e
+    LEFT JOIN invoices i ON i.id = e.invoice_id
+) AS costs
+GROUP BY GROUPING SETS (
+    (),
+    (project_name),
+    (project_name, folder_type),
+    (project_name, chapter_code),
+    (project_name, chapter_code, subchapter_code),
+    (project_name, folder_type, chapter_code),
+    (project_name, folder_type, chapter_code, subchapter_code)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_project_cost_rollup_key
+    ON project_cost_rollup (grouping_id, project_name, folder_type, chapter_code, subchapter_code);
+
+-- Data versions each rollup was last refreshed at, so concurrent refresh
+-- requests from several workers collapse into one.
+CREATE TABLE IF NOT EXISTS rollup_refreshes (
+    view_name TEXT PRIMARY KEY,
+    data_version TEXT NOT NULL,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- The view was populated above from the data as of this migration
+INSERT INTO rollup_refreshes (view_name, data_version)
+SELECT 'project_cost_rollup', COALESCE(string_agg(table_name || ':' || version, ',' ORDER BY table_name), '')
+FROM data_versions
+WHERE table_name IN ('elements', 'invoices')
+ON CONFLICT (view_name) DO NOTHING;
@@ -0,0 +1,93 @@
+-- Ranked full-text search over elements and their invoice file names.
+-- Accent-insensitive Spanish and Catalan configurations; Catalan stemming
+-- needs PostgreSQL 16+, older servers index Catalan words unstemmed.
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'es_unaccent') THEN
+        CREATE TEXT SEARCH CONFIGURATION es_unaccent (COPY = spanish);
+        ALTER TEXT SEARCH CONFIGURATION es_unaccent
+            ALTER MAPPING FOR hword, hword_part, word WITH unaccent, spanish_stem;
+    END IF;
+
+    IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'ca_unaccent') THEN
+        IF EXISTS (SELECT 1 FROM pg_ts_dict WHERE dictname = 'catalan_stem') THEN
+            CREATE TEXT SEARCH CONFIGURATION ca_unaccent (COPY = catalan);
+            ALTER TEXT SEARCH CONFIGURATION ca_unaccent
+                ALTER MAPPING FOR hword, hword_part, word WITH unaccent, catalan_stem;
+        ELSE
+            CREATE TEXT SEARCH CONFIGURATION ca_unaccent (COPY = simple);
+            ALTER TEXT SEARCH CONFIGURATION ca_unaccent
+                ALTER MAPPING FOR hword, hword_part, word WITH unaccent, simple;
+        END IF;
+    END IF;
+END
+$$;
+
+-- File names are split on _ . - first; the parser would otherwise read
+-- 'Factura_11.pdf' as a single host name token.
+CREATE OR REPLACE FUNCTION search_file_name(file_name TEXT)
+RETURNS TEXT AS $$
+    SELECT regexp_replace(COALESCE(file_name, ''), '[_.-]+', ' ', 'g');
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Weights: element name A, chapter title and invoice file name B, description C
+CREATE OR REPLACE FUNCTION element_search_vector(
+    name TEXT, chapter_title TEXT, description TEXT, file_name TEXT
+)
+RETURNS tsvector AS $$
+    SELECT
+        setweight(to_tsvector('es_unaccent', COALESCE(name, '')), 'A') ||
+        setweight(to_tsvector('ca_unaccent', COALESCE(name, '')), 'A') ||
+        setweight(to_tsvector('es_unaccent', COALESCE(chapter_title, '')), 'B') ||
+        setweight(to_tsvector('ca_unaccent', COALESCE(chapter_title, '')), 'B') ||
+        setweight(to_tsvector('es_unaccent', search_file_name(file_name)), 'B') ||
+        setweight(to_tsvector('ca_unaccent', search_file_name(file_name)), 'B') ||
+        setweight(to_tsvector('es_unaccent', COALESCE(description, '')), 'C') ||
+        setweight(to_tsvector('ca_unaccent', COALESCE(description, '')), 'C');
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Stored on elements (not generated: it includes the invoice's file name), so
+-- a search is one GIN scan even when its terms span the element and its invoice.
+ALTER TABLE elements ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+CREATE OR REPLACE FUNCTION elements_set_search_vector()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.search_vector := element_search_vector(
+        NEW.name, NEW.chapter_title, NEW.description,
+        (SELECT file_name FROM invoices WHERE id = NEW.invoice_id));
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS elements_search_vector ON elements;
+CREATE TRIGGER elements_search_vector
+    BEFORE INSERT OR UPDATE OF name, chapter_title, description, invoice_id ON elements
+    FOR EACH ROW EXECUTE FUNCTION elements_set_search_vector();
+
+CREATE OR REPLACE FUNCTION invoices_refresh_element_search()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE elements e
+    SET search_vector = element_search_vector(e.name, e.chapter_title, e.description, NEW.file_name)
+    WHERE e.invoice_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS invoices_element_search ON invoices;
+CREATE TRIGGER invoices_element_search
+    AFTER UPDATE OF file_name ON invoices
+    FOR EACH ROW WHEN (OLD.file_name IS DISTINCT FROM NEW.file_name)
+    EXECUTE FUNCTION invoices_refresh_element_search();
+
+-- Backfill existing data
+UPDATE elements e
+SET search_vector = element_search_vector(e.name, e.chapter_title, e.description, i.file_name)
+FROM elements e2
+LEFT JOIN invoices i ON i.id = e2.invoice_id
+WHERE e.id = e2.id;
+
+CREATE INDEX IF NOT EXISTS idx_elements_search_vector ON elements USING gin (search_vector);
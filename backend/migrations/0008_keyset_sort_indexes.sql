@@ -0,0 +1,10 @@
+-- (sort key, id) indexes for every keyset sort, so a page deep into a sorted
+-- grid is an index range scan instead of a full filter-and-sort.
+CREATE INDEX IF NOT EXISTS idx_invoices_file_name_id ON invoices (file_name, id);
+CREATE INDEX IF NOT EXISTS idx_invoices_folder_type_id ON invoices (folder_type, id);
+CREATE INDEX IF NOT EXISTS idx_invoices_project_name_id ON invoices (project_name, id);
+
+CREATE INDEX IF NOT EXISTS idx_elements_name_id ON elements (name, id);
+CREATE INDEX IF NOT EXISTS idx_elements_chapter_code_id ON elements (chapter_code, id);
+CREATE INDEX IF NOT EXISTS idx_elements_price_per_unit_id ON elements (price_per_unit, id);
+CREATE INDEX IF NOT EXISTS idx_elements_total_price_id ON elements (total_price, id);
@@ -0,0 +1,3 @@
+-- idx_invoices_project_name_id (0008) serves every lookup the single-column
+-- index did, and also returns a project's invoices already ordered by id.
+DROP INDEX IF EXISTS idx_invoices_project_name;
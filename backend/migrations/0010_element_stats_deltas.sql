@@ -0,0 +1,67 @@
+-- Maintain element subelement stats by applying each statement's deltas instead
+-- of recounting. A recount aggregates the statement's snapshot, so under READ
+-- COMMITTED two concurrent writers to the same element can each overwrite the
+-- other's change. "count + n" is re-evaluated against the latest row version
+-- once the row lock is granted, so concurrent deltas all land.
+CREATE OR REPLACE FUNCTION apply_element_subelement_deltas(
+    p_element_ids INTEGER[], p_counts BIGINT[], p_totals NUMERIC[])
+RETURNS VOID AS $$
+BEGIN
+    -- Lock in id order so statements touching overlapping elements cannot deadlock
+    PERFORM 1 FROM elements WHERE id = ANY(p_element_ids) ORDER BY id FOR UPDATE;
+
+    UPDATE elements e
+    SET subelement_count = e.subelement_count + d.cnt,
+        subelements_total = e.subelements_total + d.total
+    FROM unnest(p_element_ids, p_counts, p_totals) AS d(id, cnt, total)
+    WHERE e.id = d.id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION subelements_refresh_element_stats()
+RETURNS TRIGGER AS $$
+DECLARE
+    element_ids INTEGER[];
+    counts BIGINT[];
+    totals NUMERIC[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(element_id), array_agg(cnt), array_agg(total)
+        INTO element_ids, counts, totals
+        FROM (
+            SELECT element_id, count(*) AS cnt, COALESCE(sum(total_price), 0) AS total
+            FROM new_rows
+            WHERE element_id IS NOT NULL
+            GROUP BY element_id
+        ) changes;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(element_id), array_agg(-cnt), array_agg(-total)
+        INTO element_ids, counts, totals
+        FROM (
+            SELECT element_id, count(*) AS cnt, COALESCE(sum(total_price), 0) AS total
+            FROM old_rows
+            WHERE element_id IS NOT NULL
+            GROUP BY element_id
+        ) changes;
+    ELSE
+        SELECT array_agg(element_id), array_agg(cnt), array_agg(total)
+        INTO element_ids, counts, totals
+        FROM (
+            SELECT element_id, sum(cnt) AS cnt, sum(total) AS total
+            FROM (
+                SELECT element_id, 1 AS cnt, COALESCE(total_price, 0) AS total FROM new_rows
+                UNION ALL
+                SELECT element_id, -1, -COALESCE(total_price, 0) FROM old_rows
+            ) moved
+            WHERE element_id IS NOT NULL
+            GROUP BY element_id
+            HAVING sum(cnt) <> 0 OR sum(total) <> 0
+        ) changes;
+    END IF;
+
+    IF element_ids IS NOT NULL THEN
+        PERFORM apply_element_subelement_deltas(element_ids, counts, totals);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -1,5 +1,7 @@
-from flask import Flask, jsonify, request, send_file, session
+from flask import Flask, Response, jsonify, request, send_file, session, stream_with_context
 import psycopg2
+import sqlparse
+import click
 import pandas as pd
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -26,6 +28,35 @@ import time
 from collections import defaultdict
 import secrets
 import traceback
+import threading
+import hmac
+import re
+import unicodedata
+from collections import OrderedDict
+import base64
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import xlsxwriter
+import queue
+import select
+import mimetypes
+import stat
+import fcntl
+from urllib.parse import quote
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Optional speedup; Flask's json module is used without it
+    orjson = None
+try:
+    import brotli
+except ImportError:  # Optional; responses are gzipped without it
+    brotli = None
+import gzip
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 
@@ -41,12 +72,40 @@ if sys.platform.startswith('win'):
 
 MAX_HISTORY_LENGTH = 10
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, falling back to Flask's encoder hooks for types orjson lacks"""
+
+    # Datetimes go through Flask's hook so they keep jsonify's HTTP-date format
+    OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:  # sort_keys, indent, ... are only supported by the stdlib encoder
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.OPTIONS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.OPTIONS),
+            mimetype=self.mimetype
+        )
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = ORJSONProvider(app)
 CORS(app, 
      resources={r"/*": {
          "origins": "*",
          "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
          "allow_headers": ["Content-Type", "Authorization", "X-Requested-With"],
+         "expose_headers": ["Content-Disposition"],
          "supports_credentials": False
      }},
      supports_credentials=True)
@@ -59,6 +118,9 @@ load_dotenv(env_path)
 TRUSTED_PROXIES = os.getenv('VPN_SUBNET')
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 app.config['SESSION_TYPE'] = 'filesystem'
+# Defaults to flask_session/ under the working directory
+if os.getenv('SESSION_FILE_DIR'):
+    app.config['SESSION_FILE_DIR'] = os.getenv('SESSION_FILE_DIR')
 Session(app)
 
 
@@ -67,7 +129,7 @@ try:
     # Fixed version
     client = OpenAI(
         api_key=os.getenv('OPENAI_API_KEY'),
-        base_url="https://api.openai.com/v1",
+        base_url=os.getenv('OPENAI_BASE_URL', "https://api.openai.com/v1"),  # Override to point at a local fake server
         http_client=httpx.Client()  # Explicitly create the HTTP client without proxies
     )
 except Exception as e:
@@ -153,6 +215,15 @@ def record_failed_attempt(ip_address, username):
         account_lockouts[username] = now + SecurityConfig.LOCKOUT_DURATION
 
 # Enhanced token verification
+def find_token_user(data):
+    """The USERS entry a decoded token still refers to (same username and role), or None"""
+    return next(
+        (user for user in USERS if user['username'] == data.get('username')
+         and user['role'] == data.get('role')),
+        None
+    )
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -176,11 +247,7 @@ def token_required(f):
             )
             
             # Verify user still exists and has same role
-            current_user = next(
-                (user for user in USERS if user['username'] == data['username'] 
-                 and user['role'] == data['role']),
-                None
-            )
+            current_user = find_token_user(data)
             
             if not current_user:
                 return jsonify({'error': 'User no longer valid'}), 401
@@ -486,47 +553,572 @@ def get_stats():
     })
 
 
+# Connection pool configurations
+class PoolConfig:
+    MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))  # Idle connections kept open per worker
+    MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 4))  # Hard cap on connections per worker
+    MAX_AGE = int(os.getenv('DB_POOL_MAX_AGE', 1800))  # Recycle connections after 30 minutes
+    MAX_IDLE = int(os.getenv('DB_POOL_MAX_IDLE', 300))  # Close surplus connections idle for 5 minutes
+    VALIDATE_AFTER = int(os.getenv('DB_POOL_VALIDATE_AFTER', 30))  # Ping connections idle longer than this
+    CHECKOUT_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))  # Seconds to wait for a free connection
+    CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', 10))
+
+
+
 # Function to connect to the database
 def connect_to_db():
-    print("=== Database Connection Attempt ===")
-    try:
-        # Get environment variables
-        instance_connection_name = os.getenv('INSTANCE_CONNECTION_NAME')
-        db_user = os.getenv('DB_USER', 'postgres')
-        db_pass = os.getenv('DB_PASSWORD')
-        db_name = os.getenv('DB_NAME', 'ServitecInvoiceDataBase')
-
-        # Check if running on Cloud Run
-        if os.getenv('K_SERVICE'):
-            print("Running on Cloud Run, using Unix socket")
-            # Use Unix socket
-            host = f'/cloudsql/{instance_connection_name}'
-        else:
-            print("Running locally, using TCP connection")
-            host = os.getenv('DB_HOST', '34.175.111.125')
+    # Get environment variables
+    instance_connection_name = os.getenv('INSTANCE_CONNECTION_NAME')
+    db_user = os.getenv('DB_USER', 'postgres')
+    db_pass = os.getenv('DB_PASSWORD')
+    db_name = os.getenv('DB_NAME', 'ServitecInvoiceDataBase')
+
+    # Check if running on Cloud Run
+    if os.getenv('K_SERVICE'):
+        # Use Unix socket
+        host = f'/cloudsql/{instance_connection_name}'
+    else:
+        host = os.getenv('DB_HOST', '34.175.111.125')
 
-        print(f"Connecting with: host={host}, db={db_name}, user={db_user}")
-        
-        conn = psycopg2.connect(
+    try:
+        return psycopg2.connect(
             dbname=db_name,
             user=db_user,
             password=db_pass,
-            host=host
+            host=host,
+            connect_timeout=PoolConfig.CONNECT_TIMEOUT
         )
-        
-        print("Database connection successful")
-        return conn
-        
     except Exception as e:
         print(f"Database connection error: {str(e)}")
         print("\nConnection details:")
         print(f"- Running on Cloud Run: {os.getenv('K_SERVICE') is not None}")
-        print(f"- INSTANCE_CONNECTION_NAME: {os.getenv('INSTANCE_CONNECTION_NAME')}")
-        print(f"- DB_HOST: {os.getenv('DB_HOST')}")
+        print(f"- INSTANCE_CONNECTION_NAME: {instance_connection_name}")
+        print(f"- DB_HOST: {host}")
         print(f"- DB_NAME: {db_name}")
         print(f"- DB_USER: {db_user}")
         raise
 
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes available in time"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of PostgreSQL connections, one per gunicorn worker process"""
+
+    def __init__(self, connect, min_size, max_size, max_age, max_idle, validate_after, timeout):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.validate_after = validate_after
+        self.timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        # Called at init and in forked children: inherited sockets belong to the parent
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, created_at, last_used)], most recently used last
+        self._created_at = {}  # {conn: created_at} for every open connection
+        self._in_use = 0
+        self._counters = defaultdict(int)
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _reserve(self, started):
+        """Take an idle connection, or a free slot to open a new one (returns None)"""
+        deadline = started + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    self._in_use += 1
+                    return self._idle.pop()
+                if self._in_use < self.max_size:
+                    self._in_use += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        f"No database connection available after {self.timeout}s "
+                        f"({self._in_use} in use)"
+                    )
+                self._cond.wait(remaining)
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _close(self, conn, reason):
+        self._created_at.pop(conn, None)
+        self._counters[f'closed_{reason}'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_valid(self, conn, created_at, last_used):
+        now = time.monotonic()
+        if conn.closed:
+            return 'broken'
+        if now - created_at > self.max_age:
+            return 'recycled'
+        if now - last_used > self.validate_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            except Exception:
+                return 'broken'
+        return None
+
+    def getconn(self):
+        started = time.monotonic()
+        while True:
+            entry = self._reserve(started)
+            if entry is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+                self._created_at[conn] = time.monotonic()
+                self._counters['opened'] += 1
+                break
+
+            conn, created_at, last_used = entry
+            reason = self._is_valid(conn, created_at, last_used)
+            if reason is None:
+                break
+            self._close(conn, reason)
+            self._release_slot()
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._counters['checkouts'] += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn, discard=False, discard_reason='broken'):
+        created_at = self._created_at.get(conn)
+        reason = None
+        if conn.closed or created_at is None:
+            reason = 'broken'
+        elif discard:
+            reason = discard_reason
+        elif time.monotonic() - created_at > self.max_age:
+            reason = 'recycled'
+        elif conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                reason = 'broken'
+
+        if reason:
+            self._close(conn, reason)
+            self._release_slot()
+            return
+
+        now = time.monotonic()
+        expired = []
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((conn, created_at, now))
+            # Trim surplus connections that have sat idle too long (oldest first)
+            while (self._idle and len(self._idle) + self._in_use > self.min_size
+                   and now - self._idle[0][2] > self.max_idle):
+                expired.append(self._idle.pop(0)[0])
+            self._cond.notify()
+        for stale in expired:
+            self._close(stale, 'idle')
+
+    def stats(self):
+        with self._cond:
+            checkouts = self._counters['checkouts']
+            return {
+                'pid': os.getpid(),
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'size': self._in_use + len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': checkouts,
+                'opened': self._counters['opened'],
+                'closed': {
+                    reason.replace('closed_', ''): count
+                    for reason, count in self._counters.items()
+                    if reason.startswith('closed_')
+                },
+                'timeouts': self._counters['timeouts'],
+                'wait_time': {
+                    'total_ms': round(self._wait_total * 1000, 2),
+                    'avg_ms': round(self._wait_total * 1000 / checkouts, 3) if checkouts else 0,
+                    'max_ms': round(self._wait_max * 1000, 2)
+                }
+            }
+
+
+db_pool = ConnectionPool(
+    connect_to_db,
+    min_size=PoolConfig.MIN_SIZE,
+    max_size=PoolConfig.MAX_SIZE,
+    max_age=PoolConfig.MAX_AGE,
+    max_idle=PoolConfig.MAX_IDLE,
+    validate_after=PoolConfig.VALIDATE_AFTER,
+    timeout=PoolConfig.CHECKOUT_TIMEOUT
+)
+# gunicorn forks workers after import; never share the parent's sockets
+os.register_at_fork(after_in_child=db_pool._reset)
+
+
+@contextmanager
+def db_connection(discard_after=False):
+    """Check out a pooled connection; commits on success, rolls back on error.
+
+    discard_after closes the connection instead of returning it to the pool, for callers that
+    may have left session state behind.
+    """
+    conn = db_pool.getconn()
+    discard = False
+    try:
+        yield conn
+        conn.commit()
+    except BaseException as e:
+        discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        raise
+    finally:
+        if discard:
+            db_pool.putconn(conn, discard=True)
+        else:
+            db_pool.putconn(conn, discard=discard_after, discard_reason='single_use')
+
+# NUMERIC decoding configurations
+class NumericConfig:
+    # How psycopg2 decodes NUMERIC: 'string' keeps PostgreSQL's exact text (the same JSON jsonify
+    # produced from Decimal), 'float' returns JSON numbers, 'decimal' keeps psycopg2's Decimal
+    MODE = os.getenv('NUMERIC_MODE', 'string')
+
+
+NUMERIC_OID = 1700
+NUMERIC_ARRAY_OID = 1231
+
+
+def register_numeric_typecaster(mode):
+    """Decode NUMERIC at the driver level instead of building Decimals only to re-encode them"""
+    if mode == 'decimal':
+        return
+    if mode == 'float':
+        def cast(value, cur):
+            return None if value is None else float(value)
+    else:
+        def cast(value, cur):
+            return value
+    numeric = psycopg2.extensions.new_type((NUMERIC_OID,), f'NUMERIC_AS_{mode.upper()}', cast)
+    psycopg2.extensions.register_type(numeric)
+    psycopg2.extensions.register_type(
+        psycopg2.extensions.new_array_type((NUMERIC_ARRAY_OID,), f'NUMERIC_ARRAY_AS_{mode.upper()}', numeric)
+    )
+
+
+def use_decimal_numeric(cur):
+    """Decode NUMERIC as Decimal on this cursor, for exports and aggregates that need exact numbers"""
+    psycopg2.extensions.register_type(psycopg2.extensions.DECIMAL, cur)
+    psycopg2.extensions.register_type(psycopg2.extensions.DECIMALARRAY, cur)
+    return cur
+
+
+register_numeric_typecaster(NumericConfig.MODE)
+
+
+@app.route('/api/admin/pool-stats', methods=['GET'])
+@token_required
+def get_pool_stats():
+    # Get token data
+    token = request.headers['Authorization'].split(" ")[1]
+    user_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+
+    # Check if user is admin
+    if user_data.get('role') != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    # Stats are per worker process; each gunicorn worker owns its own pool
+    return jsonify(db_pool.stats())
+
+@app.route('/api/admin/cache-stats', methods=['GET'])
+@token_required
+def get_cache_stats():
+    # Get token data
+    token = request.headers['Authorization'].split(" ")[1]
+    user_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+
+    # Check if user is admin
+    if user_data.get('role') != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    # Counters are per worker process
+    return jsonify({
+        'pid': os.getpid(),
+        'interpretations': interpretation_cache.stats(),
+        'reports': report_sweeper.stats(),
+        'read_cache': read_cache.stats(),
+        'data_listener': data_listener.stats(),
+        'rollup_refresher': rollup_refresher.stats()
+    })
+
+@app.route('/api/admin/schema-cache/invalidate', methods=['POST'])
+@token_required
+def invalidate_schema_cache_endpoint():
+    # Get token data
+    token = request.headers['Authorization'].split(" ")[1]
+    user_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+
+    # Check if user is admin
+    if user_data.get('role') != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    # Only clears the worker serving this request; the others pick up DDL changes at their next probe
+    invalidate_schema_cache()
+    return jsonify({
+        'message': 'Schema cache invalidated',
+        'ttl': SchemaCacheConfig.TTL,
+        'probe_interval': SchemaCacheConfig.PROBE_INTERVAL
+    })
+
+# Schema migrations, applied at deploy time with `flask --app backend.server db-migrate`
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_LOCK_ID = 4_205_001  # Advisory lock key so concurrent deploys apply migrations once
+
+
+def list_migrations():
+    """Return (version, name, path) for every migration file, in apply order"""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r'^(\d{4})_(\w+)\.sql$', filename)
+        if match:
+            migrations.append((match.group(1), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+
+def apply_migrations():
+    """Apply pending migrations in order, one transaction each; safe to re-run"""
+    applied_now = []
+    # Dedicated connection: the session-level advisory lock must not leak into the pool
+    conn = connect_to_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    checksum TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            conn.commit()
+
+            cur.execute("SELECT version, checksum FROM schema_migrations")
+            applied = dict(cur.fetchall())
+            conn.commit()
+
+            for version, name, path in list_migrations():
+                with open(path, encoding='utf-8') as f:
+                    sql = f.read()
+                checksum = hashlib.sha256(sql.encode('utf-8')).hexdigest()
+
+                if version in applied:
+                    if applied[version] != checksum:
+                        print(f"Warning: migration {version}_{name} was modified after being applied")
+                    continue
+
+                print(f"Applying migration {version}_{name}...")
+                try:
+                    cur.execute(sql)
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                        (version, name, checksum)
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied_now.append(f"{version}_{name}")
+    finally:
+        # Closing the session also releases the advisory lock
+        conn.close()
+    return applied_now
+
+
+def index_checks():
+    """Representative endpoint queries and the indexes each one must be able to use"""
+    sample = 'sample'
+    checks = [
+        ('projects by name', PROJECTS_QUERY + " AND name = %s", [sample], {'projects_pkey'}),
+        ('subelements by element', SUBELEMENTS_QUERY, [1], {'idx_subelements_element_id'}),
+        ('subelements batch', SUBELEMENTS_BATCH_QUERY.format(columns='*'), [[1, 2]], {'idx_subelements_element_id'}),
+        ('export elements', EXPORT_ELEMENTS_QUERY, [[1, 2]], {'elements_pkey'}),
+        ('export subelements', EXPORT_SUBELEMENTS_QUERY, [[1, 2]], {'idx_subelements_element_id'}),
+        ('project tree invoices', PROJECT_TREE_INVOICES_QUERY.format(columns='*'), [sample],
+         {'idx_invoices_project_name_id'}),
+        ('project cost rollup', *build_rollup_query('chapter', {'project_name': sample}),
+         {'idx_project_cost_rollup_key'}),
+        ('element search', *build_search_query(sample, None, {'limit': 10, 'after': None}),
+         {'idx_elements_search_vector'}),
+    ]
+
+    invoice_cases = [
+        ('invoices by project', {}, sample, {'idx_invoices_project_name_id'}),
+        ('invoices by file name', {'FileNameKeyword': sample}, None, {'idx_invoices_file_name_trgm'}),
+    ]
+    for label, args, project_name, expected in invoice_cases:
+        query, params = build_invoices_query(args, project_name)
+        checks.append((label, query, params, expected))
+
+    element_cases = [
+        ('elements by project', {}, sample, {'idx_invoices_project_name_id', 'idx_elements_invoice_id'}),
+        ('elements by invoice', {'invoiceid': 1}, None, {'idx_elements_invoice_id'}),
+        ('elements by name', {'nameKeyword': sample}, None, {'idx_elements_name_trgm'}),
+        ('elements by invoice name', {'invoiceNameKeyword': sample}, None,
+         {'idx_invoices_file_name_trgm', 'idx_elements_invoice_id'}),
+    ]
+    for label, args, project_name, expected in element_cases:
+        query, params = build_elements_query(args, project_name)
+        checks.append((label, query, params, expected))
+
+    # Keyset pages past a cursor, for every sort key: the (key, id) index both bounds and
+    # orders the scan, in the non-NULL range and in the NULL tail
+    sample_keys = {'price_per_unit': 0, 'total_price': 0}
+    paged_cases = [
+        ('projects', PROJECT_SORTS, 'name', sample, lambda: (PROJECTS_QUERY, [])),
+        ('invoices', INVOICE_SORTS, 'id', 1, lambda: build_invoices_query({})),
+        ('elements', ELEMENT_SORTS, 'elements.id', 1, lambda: build_elements_query({})),
+    ]
+    for table, sorts, id_column, sample_id, build in paged_cases:
+        for sort, column in sorts.items():
+            if column == id_column:
+                expected = {f'{table}_pkey'}
+                afters = [(sample_id, sample_id)]
+            else:
+                expected = {f'idx_{table}_{sort}_id'}
+                afters = [(sample_keys.get(sort, sample), sample_id), (None, sample_id)]
+            for after in afters:
+                page = {'limit': 50, 'sort': sort, 'after': after}
+                query, params = apply_keyset(*build(), page, sorts, id_column)
+                segment = ' (NULL keys)' if after[0] is None else ''
+                checks.append((f'{table} page by {sort}{segment}', query, params, expected))
+
+    return checks
+
+
+def _plan_usage(plan, indexes, seq_scans):
+    """Collect index names and seq-scanned relations from an EXPLAIN (FORMAT JSON) plan"""
+    if 'Index Name' in plan:
+        indexes.add(plan['Index Name'])
+    if plan.get('Node Type') == 'Seq Scan':
+        seq_scans.add(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        _plan_usage(child, indexes, seq_scans)
+
+
+def _explain_usage(cur, query, params):
+    """Return the (indexes, seq-scanned relations) of a query's plan"""
+    cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    indexes, seq_scans = set(), set()
+    _plan_usage(plan[0]['Plan'], indexes, seq_scans)
+    return indexes, seq_scans
+
+
+def verify_indexes():
+    """EXPLAIN every endpoint query and report whether its expected indexes are used.
+
+    Each query is planned twice: as the planner would run it against the current statistics
+    (``natural``), and with seq scans priced out, which shows whether the index can be used at
+    all (``ok``). On small or unanalyzed tables the natural plan may rightly prefer a seq scan.
+    """
+    results = []
+    with db_connection() as conn, conn.cursor() as cur:
+        checks = index_checks()
+        natural = [_explain_usage(cur, query, params) for _, query, params, _ in checks]
+
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for (label, query, params, expected), (natural_indexes, natural_seq_scans) in zip(checks, natural):
+            indexes, seq_scans = _explain_usage(cur, query, params)
+            results.append({
+                'query': label,
+                'ok': expected <= indexes,
+                'missing': sorted(expected - indexes),
+                'indexes': sorted(indexes),
+                'seq_scans': sorted(seq_scans),
+                'natural_ok': expected <= natural_indexes,
+                'natural_indexes': sorted(natural_indexes),
+                'natural_seq_scans': sorted(natural_seq_scans)
+            })
+        conn.rollback()
+    return results
+
+
+@app.cli.command('db-migrate')
+def db_migrate_command():
+    """Apply pending schema migrations."""
+    # Running workers notice the DDL change at their next schema probe
+    applied = apply_migrations()
+    if applied:
+        print(f"Applied {len(applied)} migration(s): {', '.join(applied)}")
+    else:
+        print("Database schema is up to date")
+
+
+@app.cli.command('db-refresh-element-stats')
+def db_refresh_element_stats_command():
+    """Recompute subelement counts and totals on every element."""
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT refresh_element_subelement_stats()")
+    print("Element subelement stats refreshed")
+
+
+@app.cli.command('db-refresh-rollups')
+def db_refresh_rollups_command():
+    """Refresh the project cost rollup view."""
+    refresh_project_cost_rollup(force=True)
+    print("Project cost rollup refreshed")
+
+
+@app.cli.command('db-verify-indexes')
+@click.option('--strict', is_flag=True, help='Also fail when the natural plan does not use the index.')
+def db_verify_indexes_command(strict):
+    """Check that every endpoint query can use its index.
+
+    Fails when an index cannot be used even with seq scans disabled. The natural plan is
+    reported alongside; it only fails the check with --strict, since the planner rightly
+    prefers seq scans on small tables.
+    """
+    results = verify_indexes()
+    for result in results:
+        if not result['ok']:
+            status = 'FAIL'
+        elif not result['natural_ok']:
+            status = 'FAIL' if strict else 'WARN'
+        else:
+            status = 'OK  '
+        print(f"{status} {result['query']}: indexes={result['indexes']}")
+        print(f"     natural plan: indexes={result['natural_indexes']} seq_scans={result['natural_seq_scans']}")
+        if not result['ok']:
+            print(f"     missing: {result['missing']}")
+    if not all(result['ok'] and (result['natural_ok'] or not strict) for result in results):
+        raise SystemExit(1)
+
+
 @app.route('/api/debug/config')
 @token_required  
 def debug_config():
@@ -571,20 +1163,15 @@ def test_db_connection():
         print(f"DB_NAME: {os.getenv('DB_NAME', 'ServitecInvoiceDataBase')}")
         print(f"DB_USER: {os.getenv('DB_USER', 'postgres')}")
         
-        conn = connect_to_db()
-        cur = conn.cursor()
-        
-        # Test query
-        cur.execute('SELECT version()')
-        version = cur.fetchone()
-        
-        # Test a table
-        cur.execute('SELECT COUNT(*) FROM projects')
-        count = cur.fetchone()
-        
-        cur.close()
-        conn.close()
-        
+        with db_connection() as conn, conn.cursor() as cur:
+            # Test query
+            cur.execute('SELECT version()')
+            version = cur.fetchone()
+
+            # Test a table
+            cur.execute('SELECT COUNT(*) FROM projects')
+            count = cur.fetchone()
+
         return jsonify({
             'status': 'success',
             'database': {
@@ -614,27 +1201,18 @@ def health_check():
     print("\n=== Health Check Started ===")
     try:
         # Test database connection
-        conn = connect_to_db()
-        cur = conn.cursor()
-        
-        # Test a simple query
-        print("Testing database query...")
-        cur.execute('SELECT 1')
-        result = cur.fetchone()
-        
-        # Get database version
-        cur.execute('SELECT version()')
-        version = cur.fetchone()
-        
-        cur.close()
-        conn.close()
-        
+        with db_connection() as conn, conn.cursor() as cur:
+            # Get database version
+            cur.execute('SELECT version()')
+            version = cur.fetchone()
+
         print("Health check passed")
         return jsonify({
             "status": "healthy",
             "database": {
                 "connected": True,
-                "version": version[0] if version else ""
+                "version": version[0] if version else "",
+                "pool": db_pool.stats()
             },
             "timestamp": pd.Timestamp.now().isoformat()
         }), 200
@@ -644,84 +1222,72 @@ def health_check():
             "status": "unhealthy",
             "database": {
                 "connected": False,
-                "error": str(e)
+                "error": str(e),
+                "pool": db_pool.stats()
             },
             "timestamp": pd.Timestamp.now().isoformat()
         }), 500
 
 def execute_db_query(query, params=None):
     try:
-        conn = connect_to_db()
-        cur = conn.cursor()
-        if params:
+        with db_connection() as conn, conn.cursor() as cur:
             cur.execute(query, params)
-        else:
-            cur.execute(query)
-        data = cur.fetchall()
-        columns = [desc[0] for desc in cur.description]
-        result = [dict(zip(columns, row)) for row in data]
-        return result
+            data = cur.fetchall()
+            columns = [desc[0] for desc in cur.description]
+        return [dict(zip(columns, row)) for row in data]
     except Exception as e:
         print(f"Query execution error: {str(e)}")
         raise
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
 
 
+# Bookkeeping tables the chat assistant should never query
+SCHEMA_EXCLUDED_TABLES = {'schema_migrations', 'data_versions', 'rollup_refreshes'}
+SCHEMA_EXCLUDED_COLUMNS = {'search_vector'}  # Index-only columns the model should not select
+
 def get_database_schema():
-    conn = connect_to_db()
-    cur = conn.cursor()
-    schema = {}
-
-    # Get list of tables in the public schema
-    cur.execute("""
-        SELECT table_name
-        FROM information_schema.tables
-        WHERE table_schema = 'public' AND table_type = 'BASE TABLE';
-    """)
-    tables = cur.fetchall()
-
-    # Get columns for each table
-    for (table_name,) in tables:
-        cur.execute(f"""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = '{table_name}';
+    with db_connection() as conn, conn.cursor() as cur:
+        schema = {}
+
+        # Get every column of every base table in the public schema in one catalog query
+        cur.execute("""
+            SELECT c.table_name, c.column_name
+            FROM information_schema.columns c
+            JOIN information_schema.tables t
+              ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+            WHERE c.table_schema = 'public' AND t.table_type = 'BASE TABLE'
+            ORDER BY c.table_name, c.ordinal_position;
         """)
-        columns = cur.fetchall()
-        schema[table_name] = [column_name for (column_name,) in columns]
-
-    # Get foreign key relationships between tables
-    cur.execute("""
-        SELECT 
-            tc.table_name, 
-            kcu.column_name, 
-            ccu.table_name AS foreign_table_name,
-            ccu.column_name AS foreign_column_name
-        FROM 
-            information_schema.table_constraints AS tc 
-            JOIN information_schema.key_column_usage AS kcu
-              ON tc.constraint_name = kcu.constraint_name
-            JOIN information_schema.constraint_column_usage AS ccu
-              ON ccu.constraint_name = tc.constraint_name
-        WHERE tc.constraint_type = 'FOREIGN KEY';
-    """)
-    foreign_keys = cur.fetchall()
-    schema['foreign_keys'] = [
-        {
-            'table_name': fk[0],
-            'column_name': fk[1],
-            'foreign_table_name': fk[2],
-            'foreign_column_name': fk[3]
-        }
-        for fk in foreign_keys
-    ]
+        for table_name, column_name in cur.fetchall():
+            if table_name not in SCHEMA_EXCLUDED_TABLES and column_name not in SCHEMA_EXCLUDED_COLUMNS:
+                schema.setdefault(table_name, []).append(column_name)
+
+        # Get foreign key relationships between tables
+        cur.execute("""
+            SELECT 
+                tc.table_name, 
+                kcu.column_name, 
+                ccu.table_name AS foreign_table_name,
+                ccu.column_name AS foreign_column_name
+            FROM 
+                information_schema.table_constraints AS tc 
+                JOIN information_schema.key_column_usage AS kcu
+                  ON tc.constraint_name = kcu.constraint_name
+                JOIN information_schema.constraint_column_usage AS ccu
+                  ON ccu.constraint_name = tc.constraint_name
+            WHERE tc.constraint_type = 'FOREIGN KEY'
+            ORDER BY tc.table_name, kcu.column_name;
+        """)
+        foreign_keys = cur.fetchall()
+        schema['foreign_keys'] = [
+            {
+                'table_name': fk[0],
+                'column_name': fk[1],
+                'foreign_table_name': fk[2],
+                'foreign_column_name': fk[3]
+            }
+            for fk in foreign_keys
+        ]
 
-    cur.close()
-    conn.close()
     return schema
 
 def build_system_prompt(schema):
@@ -740,6 +1306,100 @@ def build_system_prompt(schema):
 
     return schema_description
 
+
+# Schema cache configurations
+class SchemaCacheConfig:
+    TTL = int(os.getenv('SCHEMA_CACHE_TTL', 3600))  # Re-read the catalog after an hour regardless
+    PROBE_INTERVAL = int(os.getenv('SCHEMA_CACHE_PROBE_INTERVAL', 15))  # Seconds between catalog probes
+
+
+# Cheap DDL probe: hashes the oids and columns of the public tables and their foreign keys
+# straight from pg_catalog, so each worker notices a migration without the full schema read
+SCHEMA_PROBE_QUERY = """
+    SELECT md5(
+        COALESCE((
+            SELECT string_agg(c.oid || '.' || a.attnum || '.' || a.attname || '.' || a.atttypid,
+                              ',' ORDER BY c.oid, a.attnum)
+            FROM pg_class c
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+            WHERE c.relnamespace = 'public'::regnamespace AND c.relkind IN ('r', 'p')
+        ), '') || '|' ||
+        COALESCE((
+            SELECT string_agg(oid::text, ',' ORDER BY oid)
+            FROM pg_constraint
+            WHERE connamespace = 'public'::regnamespace AND contype = 'f'
+        ), '')
+    )
+"""
+
+
+def probe_schema():
+    """Return a hash that changes whenever a public table, column or foreign key does"""
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(SCHEMA_PROBE_QUERY)
+        return cur.fetchone()[0]
+
+
+class SchemaCache:
+    """Per-process cache of the database schema and its rendered system prompt"""
+
+    def __init__(self, ttl, probe_interval):
+        self.ttl = ttl
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._entry = None  # (schema, fingerprint, system_prompt)
+        self._probe = None
+        self._expires_at = 0
+        self._probe_at = 0
+
+    def get(self):
+        """Return (schema, fingerprint, system_prompt), reloading the catalog when the probe
+        sees a DDL change or the TTL expires"""
+        with self._lock:
+            now = time.monotonic()
+            if self._entry and now < self._probe_at:
+                return self._entry
+
+            probe = probe_schema()
+            if self._entry and probe == self._probe and now < self._expires_at:
+                self._probe_at = now + self.probe_interval
+                return self._entry
+
+            schema = get_database_schema()
+            fingerprint = hashlib.sha256(
+                json.dumps(schema, sort_keys=True).encode('utf-8')
+            ).hexdigest()[:16]
+
+            # Only re-render the prompt when the DDL actually changed
+            if self._entry and self._entry[1] == fingerprint:
+                system_prompt = self._entry[2]
+            else:
+                if self._entry:
+                    print(f"Database schema changed: {self._entry[1]} -> {fingerprint}")
+                system_prompt = build_system_prompt(schema)
+
+            self._entry = (schema, fingerprint, system_prompt)
+            self._probe = probe
+            now = time.monotonic()
+            self._expires_at = now + self.ttl
+            self._probe_at = now + self.probe_interval
+            return self._entry
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = None
+            self._probe = None
+            self._expires_at = 0
+            self._probe_at = 0
+
+
+schema_cache = SchemaCache(SchemaCacheConfig.TTL, SchemaCacheConfig.PROBE_INTERVAL)
+
+
+def invalidate_schema_cache():
+    """Drop this worker's cached schema so the next chat request re-reads the catalog"""
+    schema_cache.invalidate()
+
 # Static instruction (loaded only once per session)
 STATIC_INSTRUCTIONS = """
 You are an AI assistant designed to help users interact with a PostgreSQL database using natural language. Expect to be spoken in Spanish or Catalan. Your primary functions include:
@@ -757,7 +1417,7 @@ Instructions for Generating SQL Queries:
 Instructions for Interpreting User Requests:
 This application is a data management and reporting tool designed to help users organize, filter, view, and download information on projects, invoices, and elements associated with specific projects. 
 The app provides a graphical interface with DataGrids, filterable search, and selectable item lists to assist users in managing large sets of structured data.
-Reports can be generated in Excel from the DataGrids by selecting the items and clicking the download selected button, or from custom queries from the chatbot.
+Reports can be generated in Excel (or CSV and Parquet for bulk data) from the DataGrids by selecting the items and clicking the download selected button, or from custom queries from the chatbot.
 Be prepared to be flexible with the user's request. If you get a query request and have 0 results, guide the user to try to specify full names within "".
 """
 
@@ -781,8 +1441,8 @@ function_schema = {
             },
             "report_type": {
                 "type": "string",
-                "enum": ["pdf", "excel"],
-                "description": "The report format, required when action is 'generate_report'. Defaults to 'excel'."
+                "enum": ["pdf", "excel", "csv", "parquet"],
+                "description": "The report format, required when action is 'generate_report'. Defaults to 'excel'. Use 'csv' or 'parquet' when the user asks for raw or bulk data in those formats."
             },
             "message": {
                 "type": "string",
@@ -793,516 +1453,2917 @@ function_schema = {
     }
 }
 
-def execute_db_query(query):
-    engine = connect_to_db()
-    with engine.connect() as conn:
-        result = conn.execute(query)
-        rows = result.fetchall()
-        columns = result.keys()
-        return [dict(zip(columns, row)) for row in rows]
-
-
-def is_safe_query(query):
-    # Basic check to prevent dangerous queries
-    disallowed_statements = ['DROP', 'DELETE', 'UPDATE', 'INSERT', 'ALTER', 'CREATE', 'GRANT', 'REVOKE', 'TRUNCATE', 'RENAME', 'COMMENT', 'MODIFY']
-    tokens = query.upper().split()
-    for token in tokens:
-        if token in disallowed_statements:
-            return False
-    return True
+# Guardrails for model-generated SQL
+class SqlGuardConfig:
+    STATEMENT_TIMEOUT_MS = int(os.getenv('CHAT_SQL_TIMEOUT_MS', 15000))  # Per-statement timeout
+    MAX_PLAN_COST = float(os.getenv('CHAT_SQL_MAX_COST', 2_000_000))  # EXPLAIN total cost ceiling
+    MAX_ROWS = int(os.getenv('CHAT_SQL_MAX_ROWS', 10000))  # Row cap for chat answers
+    REPORT_MAX_ROWS = int(os.getenv('CHAT_REPORT_MAX_ROWS', 200000))  # Row cap for chat reports
+    MAX_CONCURRENT = int(os.getenv('CHAT_SQL_MAX_CONCURRENT', 2))  # Generated queries per worker
+    ACQUIRE_TIMEOUT = float(os.getenv('CHAT_SQL_ACQUIRE_TIMEOUT', 5))
+    # Report exports run in the job queue, bounded by REPORT_JOB_WORKERS rather than MAX_CONCURRENT
+    REPORT_TIMEOUT_MS = int(os.getenv('CHAT_REPORT_TIMEOUT_MS', 300000))  # Per-statement timeout for reports
 
-# API Endpoint to get all projects
-@app.route('/api/projects', methods=['GET'])
-@app.route('/api/projects/<project_name>', methods=['GET'])
-def get_projects(project_name=None):
-    print("=== GET Projects Request ===")
+
+# Functions with effects beyond the query's own read-only transaction: session settings, sleeps,
+# advisory locks, other backends, server files and large objects
+BLOCKED_SQL_FUNCTIONS = re.compile(
+    r'set_config|pg_sleep\w*|pg_(try_)?advisory\w*|pg_terminate_backend|pg_cancel_backend'
+    r'|pg_reload_conf|pg_rotate_logfile|pg_switch_wal|pg_create_restore_point|pg_notify'
+    r'|pg_logical_emit_message|pg_read_\w*file|pg_ls_\w+|pg_stat_file|lo_\w+|dblink\w*'
+)
+
+
+class UnsafeQueryError(ValueError):
+    """Raised when generated SQL is rejected before or during execution"""
+
+
+generated_query_slots = threading.BoundedSemaphore(SqlGuardConfig.MAX_CONCURRENT)
+
+
+def validate_generated_sql(query):
+    """Parse generated SQL and return it as a single SELECT statement without comments or
+    trailing semicolons, so callers can safely wrap it in a subquery"""
+    # A trailing "-- comment" would otherwise swallow whatever a caller appends after the query
+    query = sqlparse.format(query or '', strip_comments=True)
+    statements = [
+        statement for statement in sqlparse.parse(query)
+        if str(statement).strip().strip(';').strip()
+    ]
+    if len(statements) != 1:
+        raise UnsafeQueryError("Exactly one SQL statement is allowed")
+
+    statement = statements[0]
+    if statement.get_type() != 'SELECT':
+        raise UnsafeQueryError("Only SELECT statements are allowed")
+
+    # get_type() looks past CTEs, so also reject data-modifying or DDL keywords anywhere
+    tokens = [token for token in statement.flatten() if not token.is_whitespace]
+    for token, next_token in zip(tokens, tokens[1:] + [None]):
+        if token.ttype in (sqlparse.tokens.DML, sqlparse.tokens.DDL) and token.normalized != 'SELECT':
+            raise UnsafeQueryError(f"{token.normalized} is not allowed in generated queries")
+        if token.ttype in sqlparse.tokens.Keyword and token.normalized == 'INTO':
+            raise UnsafeQueryError("SELECT ... INTO is not allowed in generated queries")
+        # READ ONLY does not stop these, and their effects outlive the transaction
+        is_call = next_token is not None and next_token.value == '('
+        name = token.value.strip('"').lower()
+        if is_call and BLOCKED_SQL_FUNCTIONS.fullmatch(name):
+            raise UnsafeQueryError(f"{name}() is not allowed in generated queries")
+
+    return str(statement).strip().rstrip(';').strip()
+
+
+@contextmanager
+def guarded_connection(query, report=False):
+    """Validate generated SQL and yield (conn, statement) inside a READ ONLY transaction
+    with a statement timeout, after checking the planner's cost estimate against the ceiling.
+
+    Chat queries share generated_query_slots and the short timeout; report exports (report=True)
+    run in the job queue, which already bounds them, under REPORT_TIMEOUT_MS.
+    """
+    statement = validate_generated_sql(query)
+    timeout_ms = SqlGuardConfig.REPORT_TIMEOUT_MS if report else SqlGuardConfig.STATEMENT_TIMEOUT_MS
+    slots = None if report else generated_query_slots
+
+    if slots and not slots.acquire(timeout=SqlGuardConfig.ACQUIRE_TIMEOUT):
+        raise UnsafeQueryError("Too many assistant queries are running; please try again shortly")
     try:
-        conn = connect_to_db()
-        cur = conn.cursor()
-        
-        print("Executing projects query...")
-        query = """
-            SELECT name, client, autonomous_community, size_of_construction,
-                   construction_type, number_of_floors, ground_quality_study, end_state
-            FROM projects
-            WHERE 1=1
-        """
-        params = []
-        
-        if project_name:
-            query += " AND name = %s"
-            params.append(project_name)
-            
-        print(f"Query: {query}")
-        print(f"Params: {params}")
-        
-        cur.execute(query, params)
-        projects = cur.fetchall()
-        print(f"Found {len(projects)} projects")
-        
-        columns = [
-            'name', 'client', 'autonomous_community', 'size_of_construction',
-            'construction_type', 'number_of_floors', 'ground_quality_study', 'end_state'
-        ]
-        
-        projects_list = [dict(zip(columns, project)) for project in projects]
-        return jsonify(projects_list)
-    except Exception as e:
-        print(f"! Error in get_projects: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        # Never pooled again: session state a generated query may have changed stays with it
+        with db_connection(discard_after=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SET TRANSACTION READ ONLY")
+                cur.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+
+                cur.execute("EXPLAIN (FORMAT JSON) " + statement)
+                plan = cur.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                cost = plan[0]['Plan']['Total Cost']
+                if cost > SqlGuardConfig.MAX_PLAN_COST:
+                    raise UnsafeQueryError(
+                        f"Query is too expensive to run (estimated cost {cost:,.0f}, "
+                        f"limit {SqlGuardConfig.MAX_PLAN_COST:,.0f}). Try a more specific question."
+                    )
+
+            yield conn, statement
+    except psycopg2.errors.QueryCanceled:
+        raise UnsafeQueryError(
+            f"Query exceeded the {timeout_ms / 1000:.0f}s time limit. "
+            "Try a more specific question."
+        )
+    except psycopg2.errors.ReadOnlySqlTransaction:
+        raise UnsafeQueryError("Only read-only queries are allowed")
     finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
+        if slots:
+            slots.release()
 
 
-# API Endpoint for chat
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    user_message = request.json.get('message')
-    print(f"Received message from user: {user_message}")
+def run_guarded_query(query, max_rows, report=False):
+    """Run generated SQL through guarded_connection with a row cap.
 
+    Returns (columns, rows, truncated).
+    """
+    with guarded_connection(query, report) as (conn, statement):
+        # Server-side cursor so the row cap also bounds what is transferred
+        with use_decimal_numeric(conn.cursor(name=f'guarded_{secrets.token_hex(8)}')) as cur:
+            cur.execute(statement)
+            rows = cur.fetchmany(max_rows + 1)
+            columns = [desc[0] for desc in cur.description]
 
-    # Initialize session-based instructions at the start of each session
-    if 'system_instructions' not in session:
-        session['system_instructions'] = STATIC_INSTRUCTIONS
-        session['conversation_history'] = []
-        
-    # Get the database schema
-    schema = get_database_schema()
+    truncated = len(rows) > max_rows
+    if truncated:
+        print(f"Generated query truncated at {max_rows} rows")
+    return columns, rows[:max_rows], truncated
+
+# Interpretation cache configurations
+class InterpretationCacheConfig:
+    MAX_ENTRIES = int(os.getenv('INTERPRETATION_CACHE_SIZE', 512))
+    TTL = int(os.getenv('INTERPRETATION_CACHE_TTL', 3600))  # 1 hour
+    CONTEXT_MESSAGES = int(os.getenv('INTERPRETATION_CACHE_CONTEXT', 2))  # Prior messages in the key
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a TTL"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {key: (expires_at, value)}
+        self._counters = defaultdict(int)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            if time.monotonic() >= entry[0]:
+                del self._entries[key]
+                self._counters['expired'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self._counters['hits'], self._counters['misses']
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else 0,
+                'evictions': self._counters['evictions'],
+                'expired': self._counters['expired']
+            }
 
-    # Build the system prompt with schema information
-    system_prompt = build_system_prompt(schema)
 
-    # Retrieve conversation history from session
-    conversation_history = session.get('conversation_history', [])
-    conversation_history.append({"role": "user", "content": user_message})
+interpretation_cache = TTLCache(InterpretationCacheConfig.MAX_ENTRIES, InterpretationCacheConfig.TTL)
 
-    # Limit the conversation history
-    if len(conversation_history) > MAX_HISTORY_LENGTH:
-        conversation_history = conversation_history[-MAX_HISTORY_LENGTH:]
 
-    messages = [{"role": "system", "content": system_prompt}] + conversation_history
+def normalize_message(text):
+    """Fold case, Unicode forms, whitespace and trailing punctuation of a user message"""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    text = ' '.join(text.split())
+    return text.strip(' ?!.¿¡')
 
-    try:
-        # Call OpenAI API with function calling
-        chat_response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Use GPT-4 for better performance
-            messages=messages,
-            functions=[function_schema],
-            function_call={"name": "interpret_user_request"},
-            temperature=0
-            )
 
-        # Access the function call arguments
-        choice = chat_response.choices[0]
-        function_call_args = choice.message.function_call.arguments
-                    
-        # Parse the arguments as JSON
-        interpretation = json.loads(function_call_args)
+def interpretation_cache_key(conversation_history, schema_fingerprint):
+    """Key on the normalized question, the recent conversation and the schema version"""
+    *previous, current = conversation_history
+    tail = previous[-InterpretationCacheConfig.CONTEXT_MESSAGES:] if InterpretationCacheConfig.CONTEXT_MESSAGES else []
+    payload = json.dumps([
+        schema_fingerprint,
+        normalize_message(current['content']),
+        [(message['role'], normalize_message(message['content'])) for message in tail]
+    ])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-        print(f"Interpretation: {interpretation}")
 
-        # Extract information from the interpretation
-        action = interpretation.get('action', None)  # 'action' is required, but None if missing for safety
-        sql_query = interpretation.get('sql_query', None)  # Default to None if not present
-        report_type = interpretation.get('report_type', 'excel')  # Default to 'excel'
-        assistant_message = interpretation.get('message', "")  # Default to empty string
+def interpret_user_request(messages, conversation_history, schema_fingerprint):
+    """Return the model's interpretation of the latest message, served from cache when possible"""
+    cache_key = interpretation_cache_key(conversation_history, schema_fingerprint)
+    cached = interpretation_cache.get(cache_key)
+    if cached is not None:
+        print("Interpretation served from cache")
+        return dict(cached)
 
-        if action == 'query_data':
-            if not sql_query:
-                return jsonify({'reply': "Error: No SQL query provided.", 'format': 'markdown'}), 400
+    # Call OpenAI API with function calling
+    chat_response = client.chat.completions.create(
+        model="gpt-4o-mini",  # Use GPT-4 for better performance
+        messages=messages,
+        functions=[function_schema],
+        function_call={"name": "interpret_user_request"},
+        temperature=0
+        )
 
-            # Check if the query is safe
-            if not is_safe_query(sql_query):
-                return jsonify({'reply': "Error: Unsafe SQL query detected.", 'format': 'markdown'}), 400
-            # Execute the query and fetch data
-            conn = connect_to_db()
-            cur = conn.cursor()
-            cur.execute(sql_query)
-            
-            rows = cur.fetchall()
-            columns = [desc[0] for desc in cur.description]
-            result = [dict(zip(columns, row)) for row in rows]
-
-            # Format the data for natural language response
-            natural_language_responses = []
-            if result:
-                for row in result:
-                    row_text = ', '.join(f"{col.replace('_', ' ').capitalize()}: {val}" for col, val in row.items())
-                    natural_language_responses.append(row_text)
-            else:
-                natural_language_responses.append("No results found.")
+    # Access the function call arguments
+    choice = chat_response.choices[0]
+    function_call_args = choice.message.function_call.arguments
 
-            # Close the database connection
-            cur.close()
-            conn.close()
+    # Parse the arguments as JSON
+    interpretation = json.loads(function_call_args)
 
-            # Create a summary message for OpenAI to generate a natural language response
-            data_summary = (
-                "Here are the data you need to answer the user's previous question. "
-                "Create a natural language response based on the data, question, and context:\n" +
-                "\n".join(natural_language_responses)
-            )
-            messages.append({"role": "user", "content": data_summary})
+    if interpretation.get('action') in function_schema['parameters']['properties']['action']['enum']:
+        interpretation_cache.set(cache_key, dict(interpretation))
+    return interpretation
 
-            # Limit the conversation history if necessary
-            if len(messages) > MAX_HISTORY_LENGTH:
-                messages = messages[-MAX_HISTORY_LENGTH:]
 
-            # Call OpenAI again to generate the final natural language response
-            final_response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages
-            )
+# Pagination configurations
+class PaginationConfig:
+    MAX_LIMIT = int(os.getenv('PAGINATION_MAX_LIMIT', 1000))
 
-            # Retrieve the final response content
-            if final_response.choices and final_response.choices[0].message.content:
-                final_content = final_response.choices[0].message.content.strip()
-                # Append assistant's response to conversation history
-                conversation_history.append({"role": "assistant", "content": final_content})
-                session['conversation_history'] = conversation_history
-                return jsonify({'reply': final_content, 'format': 'markdown'})
-            else:
-                return jsonify({'reply': "Error: No content in final response.", 'format': 'markdown'}), 500
-        
-        elif action == 'generate_report':
-            sql_query = interpretation.get('sql_query')
-            report_type = interpretation.get('report_type', 'excel')
-            
-            try:
-                # Execute query and get data
-                conn = connect_to_db()
-                cur = conn.cursor()
-                cur.execute(sql_query)
-                data = cur.fetchall()
-                columns = [desc[0] for desc in cur.description]
-                df = pd.DataFrame(data, columns=columns)
-                cur.close()
-                conn.close()
-
-                # Generate timestamp and filename (same pattern as downloadSelected)
-                timestamp = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
-                filename = f"chat_report_{timestamp}.xlsx"
-                filepath = os.path.join(REPORTS_DIR, filename)
-                
-                # Ensure directory exists
-                os.makedirs(os.path.dirname(filepath), exist_ok=True)
-
-                # Save Excel file
-                with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
-                    df.to_excel(writer, index=False, sheet_name='Report')
-                    workbook = writer.book
-                    worksheet = writer.sheets['Report']
-                    header_format = workbook.add_format({'bold': True, 'bg_color': '#D3D3D3'})
-                    for col_num, value in enumerate(df.columns.values):
-                        worksheet.write(0, col_num, value, header_format)
-
-                # Return the download URL using the same pattern as downloadSelected
-                report_url = f'/api/download/{filename}'
-                
-                return jsonify({
-                    'reply': "Report generated successfully. You can download it using the button below.",
-                    'format': 'markdown',
-                    'report_url': report_url
-                })
 
+class PaginationError(ValueError):
+    """Raised for malformed limit, sort or cursor parameters"""
+
+
+# Sortable keys per endpoint: {sort name: SQL expression}. The sort name is
+# also the result column holding the key, so the next cursor can be read back.
+# Every key has a (key, id) index (migration 0008); keys on a joined table
+# cannot share an index with the id, so they are not offered.
+PROJECT_SORTS = {'name': 'name'}
+INVOICE_SORTS = {
+    'id': 'id',
+    'file_name': 'file_name',
+    'folder_type': 'folder_type',
+    'project_name': 'project_name'
+}
+ELEMENT_SORTS = {
+    'id': 'elements.id',
+    'name': 'elements.name',
+    'chapter_code': 'elements.chapter_code',
+    'price_per_unit': 'elements.price_per_unit',
+    'total_price': 'elements.total_price'
+}
+
+
+def _cursor_signature(payload):
+    return hmac.new(app.config['SECRET_KEY'].encode('utf-8'), payload, hashlib.sha256).hexdigest()[:16]
+
+
+def encode_cursor(sort, key, row_id):
+    """Encode the last (sort key, id) of a page as an opaque, signed token"""
+    payload = base64.urlsafe_b64encode(json.dumps([sort, key, row_id], default=str).encode('utf-8'))
+    return f"{payload.decode('ascii')}.{_cursor_signature(payload)}"
+
+
+def decode_cursor(token, sort):
+    """Return the (sort key, id) stored in a cursor token issued for the same sort"""
+    try:
+        payload, signature = token.encode('ascii').rsplit(b'.', 1)
+        if not hmac.compare_digest(signature, _cursor_signature(payload).encode('ascii')):
+            raise PaginationError('Invalid cursor')
+        cursor_sort, key, row_id = json.loads(base64.urlsafe_b64decode(payload))
+    except (ValueError, TypeError, UnicodeError):
+        raise PaginationError('Invalid cursor')
+    if cursor_sort != sort:
+        raise PaginationError('Cursor was issued for a different sort')
+    return key, row_id
+
+
+def parse_page_args(args, sorts, default_sort):
+    """Return the requested keyset page, or None when the client did not ask for one"""
+    if 'limit' not in args and 'cursor' not in args:
+        return None
+    try:
+        limit = int(args.get('limit', PaginationConfig.MAX_LIMIT))
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    if limit < 1:
+        raise PaginationError('limit must be positive')
+
+    sort = args.get('sort', default_sort)
+    if sort not in sorts:
+        raise PaginationError(f"sort must be one of: {', '.join(sorts)}")
+
+    cursor = args.get('cursor')
+    return {
+        'limit': min(limit, PaginationConfig.MAX_LIMIT),
+        'sort': sort,
+        'after': decode_cursor(cursor, sort) if cursor else None
+    }
+
+
+def apply_keyset(query, params, page, sorts, id_column):
+    """Append the keyset predicate, ORDER BY and LIMIT to a query ending in a WHERE clause.
+
+    Every predicate is a single range on the (sort key, id) index, so later pages cost the same
+    as the first.
+    """
+    sort_column = sorts[page['sort']]
+    params = list(params)
+    limit = page['limit'] + 1  # One extra row tells whether another page exists
+
+    if sort_column == id_column:
+        if page['after'] is not None:
+            query += f" AND {id_column} > %s"
+            params.append(page['after'][1])
+        query += f" ORDER BY {id_column} LIMIT %s"
+        params.append(limit)
+        return query, params
+
+    order_by = f" ORDER BY {sort_column}, {id_column} LIMIT %s"
+    if page['after'] is None:
+        return query + order_by, params + [limit]
+
+    key, row_id = page['after']
+    # ASC sorts put NULL keys last, so they form their own tail segment
+    if key is None:
+        query += f" AND {sort_column} IS NULL AND {id_column} > %s" + order_by
+        return query, params + [row_id, limit]
+
+    # The rest of the non-NULL range, then the start of the NULL segment, each its own index
+    # scan; an OR of the two would rule out the range scan. Result columns are named after
+    # the sort key and the id.
+    id_name = id_column.rsplit('.', 1)[-1]
+    query = (
+        f"({query} AND ({sort_column}, {id_column}) > (%s, %s){order_by})\n"
+        f"UNION ALL\n"
+        f"({query} AND {sort_column} IS NULL{order_by})\n"
+        f"ORDER BY {page['sort']}, {id_name} LIMIT %s"
+    )
+    return query, params + [key, row_id, limit] + params + [limit, limit]
+
+
+def build_page(rows, columns, page, id_key, response_format='objects'):
+    """Trim the look-ahead row and attach the cursor for the next page"""
+    has_more = len(rows) > page['limit']
+    rows = rows[:page['limit']]
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            page['sort'], last[columns.index(page['sort'])], last[columns.index(id_key)]
+        )
+    return {
+        'items': shape_rows(columns, rows, response_format),
+        'next_cursor': next_cursor,
+        'limit': page['limit'],
+        'sort': page['sort']
+    }
+
+
+# 'objects' is a list of row dicts; 'columnar' and 'rows' send each column name once
+RESPONSE_FORMATS = ('objects', 'columnar', 'rows')
+
+
+class ResponseFormatError(ValueError):
+    """Raised for an unknown format parameter"""
+
+
+def get_response_format(args):
+    response_format = args.get('format', 'objects')
+    if response_format not in RESPONSE_FORMATS:
+        raise ResponseFormatError(
+            f"Unknown format '{response_format}'; expected one of {', '.join(RESPONSE_FORMATS)}"
+        )
+    return response_format
+
+
+def shape_rows(columns, rows, response_format):
+    """Build a response body from cursor rows; only the 'objects' format builds per-row dicts.
+
+    columnar: {"columns": [...], "data": {column: [values]}}
+    rows:     {"columns": [...], "rows": [[values], ...]}
+    """
+    if response_format == 'columnar':
+        values = zip(*rows) if rows else [()] * len(columns)
+        return {'columns': columns, 'data': {column: list(vals) for column, vals in zip(columns, values)}}
+    if response_format == 'rows':
+        return {'columns': columns, 'rows': rows}
+    return [dict(zip(columns, row)) for row in rows]
+
+
+# Selectable columns per endpoint for the fields= parameter: {field name: SQL expression}
+ELEMENT_FIELDS = {
+    'id': 'elements.id',
+    'invoice_id': 'elements.invoice_id',
+    'name': 'elements.name',
+    'unit': 'elements.unit',
+    'quantity': 'elements.quantity',
+    'price_per_unit': 'elements.price_per_unit',
+    'discount': 'elements.discount',
+    'total_price': 'elements.total_price',
+    'chapter_code': 'elements.chapter_code',
+    'chapter_title': 'elements.chapter_title',
+    'subchapter_code': 'elements.subchapter_code',
+    'subchapter_title': 'elements.subchapter_title',
+    'element_code': 'elements.element_code',
+    'description': 'elements.description',
+    'has_subelements': 'elements.has_subelements',
+    'subelement_count': 'elements.subelement_count',
+    'subelements_total': 'elements.subelements_total',
+    'invoice_name': 'invoices.file_name',
+    'folder_type': 'invoices.folder_type',
+    'project_name': 'invoices.project_name'
+}
+SUBELEMENT_FIELDS = {
+    'id': 'subelements.id',
+    'element_id': 'subelements.element_id',
+    'title': 'subelements.title',
+    'unit': 'subelements.unit',
+    'n': 'subelements.n',
+    'l': 'subelements.l',
+    'h': 'subelements.h',
+    'w': 'subelements.w',
+    'unit_price': 'subelements.unit_price',
+    'total_price': 'subelements.total_price'
+}
+
+
+class FieldSelectionError(ValueError):
+    """Raised for an empty or unknown fields parameter"""
+
+
+def parse_fields(args, allowed, required=(), param='fields'):
+    """Return the requested field names in order, or None when the client did not ask for a projection.
+
+    Required fields (the id and sort key a keyset page reads back) are appended when missing.
+    """
+    if param not in args:
+        return None
+    fields = [field.strip() for field in args.get(param, '').split(',') if field.strip()]
+    if not fields:
+        raise FieldSelectionError(f'{param} must name at least one column')
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise FieldSelectionError(
+            f"Unknown fields: {', '.join(unknown)}; expected any of {', '.join(allowed)}"
+        )
+    return list(OrderedDict.fromkeys(fields + list(required)))
+
+
+def select_list(fields, allowed):
+    return ', '.join(f"{allowed[field]} AS {field}" for field in fields)
+
+
+# Response compression configurations
+class CompressionConfig:
+    MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))  # Smaller bodies are sent uncompressed
+    GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+    BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 5))
+    MIMETYPES = {'application/json', 'text/plain', 'text/html'}
+
+
+def negotiate_encoding(accept_encodings):
+    """Pick br or gzip from an Accept-Encoding header, or None when the client takes neither"""
+    br = accept_encodings.quality('br') if brotli is not None else 0
+    gz = accept_encodings.quality('gzip')
+    if br and br >= gz:
+        return 'br'
+    return 'gzip' if gz else None
+
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=CompressionConfig.BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=CompressionConfig.GZIP_LEVEL)
+
+
+def set_encoded_body(response, body, encoding):
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+
+
+@app.after_request
+def compress_response(response):
+    # Streamed bodies and files are left alone; only buffered text responses are compressed
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in CompressionConfig.MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = negotiate_encoding(request.accept_encodings)
+    if len(body) < CompressionConfig.MIN_SIZE or encoding is None:
+        return response
+
+    set_encoded_body(response, compress_body(body, encoding), encoding)
+    return response
+
+
+# Conditional GET configurations
+class ConditionalConfig:
+    CACHE_CONTROL = 'no-cache'  # Browsers keep the response but revalidate it with If-None-Match
+
+
+def versioned(*tables):
+    """Tag GET responses with a weak ETag from the tables' data versions; a matching
+    If-None-Match gets a 304 before the view runs its query"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            # The tag covers the URL only, so requests with a body are never answered from it
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+
+            # The listener's copy costs nothing; before it has connected, ask the database
+            version = data_listener.versions(tables)
+            if version is None:
+                try:
+                    with db_connection() as conn:
+                        version = data_version(conn, tables)
+                except psycopg2.Error as e:
+                    print(f"Data versions unavailable, serving without ETag: {str(e)}")
+                    return f(*args, **kwargs)
+            if not version:
+                return f(*args, **kwargs)
+
+            etag = hashlib.sha256(f'{version}|{request.full_path}'.encode('utf-8')).hexdigest()[:32]
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = ConditionalConfig.CACHE_CONTROL
+            return response
+        return decorated
+    return decorator
+
+
+# Read cache configurations
+class ReadCacheConfig:
+    MAX_ENTRIES = int(os.getenv('READ_CACHE_MAX_ENTRIES', 256))  # In-memory responses per endpoint, per worker
+    TTL = int(os.getenv('READ_CACHE_TTL', 600))  # Upper bound on entry age in both tiers (seconds)
+    SHARED_DIR = os.getenv('READ_CACHE_DIR', '/tmp/read-cache')  # Node-local directory shared by all workers
+    SHARED_MAX_ENTRIES = int(os.getenv('READ_CACHE_SHARED_MAX_ENTRIES', 1024))  # Files per endpoint
+    CHANNEL = 'data_changed'  # NOTIFY channel of bump_data_version()
+    POLL_INTERVAL = 5  # Seconds between listener health checks, which also re-read data_versions
+    RECONNECT_DELAY = 5
+
+
+class DataChangeListener:
+    """Per-process LISTEN thread that mirrors data_versions and tells subscribers which tables changed"""
+
+    def __init__(self, channel, poll_interval, reconnect_delay):
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.reconnect_delay = reconnect_delay
+        self._subscribers = []
+        self._reset()
+
+    def _reset(self):
+        # The listener thread does not survive fork, so each worker process starts its own lazily
+        self._lock = threading.Lock()
+        self._thread = None
+        self._versions = None  # {table_name: version} while listening
+        self._counters = defaultdict(int)
+
+    def subscribe(self, callback):
+        """Call callback(tables) on every change; tables is None when notifications may have been missed"""
+        self._subscribers.append(callback)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='data-change-listener', daemon=True)
+                self._thread.start()
+
+    def versions(self, tables):
+        """Version stamp in data_version() format, or None while not listening"""
+        self.start()
+        with self._lock:
+            versions = self._versions
+        if versions is None:
+            return None
+        return ','.join(f'{name}:{versions[name]}' for name in sorted(tables) if name in versions)
+
+    def _update(self, versions, complete):
+        with self._lock:
+            initial = self._versions is None
+            current = dict(self._versions or {})
+            changed = {name for name, version in versions.items() if current.get(name, -1) < version}
+            current.update({name: versions[name] for name in changed})
+            self._versions = current
+        if complete:
+            changed = None
+        elif initial:
+            return changed  # Nothing was cached against the versions we did not know
+        if changed is None or changed:
+            for callback in self._subscribers:
+                callback(changed)
+        return changed
+
+    def _read_versions(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT table_name, version FROM data_versions")
+            return dict(cur.fetchall())
+
+    def _listen(self, conn):
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {self.channel}")
+        # After a reconnect anything may have changed while nobody was listening
+        self._update(self._read_versions(conn), complete=self._counters['connects'] > 1)
+        while True:
+            if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                # Idle: the version read doubles as a health check and catches lost notifications
+                if self._update(self._read_versions(conn), complete=False):
+                    self._counters['reconciled'] += 1
+            conn.poll()
+            versions = {}
+            while conn.notifies:
+                table_name, _, version = conn.notifies.pop(0).payload.partition(':')
+                versions[table_name] = max(int(version), versions.get(table_name, 0))
+                self._counters['notifications'] += 1
+            if versions:
+                self._update(versions, complete=False)
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = connect_to_db()
+                self._counters['connects'] += 1
+                self._listen(conn)
             except Exception as e:
-                print(f"Error generating report: {str(e)}")
-                return jsonify({
-                    'reply': f"Error generating report: {str(e)}", 
-                    'format': 'markdown'
-                }), 500
-                
-        elif action in ['instruct_user', 'conversation']:
-            if not assistant_message:
-                return jsonify({'reply': "Error: No message provided by assistant.", 'format': 'markdown'}), 400
+                print(f"Data change listener error: {str(e)}")
+            finally:
+                with self._lock:
+                    self._versions = None
+                if conn is not None and not conn.closed:
+                    conn.close()
+            time.sleep(self.reconnect_delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'listening': self._versions is not None,
+                'versions': dict(self._versions or {}),
+                'connects': self._counters['connects'],
+                'notifications': self._counters['notifications'],
+                'reconciled': self._counters['reconciled']
+            }
 
-            # Append assistant's response to conversation history
-            conversation_history.append({"role": "assistant", "content": assistant_message})
-            session['conversation_history'] = conversation_history
 
-            return jsonify({'reply': assistant_message, 'format': 'markdown'})
+data_listener = DataChangeListener(
+    ReadCacheConfig.CHANNEL, ReadCacheConfig.POLL_INTERVAL, ReadCacheConfig.RECONNECT_DELAY
+)
+os.register_at_fork(after_in_child=data_listener._reset)
+
+
+class ReadCache:
+    """Two-tier cache of serialized GET responses: a per-worker LRU in front of files shared by
+    every worker on the node. Keys include the data versions the response was read at."""
+
+    def __init__(self, directory, max_entries, ttl, shared_max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared_max_entries = shared_max_entries
+        self._memory = {}  # {namespace: TTLCache}
+        self._tables = {}  # {namespace: set of table names}
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    def register(self, namespace, tables):
+        self._memory[namespace] = TTLCache(self.max_entries, self.ttl)
+        self._tables[namespace] = set(tables)
+
+    def key(self, namespace, parts, version):
+        digest = hashlib.sha256(json.dumps([parts, version], sort_keys=True).encode('utf-8')).hexdigest()[:32]
+        return namespace, digest
+
+    def encoded_key(self, key, encoding):
+        """Key of the compressed copy of an entry; it lives and is invalidated beside the entry"""
+        namespace, digest = key
+        return namespace, f'{digest}.{encoding}'
+
+    def get(self, key):
+        namespace, digest = key
+        body = self._memory[namespace].get(digest)
+        if body is not None:
+            return body
+        try:
+            with open(os.path.join(self.directory, namespace, digest), 'rb') as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime < self.ttl:
+                    body = f.read()
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._counters['shared_hits' if body is not None else 'shared_misses'] += 1
+        if body is not None:
+            self._memory[namespace].set(digest, body)
+        return body
+
+    def set(self, key, body):
+        namespace, digest = key
+        self._memory[namespace].set(digest, body)
+        directory = os.path.join(self.directory, namespace)
+        os.makedirs(directory, exist_ok=True)
+        filepath = os.path.join(directory, digest)
+        tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, filepath)
+        except OSError as e:
+            print(f"Read cache write failed: {str(e)}")
+            return
+        with self._lock:
+            self._counters['shared_writes'] += 1
+        self._trim(directory)
+
+    def _entries(self, directory):
+        try:
+            return [entry for entry in os.scandir(directory) if not entry.name.endswith('.tmp')]
+        except FileNotFoundError:
+            return []
+
+    def _remove(self, entries):
+        removed = 0
+        for entry in entries:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass  # Another worker got there first
+        return removed
+
+    def _trim(self, directory):
+        entries = self._entries(directory)
+        if len(entries) <= self.shared_max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        removed = self._remove(entries[:len(entries) - self.shared_max_entries])
+        with self._lock:
+            self._counters['shared_evictions'] += removed
+
+    def invalidate(self, tables):
+        """Drop both tiers of every namespace that reads one of tables (all namespaces for None)"""
+        for namespace, namespace_tables in self._tables.items():
+            if tables is not None and not namespace_tables & tables:
+                continue
+            self._memory[namespace].clear()
+            removed = self._remove(self._entries(os.path.join(self.directory, namespace)))
+            with self._lock:
+                self._counters['invalidations'] += 1
+                self._counters['shared_evictions'] += removed
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        hits, misses = counters.get('shared_hits', 0), counters.get('shared_misses', 0)
+        return {
+            'memory': {namespace: cache.stats() for namespace, cache in self._memory.items()},
+            'shared': {
+                'directory': self.directory,
+                'entries': {
+                    namespace: len(self._entries(os.path.join(self.directory, namespace)))
+                    for namespace in self._memory
+                },
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else 0,
+                'writes': counters.get('shared_writes', 0),
+                'evictions': counters.get('shared_evictions', 0)
+            },
+            'invalidations': counters.get('invalidations', 0)
+        }
+
+
+read_cache = ReadCache(
+    ReadCacheConfig.SHARED_DIR, ReadCacheConfig.MAX_ENTRIES, ReadCacheConfig.TTL,
+    ReadCacheConfig.SHARED_MAX_ENTRIES
+)
+data_listener.subscribe(read_cache.invalidate)
+
+
+def read_cached(namespace, tables, params, flags=()):
+    """Serve a GET view's JSON from read_cache, keyed by its URL arguments, the named query
+    parameters (flags count only when 'true') and the tables' data versions.
+
+    Bodies worth compressing are also cached per content encoding, so a hit is never
+    compressed again; compress_response skips responses that already carry an encoding.
+    """
+    read_cache.register(namespace, tables)
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            # Without the listener there is no cheap way to tell when an entry goes stale
+            version = data_listener.versions(tables)
+            if version is None:
+                return f(*args, **kwargs)
+
+            parts = dict(kwargs)
+            parts.update({name: request.args[name] for name in params if request.args.get(name)})
+            parts.update({name: True for name in flags if request.args.get(name) == 'true'})
+            key = read_cache.key(namespace, parts, version)
+            encoding = negotiate_encoding(request.accept_encodings)
+            if encoding is not None:
+                encoded = read_cache.get(read_cache.encoded_key(key, encoding))
+                if encoded is not None:
+                    response = app.response_class(mimetype='application/json')
+                    response.vary.add('Accept-Encoding')
+                    set_encoded_body(response, encoded, encoding)
+                    return response
+
+            body = read_cache.get(key)
+            if body is not None:
+                response = app.response_class(body, mimetype='application/json')
+            else:
+                response = app.make_response(f(*args, **kwargs))
+                if not (response.status_code == 200 and not response.is_streamed
+                        and response.mimetype == 'application/json'):
+                    return response
+                body = response.get_data()
+                read_cache.set(key, body)
+
+            if encoding is not None and len(body) >= CompressionConfig.MIN_SIZE:
+                encoded = compress_body(body, encoding)
+                read_cache.set(read_cache.encoded_key(key, encoding), encoded)
+                response.vary.add('Accept-Encoding')
+                set_encoded_body(response, encoded, encoding)
+            return response
+        return decorated
+    return decorator
+
+
+PAGE_PARAMS = ('format', 'limit', 'sort', 'cursor')
+INVOICE_FILTER_PARAMS = ('startDate', 'endDate', 'FileNameKeyword')
+FOLDER_TYPE_FLAGS = ('folderTypeFilters[adicionals]', 'folderTypeFilters[pressupost]')
+
+
+PROJECTS_QUERY = """
+    SELECT name, client, autonomous_community, size_of_construction,
+           construction_type, number_of_floors, ground_quality_study, end_state
+    FROM projects
+    WHERE 1=1
+"""
+
+# API Endpoint to get all projects
+@app.route('/api/projects', methods=['GET'])
+@app.route('/api/projects/<project_name>', methods=['GET'])
+@versioned('projects')
+@read_cached('projects', ('projects',), PAGE_PARAMS)
+def get_projects(project_name=None):
+    print("=== GET Projects Request ===")
+    try:
+        print("Executing projects query...")
+        query = PROJECTS_QUERY
+        params = []
+        
+        if project_name:
+            query += " AND name = %s"
+            params.append(project_name)
+
+        response_format = get_response_format(request.args)
+        page = parse_page_args(request.args, PROJECT_SORTS, 'name')
+        if page:
+            query, params = apply_keyset(query, params, page, PROJECT_SORTS, 'name')
+
+        print(f"Query: {query}")
+        print(f"Params: {params}")
+        
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            projects = cur.fetchall()
+        print(f"Found {len(projects)} projects")
+        
+        columns = [
+            'name', 'client', 'autonomous_community', 'size_of_construction',
+            'construction_type', 'number_of_floors', 'ground_quality_study', 'end_state'
+        ]
+        
+        if page:
+            return jsonify(build_page(projects, columns, page, 'name', response_format))
+        return jsonify(shape_rows(columns, projects, response_format))
+    except (PaginationError, ResponseFormatError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"! Error in get_projects: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+def start_chat_turn(user_message):
+    """Append the user message to the session history and build the model messages"""
+    # Initialize session-based instructions at the start of each session
+    if 'system_instructions' not in session:
+        session['system_instructions'] = STATIC_INSTRUCTIONS
+        session['conversation_history'] = []
+
+    # Get the cached database schema and the system prompt built from it
+    schema, schema_fingerprint, system_prompt = schema_cache.get()
+
+    # Retrieve conversation history from session
+    conversation_history = session.get('conversation_history', [])
+    conversation_history.append({"role": "user", "content": user_message})
+
+    # Limit the conversation history
+    if len(conversation_history) > MAX_HISTORY_LENGTH:
+        conversation_history = conversation_history[-MAX_HISTORY_LENGTH:]
+
+    messages = [{"role": "system", "content": system_prompt}] + conversation_history
+    return conversation_history, messages, schema_fingerprint
+
+
+def run_chat_query(sql_query, max_rows=SqlGuardConfig.MAX_ROWS, report=False):
+    """Execute a model-generated query through the guarded executor; returns (columns, rows, truncated)"""
+    return run_guarded_query(sql_query, max_rows, report)
+
+
+# Chat result shaping configurations
+class ChatResultConfig:
+    MAX_ROWS_TO_MODEL = int(os.getenv('CHAT_MAX_ROWS_TO_MODEL', 50))  # Above this, send aggregates instead
+    SAMPLE_ROWS = int(os.getenv('CHAT_SAMPLE_ROWS', 10))
+    TOP_N = int(os.getenv('CHAT_TOP_N', 5))
+    GROUP_COLUMNS = ['project_name', 'chapter_title', 'chapter_code', 'subchapter_title',
+                     'invoice_name', 'file_name', 'folder_type']
+
+
+def format_result_rows(columns, rows):
+    """Render rows as 'Col: val' lines for the model"""
+    return [
+        ', '.join(f"{col.replace('_', ' ').capitalize()}: {val}" for col, val in zip(columns, row))
+        for row in rows
+    ]
+
+
+def summarize_result(df):
+    """Vectorized aggregates describing a result too large to send row by row"""
+    numeric_columns = []
+    for col in df.columns:
+        if col == 'id' or col.endswith('_id') or df[col].dtype == bool:
+            continue
+        values = pd.to_numeric(df[col], errors='coerce')
+        # Keep columns whose non-null values are all numeric (Decimal, int, float)
+        if values.notna().sum() and values.notna().sum() == df[col].notna().sum():
+            df[col] = values
+            numeric_columns.append(col)
+
+    lines = [f"- Row count: {len(df)}"]
+    if numeric_columns:
+        stats = df[numeric_columns].agg(['sum', 'min', 'max'])
+        for col in numeric_columns:
+            lines.append(
+                f"- {col}: sum={stats.at['sum', col]:.2f}, "
+                f"min={stats.at['min', col]:.2f}, max={stats.at['max', col]:.2f}"
+            )
+
+    value_column = 'total_price' if 'total_price' in numeric_columns else (numeric_columns[0] if numeric_columns else None)
+    for group in ChatResultConfig.GROUP_COLUMNS:
+        if group not in df.columns or df[group].nunique() <= 1:
+            continue
+        if value_column:
+            top = df.groupby(group)[value_column].sum().nlargest(ChatResultConfig.TOP_N)
+            lines.append(f"Top {len(top)} {group} by {value_column}:")
+            lines.extend(f"  - {key}: {value:.2f}" for key, value in top.items())
+        else:
+            top = df[group].value_counts().head(ChatResultConfig.TOP_N)
+            lines.append(f"Top {len(top)} {group} by row count:")
+            lines.extend(f"  - {key}: {value}" for key, value in top.items())
+    return lines
+
+
+def build_data_summary(columns, rows, truncated=False, sql_query=None, owner=None):
+    """Render query results as the prompt for the final natural language answer.
+
+    Returns (data_summary, report_job). Results above MAX_ROWS_TO_MODEL are
+    replaced by aggregates and a sample, and the query is queued as a report
+    job of up to CHAT_REPORT_MAX_ROWS rows, returned alongside.
+    """
+    report_job = None
+    # Format the data for natural language response
+    if not rows:
+        natural_language_responses = ["No results found."]
+    elif len(rows) <= ChatResultConfig.MAX_ROWS_TO_MODEL:
+        natural_language_responses = format_result_rows(columns, rows)
+    else:
+        df = pd.DataFrame(rows, columns=columns)
+        natural_language_responses = (
+            [f"The query returned {len(rows)} rows, too many to list. Aggregates over all rows:"]
+            + summarize_result(df)
+            + [f"First {ChatResultConfig.SAMPLE_ROWS} rows:"]
+            + format_result_rows(columns, rows[:ChatResultConfig.SAMPLE_ROWS])
+        )
+        try:
+            report_job = enqueue_chat_report(sql_query, owner)
+            natural_language_responses.append(
+                "The full result is being prepared for the user as a downloadable Excel report "
+                f"(up to {SqlGuardConfig.REPORT_MAX_ROWS} rows); mention it."
+            )
+        except ReportJobLimitError:
+            natural_language_responses.append(
+                "The full result could not be exported because the user already has reports in progress; "
+                "tell them to ask again once those finish."
+            )
+        except ReportJobAuthError:
+            natural_language_responses.append(
+                "The full result could not be exported because the user is not signed in; tell them to sign in."
+            )
+
+    if truncated:
+        natural_language_responses.append(
+            f"Note: the result was cut off at {len(rows)} rows; tell the user it may be incomplete."
+        )
+
+    # Create a summary message for OpenAI to generate a natural language response
+    data_summary = (
+        "Here are the data you need to answer the user's previous question. "
+        "Create a natural language response based on the data, question, and context:\n" +
+        "\n".join(natural_language_responses)
+    )
+    return data_summary, report_job
+
+
+def build_answer_messages(messages, data_summary):
+    """Messages for the second model call, which turns the data into an answer"""
+    messages = messages + [{"role": "user", "content": data_summary}]
+
+    # Limit the conversation history if necessary
+    if len(messages) > MAX_HISTORY_LENGTH:
+        messages = messages[-MAX_HISTORY_LENGTH:]
+    return messages
+
+
+# Report cache configurations
+class ReportCacheConfig:
+    MAX_BYTES = int(os.getenv('REPORTS_MAX_BYTES', 1024 ** 3))  # Size cap for the reports directory
+    MAX_AGE = int(os.getenv('REPORTS_MAX_AGE', 7 * 24 * 60 * 60))  # Evict reports unused for this long (seconds)
+    SWEEP_INTERVAL = int(os.getenv('REPORTS_SWEEP_INTERVAL', 60))  # Minimum seconds between sweeps per worker
+    TMP_MAX_AGE = 60 * 60  # Partial files older than this belong to a crashed writer
+
+
+# Tables each selection export reads, for its data version
+REPORT_DEPENDENCIES = {
+    'projects': ['projects'],
+    'invoices': ['invoices', 'projects'],
+    'elements': ['elements', 'invoices', 'subelements'],
+}
+
+
+def data_version(conn, tables=None):
+    """Version stamp for the given tables (all tables when None), bumped by triggers on every write"""
+    with conn.cursor() as cur:
+        if tables is None:
+            cur.execute("SELECT table_name, version FROM data_versions ORDER BY table_name")
+        else:
+            cur.execute(
+                "SELECT table_name, version FROM data_versions WHERE table_name = ANY(%s) ORDER BY table_name",
+                (list(tables),)
+            )
+        return ','.join(f'{name}:{version}' for name, version in cur.fetchall())
+
+
+def report_cache_key(*parts):
+    """Content address for a report: a hash of everything that determines its bytes"""
+    return hashlib.sha256(json.dumps(parts, default=str).encode('utf-8')).hexdigest()[:32]
+
+
+def selection_report_filename(entity_type, selected_ids, export_format):
+    with db_connection() as conn:
+        version = data_version(conn, REPORT_DEPENDENCIES[entity_type])
+    selection = sorted({str(selected_id) for selected_id in selected_ids})
+    key = report_cache_key('selection', entity_type, selection, export_format, version)
+    return f"{entity_type}_report_{key}.{export_format}"
+
+
+def lookup_cached_report(filename):
+    """Return the path of an existing report, marking it recently used for the sweeper, or None"""
+    filepath = os.path.join(REPORTS_DIR, filename)
+    try:
+        os.utime(filepath)
+    except FileNotFoundError:
+        return None
+    return filepath
+
+
+REPORT_TMP_PREFIX = '.tmp-'
+
+
+def report_tmp_path(filepath):
+    """Unique partial-file path (keeping the extension); reports are renamed into place only once complete"""
+    directory, filename = os.path.split(filepath)
+    return os.path.join(directory, f"{REPORT_TMP_PREFIX}{secrets.token_hex(4)}-{filename}")
+
+
+def publish_report(tmp_path, filepath):
+    os.replace(tmp_path, filepath)
+    report_sweeper.maybe_sweep()
+
+
+def discard_report(tmp_path):
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def cache_report_stream(chunks, filepath):
+    """Pass a streamed export through while saving it; the copy is published only if the stream completes"""
+    tmp_path = report_tmp_path(filepath)
+    try:
+        with open(tmp_path, 'wb') as out:
+            for chunk in chunks:
+                out.write(chunk)
+                yield chunk
+    except BaseException:
+        discard_report(tmp_path)
+        raise
+    publish_report(tmp_path, filepath)
+
+
+class ReportSweeper:
+    """Evicts reports by age, then least recently used first until the directory fits its size cap"""
+
+    def __init__(self, directory, max_bytes, max_age, interval):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._counters = defaultdict(int)
+
+    def maybe_sweep(self):
+        """Sweep unless this worker already did so within the interval"""
+        now = time.monotonic()
+        with self._lock:
+            if self._last_sweep and now - self._last_sweep < self.interval:
+                return
+            self._last_sweep = now
+        try:
+            self.sweep()
+        except OSError as e:
+            print(f"Error sweeping reports: {str(e)}")
+
+    def sweep(self):
+        now = time.time()
+        reports = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue  # The jobs directory manages itself
+            try:
+                entry_stat = entry.stat()
+                if entry.name.startswith(REPORT_TMP_PREFIX):
+                    if now - entry_stat.st_mtime > ReportCacheConfig.TMP_MAX_AGE:
+                        os.remove(entry.path)
+                    continue
+                if now - entry_stat.st_mtime > self.max_age:
+                    os.remove(entry.path)
+                    self._counters['expired'] += 1
+                    continue
+            except FileNotFoundError:
+                continue  # Removed by another worker
+            reports.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+
+        # Lookups touch the mtime, so oldest mtime is least recently used
+        total = sum(size for _, size, _ in reports)
+        for _, size, path in sorted(reports):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._counters['evicted'] += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._counters['sweeps'] += 1
+        self._counters['bytes'] = total
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, max_bytes=self.max_bytes, max_age=self.max_age)
+
+
+report_sweeper = ReportSweeper(
+    REPORTS_DIR, ReportCacheConfig.MAX_BYTES, ReportCacheConfig.MAX_AGE, ReportCacheConfig.SWEEP_INTERVAL
+)
+
+
+def write_excel_report(df, prefix, filename=None):
+    """Write a DataFrame to an Excel file in REPORTS_DIR and return its download URL"""
+    # Generate timestamp and filename unless the caller passed a cache filename
+    if filename is None:
+        timestamp = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"{prefix}_{timestamp}_{secrets.token_hex(4)}.xlsx"
+    filepath = os.path.join(REPORTS_DIR, filename)
+
+    # Ensure directory exists
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    # Save Excel file
+    tmp_path = report_tmp_path(filepath)
+    try:
+        with pd.ExcelWriter(tmp_path, engine='xlsxwriter') as writer:
+            df.to_excel(writer, index=False, sheet_name='Report')
+            workbook = writer.book
+            worksheet = writer.sheets['Report']
+            header_format = workbook.add_format({'bold': True, 'bg_color': '#D3D3D3'})
+            for col_num, value in enumerate(df.columns.values):
+                worksheet.write(0, col_num, value, header_format)
+    except BaseException:
+        discard_report(tmp_path)
+        raise
+    publish_report(tmp_path, filepath)
+
+    # Return the download URL using the same pattern as downloadSelected
+    return f'/api/download/{filename}'
+
+
+# Reports cut off at their row cap are published under a marked name, so cache hits still know
+PARTIAL_REPORT_MARKER = '_partial'
+
+
+def report_truncated(filename):
+    return PARTIAL_REPORT_MARKER in os.path.splitext(filename)[0]
+
+
+def generate_chat_report(sql_query, progress=None, report_type='excel'):
+    """Write the results of a report query to REPORTS_DIR, capped at CHAT_REPORT_MAX_ROWS.
+
+    Returns (download URL, truncated).
+    """
+    # Identical queries against unchanged data reuse the existing file
+    extension = report_type if report_type in ('csv', 'parquet') else 'xlsx'
+    with db_connection() as conn:
+        version = data_version(conn)
+    key = report_cache_key(
+        'chat', validate_generated_sql(sql_query), extension, SqlGuardConfig.REPORT_MAX_ROWS, version
+    )
+    filenames = {
+        False: f"chat_report_{key}.{extension}",
+        True: f"chat_report_{key}{PARTIAL_REPORT_MARKER}.{extension}"
+    }
+    for truncated, filename in filenames.items():
+        if lookup_cached_report(filename):
+            return f'/api/download/{filename}', truncated
+
+    if extension != 'xlsx':
+        # Stream straight from the guarded transaction to the file, without a DataFrame
+        tmp_path = report_tmp_path(os.path.join(REPORTS_DIR, filenames[False]))
+        try:
+            with guarded_connection(sql_query, report=True) as (conn, statement), open(tmp_path, 'wb') as out:
+                rows_written = write_flat_export(
+                    conn, report_type, statement, None, out, progress, SqlGuardConfig.REPORT_MAX_ROWS
+                )
+        except BaseException:
+            discard_report(tmp_path)
+            raise
+        # The export stops at the cap, so a full cap is reported as (possibly) cut off
+        truncated = rows_written >= SqlGuardConfig.REPORT_MAX_ROWS
+        publish_report(tmp_path, os.path.join(REPORTS_DIR, filenames[truncated]))
+        return f'/api/download/{filenames[truncated]}', truncated
+
+    # Execute query and get data
+    columns, data, truncated = run_chat_query(sql_query, SqlGuardConfig.REPORT_MAX_ROWS, report=True)
+    if progress:
+        progress(0, len(data))
+    report_url = write_excel_report(pd.DataFrame(data, columns=columns), 'chat_report', filenames[truncated])
+    if progress:
+        progress(len(data))
+    return report_url, truncated
+
+
+REPORT_QUEUED_REPLY = "Your report is being generated. The download button will appear when it is ready."
+
+
+# API Endpoint for chat
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    user_message = request.json.get('message')
+    print(f"Received message from user: {user_message}")
+
+    conversation_history, messages, schema_fingerprint = start_chat_turn(user_message)
+
+    try:
+        interpretation = interpret_user_request(messages, conversation_history, schema_fingerprint)
+
+        print(f"Interpretation: {interpretation}")
+
+        # Extract information from the interpretation
+        action = interpretation.get('action', None)  # 'action' is required, but None if missing for safety
+        sql_query = interpretation.get('sql_query', None)  # Default to None if not present
+        report_type = interpretation.get('report_type', 'excel')  # Default to 'excel'
+        assistant_message = interpretation.get('message', "")  # Default to empty string
+
+        if action == 'query_data':
+            if not sql_query:
+                return jsonify({'reply': "Error: No SQL query provided.", 'format': 'markdown'}), 400
+
+            # Execute the query and fetch data through the guarded executor
+            try:
+                columns, rows, truncated = run_chat_query(sql_query)
+            except UnsafeQueryError as e:
+                return jsonify({'reply': f"Error: {e}", 'format': 'markdown'}), 400
+            data_summary, report_job = build_data_summary(columns, rows, truncated, sql_query, report_job_owner())
+
+            # Call OpenAI again to generate the final natural language response
+            final_response = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=build_answer_messages(messages, data_summary)
+            )
+
+            # Retrieve the final response content
+            if final_response.choices and final_response.choices[0].message.content:
+                final_content = final_response.choices[0].message.content.strip()
+                # Append assistant's response to conversation history
+                conversation_history.append({"role": "assistant", "content": final_content})
+                session['conversation_history'] = conversation_history
+                response = {'reply': final_content, 'format': 'markdown'}
+                if report_job:
+                    response.update(job_id=report_job['id'], job_url=report_job_status(report_job)['status_url'])
+                return jsonify(response)
+            else:
+                return jsonify({'reply': "Error: No content in final response.", 'format': 'markdown'}), 500
+        
+        elif action == 'generate_report':
+            try:
+                # Build the workbook in the report job queue instead of this request thread
+                job = enqueue_chat_report(sql_query, report_job_owner(), report_type)
+
+                return jsonify({
+                    'reply': REPORT_QUEUED_REPLY,
+                    'format': 'markdown',
+                    'job_id': job['id'],
+                    'job_url': report_job_status(job)['status_url']
+                })
+
+            except UnsafeQueryError as e:
+                return jsonify({'reply': f"Error: {e}", 'format': 'markdown'}), 400
+            except ReportJobAuthError as e:
+                return jsonify({'reply': f"Error: {e}", 'format': 'markdown'}), 401
+            except ReportJobLimitError as e:
+                return jsonify({'reply': f"Error: {e}", 'format': 'markdown'}), 429
+            except Exception as e:
+                print(f"Error generating report: {str(e)}")
+                return jsonify({
+                    'reply': f"Error generating report: {str(e)}", 
+                    'format': 'markdown'
+                }), 500
+                
+        elif action in ['instruct_user', 'conversation']:
+            if not assistant_message:
+                return jsonify({'reply': "Error: No message provided by assistant.", 'format': 'markdown'}), 400
+
+            # Append assistant's response to conversation history
+            conversation_history.append({"role": "assistant", "content": assistant_message})
+            session['conversation_history'] = conversation_history
+
+            return jsonify({'reply': assistant_message, 'format': 'markdown'})
+
+        else:
+            return jsonify({'reply': f"Error: Unrecognized action '{action}'.", 'format': 'markdown'}), 400
+
+    except Exception as e:
+        print(f"Error in chat function: {e}")
+        return jsonify({'reply': "An error occurred during processing. Please try again.", 'format': 'markdown'}), 500
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+# Streaming variant of the chat endpoint (Server-Sent Events)
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    user_message = request.json.get('message')
+    print(f"Received streaming message from user: {user_message}")
+
+    conversation_history, messages, schema_fingerprint = start_chat_turn(user_message)
+    owner = report_job_owner()
+    # Save the user turn now so the session cookie is sent with the stream headers
+    session['conversation_history'] = conversation_history
+
+    def generate():
+        try:
+            yield sse_event('phase', {'phase': 'interpreting'})
+            interpretation = interpret_user_request(messages, conversation_history, schema_fingerprint)
+            print(f"Interpretation: {interpretation}")
+
+            action = interpretation.get('action', None)
+            sql_query = interpretation.get('sql_query', None)
+            report_type = interpretation.get('report_type', 'excel')
+            assistant_message = interpretation.get('message', "")
+            done = {'format': 'markdown'}
+
+            if action == 'query_data':
+                if not sql_query:
+                    yield sse_event('error', {'reply': "Error: No SQL query provided.", 'format': 'markdown'})
+                    return
+
+                yield sse_event('phase', {'phase': 'querying'})
+                columns, rows, truncated = run_chat_query(sql_query)
+                yield sse_event('rows', {'count': len(rows), 'truncated': truncated})
+
+                data_summary, report_job = build_data_summary(columns, rows, truncated, sql_query, owner)
+                if report_job:
+                    done.update(job_id=report_job['id'], job_url=report_job_status(report_job)['status_url'])
+                    yield sse_event('job', {'job_id': done['job_id'], 'job_url': done['job_url']})
+
+                yield sse_event('phase', {'phase': 'answering'})
+                stream = client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=build_answer_messages(messages, data_summary),
+                    stream=True
+                )
+                parts = []
+                for chunk in stream:
+                    token = chunk.choices[0].delta.content if chunk.choices else None
+                    if token:
+                        parts.append(token)
+                        yield sse_event('token', {'text': token})
+                reply = ''.join(parts).strip()
+                if not reply:
+                    yield sse_event('error', {'reply': "Error: No content in final response.", 'format': 'markdown'})
+                    return
+
+            elif action == 'generate_report':
+                job = enqueue_chat_report(sql_query, owner, report_type)
+                done.update(job_id=job['id'], job_url=report_job_status(job)['status_url'])
+                yield sse_event('job', {'job_id': done['job_id'], 'job_url': done['job_url']})
+                reply = REPORT_QUEUED_REPLY
+                yield sse_event('token', {'text': reply})
+
+            elif action in ['instruct_user', 'conversation']:
+                if not assistant_message:
+                    yield sse_event('error', {'reply': "Error: No message provided by assistant.", 'format': 'markdown'})
+                    return
+                reply = assistant_message
+                yield sse_event('token', {'text': reply})
+
+            else:
+                yield sse_event('error', {'reply': f"Error: Unrecognized action '{action}'.", 'format': 'markdown'})
+                return
+
+            # The response headers are long gone, so write the session store directly
+            conversation_history.append({"role": "assistant", "content": reply})
+            session['conversation_history'] = conversation_history
+            app.session_interface.save_session(app, session, Response())
+
+            done['reply'] = reply
+            yield sse_event('done', done)
+
+        except (UnsafeQueryError, ReportJobLimitError, ReportJobAuthError) as e:
+            yield sse_event('error', {'reply': f"Error: {e}", 'format': 'markdown'})
+        except Exception as e:
+            print(f"Error in chat stream: {e}")
+            yield sse_event('error', {
+                'reply': "An error occurred during processing. Please try again.",
+                'format': 'markdown'
+            })
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Let nginx pass events through unbuffered
+        }
+    )
+
+# Download configurations
+class DownloadConfig:
+    # Set to an nginx `internal` location aliased to REPORTS_DIR (e.g. /protected-reports/) to let nginx
+    # send the file bytes; nginx then handles Range and conditional requests itself
+    ACCEL_REDIRECT_PREFIX = os.getenv('REPORTS_ACCEL_REDIRECT_PREFIX')
+
+
+REPORT_FILENAME_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9_.-]*')
+
+
+def report_mimetype(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return EXPORT_MIMETYPES.get(extension) or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def send_report(filename, download_name=None):
+    """Serve a file from REPORTS_DIR with ETag and Range support, or offload it to nginx.
+
+    Looks the file up with a single stat, never a directory listing. Reports are written to
+    a temporary file and renamed into place, so new content always means a new inode; the
+    ETag comes from the inode and size rather than the mtime or ctime, which the report
+    cache's touch on every hit would change.
+    """
+    if not REPORT_FILENAME_PATTERN.fullmatch(filename):
+        return jsonify({'error': 'File not found'}), 404
+    filepath = os.path.join(REPORTS_DIR, filename)
+    try:
+        file_stat = os.stat(filepath)
+    except FileNotFoundError:
+        return jsonify({'error': 'File not found'}), 404
+    if not stat.S_ISREG(file_stat.st_mode):
+        return jsonify({'error': 'File not found'}), 404
+
+    download_name = download_name or filename
+    mimetype = report_mimetype(filename)
+
+    if DownloadConfig.ACCEL_REDIRECT_PREFIX:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = DownloadConfig.ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(filename)
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        return response
+
+    response = send_file(
+        filepath,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name,
+        conditional=True,
+        etag=hashlib.sha256(
+            f"{filename}:{file_stat.st_dev}:{file_stat.st_ino}:{file_stat.st_size}".encode('utf-8')
+        ).hexdigest()[:32]
+    )
+    # Advertise resumable downloads on full responses too
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+# Update the download endpoint
+@app.route('/api/download/<path:filename>', methods=['GET'])
+def download_file(filename):
+    try:
+        print(f"Download request received for file: {filename}")
+        return send_report(os.path.basename(filename))
+    except Exception as e:
+        print(f"Error in download_file: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+        
+@app.route('/api/test-download', methods=['GET'])
+def test_download():
+    try:
+        print("\n=== Test Download ===")
+        # Create a test Excel file
+        test_df = pd.DataFrame({'test': ['data1', 'data2'], 'column2': ['value1', 'value2']})
+        test_file = os.path.join(REPORTS_DIR, 'test.xlsx')
+        
+        # Ensure directory exists
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        
+        print(f"Creating test file at: {test_file}")
+        
+        # Write test file
+        with pd.ExcelWriter(test_file, engine='xlsxwriter') as writer:
+            test_df.to_excel(writer, index=False, sheet_name='Test')
+            workbook = writer.book
+            worksheet = writer.sheets['Test']
+            header_format = workbook.add_format({'bold': True, 'bg_color': '#D3D3D3'})
+            for col_num, value in enumerate(test_df.columns.values):
+                worksheet.write(0, col_num, value, header_format)
+            
+        # Set permissions
+        os.chmod(test_file, 0o666)
+        
+        print(f"Test file created successfully")
+        print(f"File exists: {os.path.exists(test_file)}")
+        print(f"File size: {os.path.getsize(test_file)} bytes")
+        print(f"File permissions: {oct(os.stat(test_file).st_mode)[-3:]}")
+        print(f"Directory contents: {os.listdir(REPORTS_DIR)}")
+        
+        return jsonify({
+            'message': 'Test file created successfully',
+            'download_url': '/api/download/test.xlsx'
+        })
+    except Exception as e:
+        print(f"Test download error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    
+def build_invoices_query(args, project_name=None):
+    """Build the invoices query and its params from the grid filter arguments"""
+    # Build base query
+    query = """
+        SELECT
+            id,
+            file_name,
+            folder_type,
+            project_name
+        FROM invoices
+    """
+    params = []
+
+    # Start WHERE clause
+    if project_name:
+        query += " WHERE project_name = %s"
+        params.append(project_name)
+    else:
+        query += " WHERE 1=1"
+
+    # Get folder type filters
+    folder_type_adicionals = args.get('folderTypeFilters[adicionals]') == 'true'
+    folder_type_pressupost = args.get('folderTypeFilters[pressupost]') == 'true'
+
+    # Apply folder type filters if either checkbox is checked
+    if folder_type_adicionals or folder_type_pressupost:
+        filter_values = []
+        if folder_type_adicionals:
+            filter_values.append('Adicionals')
+        if folder_type_pressupost:
+            filter_values.append('Pressupost contracte')
+        if filter_values:
+            placeholders = ', '.join(['%s'] * len(filter_values))
+            query += f" AND folder_type IN ({placeholders})"
+            params.extend(filter_values)
+
+    # Apply additional filters
+    start_date = args.get('startDate')
+    if start_date:
+        query += " AND date >= %s"
+        params.append(start_date)
+
+    end_date = args.get('endDate')
+    if end_date:
+        query += " AND date <= %s"
+        params.append(end_date)
+
+    file_name_keyword = args.get('FileNameKeyword')
+    if file_name_keyword:
+        query += " AND file_name ILIKE %s"
+        params.append(f'%{file_name_keyword}%')
+
+    return query, params
+
+
+@app.route('/api/invoices', methods=['GET'])
+@app.route('/api/invoices/<project_name>', methods=['GET'])
+@versioned('invoices')
+@read_cached('invoices', ('invoices',), PAGE_PARAMS + INVOICE_FILTER_PARAMS, FOLDER_TYPE_FLAGS)
+def get_invoices(project_name=None):
+    print("=== GET Invoices Request ===")
+    try:
+        # Debug logging
+        print("Received request args:", request.args)
+        print("Folder type filters:", {
+            'adicionals': request.args.get('folderTypeFilters[adicionals]'),
+            'pressupost': request.args.get('folderTypeFilters[pressupost]')
+        })
+
+        query, params = build_invoices_query(request.args, project_name)
+
+        response_format = get_response_format(request.args)
+        page = parse_page_args(request.args, INVOICE_SORTS, 'id')
+        if page:
+            query, params = apply_keyset(query, params, page, INVOICE_SORTS, 'id')
+
+        print(f"Query: {query}")
+        print(f"Params: {params}")
+
+        # Execute query
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            invoices = cur.fetchall()
+        print(f"Found {len(invoices)} invoices")
+
+        # Get column names from cursor description
+        columns = ['id', 'file_name', 'folder_type', 'project_name']
+        
+        if page:
+            return jsonify(build_page(invoices, columns, page, 'id', response_format))
+
+        return jsonify(shape_rows(columns, invoices, response_format))
+
+    except (PaginationError, ResponseFormatError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error in get_invoices: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+SUBELEMENTS_QUERY = "SELECT * FROM subelements WHERE element_id = %s;"
+SUBELEMENTS_FIELDS_QUERY = "SELECT {columns} FROM subelements WHERE element_id = %s;"
+
+# API Endpoint to get subelements by element ID
+@app.route('/api/subelements/<element_id>', methods=['GET'])
+@versioned('subelements')
+def get_subelements(element_id):
+    try:
+        response_format = get_response_format(request.args)
+        fields = parse_fields(request.args, SUBELEMENT_FIELDS)
+    except (ResponseFormatError, FieldSelectionError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    query = SUBELEMENTS_QUERY
+    if fields:
+        query = SUBELEMENTS_FIELDS_QUERY.format(columns=select_list(fields, SUBELEMENT_FIELDS))
+
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(query, (element_id,))
+        subelements = cur.fetchall()
+        columns = [desc[0] for desc in cur.description]
+    return jsonify(shape_rows(columns, subelements, response_format))
+
+# Batch subelements configurations
+class SubelementBatchConfig:
+    MAX_IDS = int(os.getenv('SUBELEMENTS_BATCH_MAX_IDS', 1000))  # Element ids per batch request
+
+
+SUBELEMENTS_BATCH_QUERY = (
+    "SELECT {columns} FROM subelements WHERE element_id = ANY(%s::integer[]) ORDER BY element_id, id;"
+)
+
+
+def parse_element_ids(values):
+    """Return the distinct element ids of a batch request, sorted, or raise ValueError"""
+    if not isinstance(values, list):
+        raise ValueError('elementIds must be a list of element ids')
+    try:
+        element_ids = sorted({int(value) for value in values})
+    except (TypeError, ValueError):
+        raise ValueError('elementIds must be integers')
+    if not element_ids:
+        raise ValueError('elementIds must not be empty')
+    if len(element_ids) > SubelementBatchConfig.MAX_IDS:
+        raise ValueError(f'At most {SubelementBatchConfig.MAX_IDS} elementIds per request')
+    return element_ids
+
+
+# API Endpoint to get the subelements of many elements in one round trip, grouped by element_id.
+# GET takes ?elementIds=1,2,3; POST takes {"elementIds": [...]} for lists too long for a URL.
+@app.route('/api/subelements/batch', methods=['GET', 'POST'])
+@versioned('subelements')
+def get_subelements_batch():
+    try:
+        if request.method == 'POST':
+            values = (request.get_json(silent=True) or {}).get('elementIds')
+        else:
+            values = [value for value in request.args.get('elementIds', '').split(',') if value.strip()]
+        element_ids = parse_element_ids(values)
+        response_format = get_response_format(request.args)
+        fields = parse_fields(request.args, SUBELEMENT_FIELDS, ['element_id'])
+    except (ValueError, ResponseFormatError, FieldSelectionError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    query = SUBELEMENTS_BATCH_QUERY.format(columns=select_list(fields or list(SUBELEMENT_FIELDS), SUBELEMENT_FIELDS))
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(query, (element_ids,))
+        rows = cur.fetchall()
+        columns = [desc[0] for desc in cur.description]
+
+    # Rows arrive ordered by element_id, one pass groups them; every requested id gets a key
+    grouped = {element_id: [] for element_id in element_ids}
+    element_index = columns.index('element_id')
+    for row in rows:
+        grouped[row[element_index]].append(row)
+    return jsonify({
+        str(element_id): shape_rows(columns, element_rows, response_format)
+        for element_id, element_rows in grouped.items()
+    })
+
+
+def build_elements_query(args, project_name=None, fields=None):
+    """Build the elements query and its params from the grid filter arguments, optionally
+    selecting only the given ELEMENT_FIELDS"""
+    # Get filters from query parameters
+    nameKeyword = args.get('nameKeyword')
+    invoiceNameKeyword = args.get('invoiceNameKeyword')
+    invoiceid = args.get('invoiceid')
+    min_price = args.get('minPrice')
+    max_price = args.get('maxPrice')
+    quantity = args.get('quantity')
+
+    # Base query with JOIN to get invoice information; has_subelements,
+    # subelement_count and subelements_total are precomputed columns of elements.
+    # Columns are listed rather than elements.* so search_vector is never sent.
+    query = f"""
+        SELECT {select_list(fields or list(ELEMENT_FIELDS), ELEMENT_FIELDS)}
+        FROM elements
+        LEFT JOIN invoices ON elements.invoice_id = invoices.id
+    """
+
+    params = []
+
+    # Start WHERE clause
+    if project_name:
+        query += " WHERE invoices.project_name = %s"
+        params.append(project_name)
+    else:
+        query += " WHERE 1=1"  # This ensures we can always add AND conditions
+
+    # Get folder type filters
+    folder_type_adicionals = args.get('folderTypeFilters[adicionals]') == 'true'
+    folder_type_pressupost = args.get('folderTypeFilters[pressupost]') == 'true'
+
+    # Apply folder type filter if either checkbox is checked
+    if folder_type_adicionals or folder_type_pressupost:
+        filter_values = []
+        if folder_type_adicionals:
+            filter_values.append('Adicionals')
+        if folder_type_pressupost:
+            filter_values.append('Pressupost contracte')
+        if filter_values:
+            query += " AND invoices.folder_type IN %s"  # Changed from IN ({placeholders})
+            params.append(tuple(filter_values))  # Keep as tuple
+
+    # Apply additional filters
+    if nameKeyword:
+        query += " AND elements.name ILIKE %s"
+        params.append(f'%{nameKeyword}%')
+    if invoiceNameKeyword:
+        query += " AND invoices.file_name ILIKE %s"
+        params.append(f'%{invoiceNameKeyword}%')
+    if invoiceid:
+        query += " AND elements.invoice_id = %s"
+        params.append(invoiceid)
+    if min_price:
+        query += " AND elements.price_per_unit >= %s"
+        params.append(min_price)
+    if max_price:
+        query += " AND elements.price_per_unit <= %s"
+        params.append(max_price)
+    if quantity:
+        query += " AND elements.quantity = %s"
+        params.append(quantity)
+
+    return query, params
+
+
+# Streaming configurations
+class StreamConfig:
+    DEFAULT_ITERSIZE = int(os.getenv('STREAM_ITERSIZE', 2000))  # Rows fetched per server-side round trip
+    MAX_ITERSIZE = int(os.getenv('STREAM_MAX_ITERSIZE', 20000))
+
+
+def get_itersize(args):
+    """Read a client-tunable itersize, clamped to the configured bounds"""
+    try:
+        itersize = int(args.get('itersize', StreamConfig.DEFAULT_ITERSIZE))
+    except (TypeError, ValueError):
+        itersize = StreamConfig.DEFAULT_ITERSIZE
+    return max(1, min(itersize, StreamConfig.MAX_ITERSIZE))
+
+
+def stream_json_array(query, params, itersize):
+    """Yield a JSON array from a named (server-side) cursor, one batch of rows at a time"""
+    with db_connection() as conn:
+        with conn.cursor(name=f'stream_{secrets.token_hex(8)}') as cur:
+            cur.itersize = itersize
+            cur.execute(query, params)
+            yield '['
+            columns = None
+            separator = ''
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                if columns is None:
+                    columns = [desc[0] for desc in cur.description]
+                chunk = ','.join(app.json.dumps(dict(zip(columns, row))) for row in rows)
+                yield separator + chunk
+                separator = ','
+            yield ']'
+
+
+# API Endpoint to get all elements or elements by project name
+@app.route('/api/elements', methods=['GET'])
+@app.route('/api/elements/<project_name>', methods=['GET'])
+@versioned('elements', 'invoices')
+def get_elements(project_name=None):
+    print("Received request args:", request.args)
+    print("Folder type filters:", {
+        'adicionals': request.args.get('folderTypeFilters[adicionals]'),
+        'pressupost': request.args.get('folderTypeFilters[pressupost]')
+    })
+
+    try:
+        response_format = get_response_format(request.args)
+        page = parse_page_args(request.args, ELEMENT_SORTS, 'id')
+        fields = parse_fields(request.args, ELEMENT_FIELDS, ['id', page['sort']] if page else ())
+    except (ResponseFormatError, PaginationError, FieldSelectionError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    query, params = build_elements_query(request.args, project_name, fields)
+
+    # Streaming mode keeps worker memory flat regardless of the result size
+    if request.args.get('stream') == 'true':
+        if response_format != 'objects':
+            return jsonify({'error': 'stream=true only supports the objects format'}), 400
+        return Response(
+            stream_json_array(query, params, get_itersize(request.args)),
+            mimetype='application/json'
+        )
+
+    if page:
+        query, params = apply_keyset(query, params, page, ELEMENT_SORTS, 'elements.id')
+
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(query, params)
+        elements = cur.fetchall()
+        columns = [desc[0] for desc in cur.description]
+
+    if page:
+        return jsonify(build_page(elements, columns, page, 'id', response_format))
+    return jsonify(shape_rows(columns, elements, response_format))
+
+# Project tree configurations
+class ProjectTreeConfig:
+    MAX_NODES = int(os.getenv('PROJECT_TREE_MAX_NODES', 50000))  # Elements + subelements per response
+
+
+INVOICE_FIELDS = {
+    'id': 'id',
+    'file_name': 'file_name',
+    'folder_type': 'folder_type',
+    'project_name': 'project_name'
+}
+PROJECT_TREE_DEPTHS = ('project', 'invoices', 'elements', 'subelements')
+PROJECT_TREE_INVOICES_QUERY = "SELECT {columns} FROM invoices WHERE project_name = %s ORDER BY id"
+
+
+class ProjectTreeError(ValueError):
+    """Raised for a bad depth or field selection on the project tree"""
+
+
+def parse_tree_depth(args):
+    depth = args.get('depth', PROJECT_TREE_DEPTHS[-1])
+    if depth not in PROJECT_TREE_DEPTHS:
+        raise ProjectTreeError(f"depth must be one of: {', '.join(PROJECT_TREE_DEPTHS)}")
+    return PROJECT_TREE_DEPTHS.index(depth)
+
+
+def fetch_dicts(cur, query, params):
+    cur.execute(query, params)
+    columns = [desc[0] for desc in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def project_tree_too_large(max_nodes):
+    return jsonify({
+        'error': f'Project tree has more than {max_nodes} elements and subelements; '
+                 'request a smaller depth or page through /api/elements'
+    }), 413
+
+
+# API Endpoint for a project's nested invoices -> elements -> subelements in one round trip.
+# One query per level, whatever the size of the tree; children are attached through id dicts.
+@app.route('/api/projects/<project_name>/tree', methods=['GET'])
+@versioned('projects', 'invoices', 'elements', 'subelements')
+def get_project_tree(project_name):
+    try:
+        depth = parse_tree_depth(request.args)
+        # Keys the stitching needs are always selected
+        invoice_fields = parse_fields(request.args, INVOICE_FIELDS, ['id'], 'fields[invoices]')
+        element_fields = parse_fields(request.args, ELEMENT_FIELDS, ['id', 'invoice_id'], 'fields[elements]')
+        subelement_fields = parse_fields(request.args, SUBELEMENT_FIELDS, ['element_id'], 'fields[subelements]')
+    except (ProjectTreeError, FieldSelectionError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    max_nodes = ProjectTreeConfig.MAX_NODES
+    with db_connection() as conn, conn.cursor() as cur:
+        # Every level is read from the same snapshot
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        projects = fetch_dicts(cur, PROJECTS_QUERY + " AND name = %s", [project_name])
+        if not projects:
+            return jsonify({'error': 'Project not found'}), 404
+        project = projects[0]
+        counts = {}
+
+        if depth >= 1:
+            columns = select_list(invoice_fields or list(INVOICE_FIELDS), INVOICE_FIELDS)
+            invoices = fetch_dicts(cur, PROJECT_TREE_INVOICES_QUERY.format(columns=columns), [project_name])
+            project['invoices'] = invoices
+            counts['invoices'] = len(invoices)
+
+        if depth >= 2:
+            query, params = build_elements_query({}, project_name, element_fields)
+            query += " ORDER BY elements.invoice_id, elements.id LIMIT %s"
+            elements = fetch_dicts(cur, query, params + [max_nodes + 1])
+            if len(elements) > max_nodes:
+                return project_tree_too_large(max_nodes)
+            invoices_by_id = {invoice['id']: invoice for invoice in invoices}
+            for invoice in invoices:
+                invoice['elements'] = []
+            for element in elements:
+                invoices_by_id[element['invoice_id']]['elements'].append(element)
+            counts['elements'] = len(elements)
+
+        if depth >= 3:
+            elements_by_id = {element['id']: element for element in elements}
+            for element in elements:
+                element['subelements'] = []
+            if elements:
+                columns = select_list(subelement_fields or list(SUBELEMENT_FIELDS), SUBELEMENT_FIELDS)
+                query = SUBELEMENTS_BATCH_QUERY.format(columns=columns).rstrip(';') + " LIMIT %s"
+                subelements = fetch_dicts(cur, query, [list(elements_by_id), max_nodes - len(elements) + 1])
+                if len(elements) + len(subelements) > max_nodes:
+                    return project_tree_too_large(max_nodes)
+            else:
+                subelements = []
+            for subelement in subelements:
+                elements_by_id[subelement['element_id']]['subelements'].append(subelement)
+            counts['subelements'] = len(subelements)
+
+    project['counts'] = counts
+    return jsonify(project)
+
+
+# Search configurations
+class SearchConfig:
+    DEFAULT_LIMIT = int(os.getenv('SEARCH_DEFAULT_LIMIT', 50))  # Page size when no limit is given
+    MAX_QUERY_LENGTH = 200
+    # Short fields are highlighted whole, descriptions as fragments around the matches
+    HIGHLIGHT_ALL = 'HighlightAll=true, StartSel=<mark>, StopSel=</mark>'
+    HIGHLIGHT_FRAGMENTS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=25, MinWords=8, MaxFragments=2'
+
+
+SEARCH_SORTS = {'rank': 'rank'}
+
+
+class SearchError(ValueError):
+    """Raised for a missing or oversized search query"""
+
+
+def build_search_query(text, project_name, page):
+    """Build the ranked element search for a websearch-style query, one keyset page at a time"""
+    params = [text, text]
+    filters = ''
+    if project_name:
+        filters = " AND i.project_name = %s"
+        params.append(project_name)
+
+    # Ranks come back exactly as computed before, so (rank, id) works as a descending keyset;
+    # ts_rank_cd returns real, so the cursor's rank is compared as real too
+    keyset = ''
+    if page['after'] is not None:
+        rank, row_id = page['after']
+        keyset = "WHERE rank < %s::real OR (rank = %s::real AND id > %s)"
+        params.extend([rank, rank, row_id])
+    params.append(page['limit'] + 1)
+
+    # Highlights are only built for the rows of the page
+    query = f"""
+        WITH search AS (
+            SELECT websearch_to_tsquery('es_unaccent', %s) || websearch_to_tsquery('ca_unaccent', %s) AS query
+        ),
+        ranked AS (
+            SELECT e.id, ts_rank_cd(e.search_vector, search.query) AS rank
+            FROM elements e
+            LEFT JOIN invoices i ON i.id = e.invoice_id
+            CROSS JOIN search
+            WHERE e.search_vector @@ search.query{filters}
+        ),
+        page AS (
+            SELECT id, rank FROM ranked {keyset}
+            ORDER BY rank DESC, id
+            LIMIT %s
+        )
+        SELECT
+            e.id,
+            e.invoice_id,
+            e.name,
+            e.chapter_code,
+            e.chapter_title,
+            e.total_price,
+            i.file_name AS invoice_name,
+            i.folder_type,
+            i.project_name,
+            page.rank,
+            ts_headline('es_unaccent', COALESCE(e.name, ''), search.query, '{SearchConfig.HIGHLIGHT_ALL}') AS name_highlight,
+            ts_headline('es_unaccent', COALESCE(e.chapter_title, ''), search.query, '{SearchConfig.HIGHLIGHT_ALL}') AS chapter_title_highlight,
+            ts_headline('es_unaccent', COALESCE(e.description, ''), search.query, '{SearchConfig.HIGHLIGHT_FRAGMENTS}') AS description_highlight,
+            ts_headline('es_unaccent', search_file_name(i.file_name), search.query, '{SearchConfig.HIGHLIGHT_ALL}') AS invoice_name_highlight
+        FROM page
+        JOIN elements e ON e.id = page.id
+        LEFT JOIN invoices i ON i.id = e.invoice_id
+        CROSS JOIN search
+        ORDER BY page.rank DESC, e.id
+    """
+    return query, params
+
+
+def parse_search_args(args):
+    """Return the search text and keyset page from the request arguments"""
+    text = (args.get('q') or '').strip()
+    if not text:
+        raise SearchError('q is required')
+    if len(text) > SearchConfig.MAX_QUERY_LENGTH:
+        raise SearchError(f'q must be at most {SearchConfig.MAX_QUERY_LENGTH} characters')
+    page = parse_page_args(args, SEARCH_SORTS, 'rank') or {
+        'limit': SearchConfig.DEFAULT_LIMIT,
+        'sort': 'rank',
+        'after': None
+    }
+    return text, page
+
+
+# API Endpoint for ranked, highlighted full-text search over elements and invoice names
+@app.route('/api/search/elements', methods=['GET'])
+@app.route('/api/search/elements/<project_name>', methods=['GET'])
+@versioned('elements', 'invoices')
+def search_elements(project_name=None):
+    try:
+        text, page = parse_search_args(request.args)
+        response_format = get_response_format(request.args)
+    except (SearchError, PaginationError, ResponseFormatError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    query, params = build_search_query(text, project_name, page)
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        columns = [desc[0] for desc in cur.description]
+
+    return jsonify(build_page(rows, columns, page, 'id', response_format))
+
+
+# Rollup configurations
+class RollupConfig:
+    REFRESH_DELAY = int(os.getenv('ROLLUP_REFRESH_DELAY', 30))  # Seconds of writes batched into one refresh
+
+
+ROLLUP_REFRESH_LOCK_ID = 4_205_002  # Advisory lock key so workers refresh the rollup one at a time
+ROLLUP_TABLES = ('elements', 'invoices')
+
+# Rollup levels: {level: (grouping_id, key columns)}; grouping_id is the GROUPING() bitmask from migration 0006
+ROLLUP_LEVELS = {
+    'total': (15, []),
+    'project': (7, ['project_name']),
+    'folder_type': (3, ['project_name', 'folder_type']),
+    'chapter': (5, ['project_name', 'chapter_code']),
+    'subchapter': (4, ['project_name', 'chapter_code', 'subchapter_code']),
+    'folder_type_chapter': (1, ['project_name', 'folder_type', 'chapter_code']),
+    'folder_type_subchapter': (0, ['project_name', 'folder_type', 'chapter_code', 'subchapter_code']),
+}
+ROLLUP_VALUE_COLUMNS = ['element_count', 'invoice_count', 'subelement_count', 'quantity', 'total_price']
+
+
+class RollupError(ValueError):
+    """Raised for an unknown level or a filter on a column the level rolls up"""
+
+
+def build_rollup_query(level, filters):
+    """Build the rollup query for a level, filtered by {key column: value}"""
+    if level not in ROLLUP_LEVELS:
+        raise RollupError(f"level must be one of: {', '.join(ROLLUP_LEVELS)}")
+    grouping_id, keys = ROLLUP_LEVELS[level]
+
+    # '' stands for a missing key in the view; send it as null
+    columns = [f"NULLIF({key}, '') AS {key}" for key in keys] + ROLLUP_VALUE_COLUMNS
+    query = f"SELECT {', '.join(columns)} FROM project_cost_rollup WHERE grouping_id = %s"
+    params = [grouping_id]
+    for key, value in filters.items():
+        if key not in keys:
+            raise RollupError(f"level '{level}' does not group by {key}")
+        query += f" AND {key} = %s"
+        params.append(value)
+    if keys:
+        query += f" ORDER BY {', '.join(keys)}"
+    return query, params
+
+
+def refresh_project_cost_rollup(force=False):
+    """Refresh the rollup unless it already reflects the current data; returns whether it ran"""
+    with db_connection() as conn, conn.cursor() as cur:
+        # Workers notified of the same write queue here, then find the version already refreshed
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_REFRESH_LOCK_ID,))
+        version = data_version(conn, ROLLUP_TABLES)
+        cur.execute("SELECT data_version FROM rollup_refreshes WHERE view_name = 'project_cost_rollup'")
+        row = cur.fetchone()
+        if row and row[0] == version and not force:
+            return False
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY project_cost_rollup")
+        cur.execute("""
+            INSERT INTO rollup_refreshes (view_name, data_version)
+            VALUES ('project_cost_rollup', %s)
+            ON CONFLICT (view_name) DO UPDATE SET data_version = EXCLUDED.data_version, refreshed_at = now()
+        """, (version,))
+    return True
+
+
+class RollupRefresher:
+    """Turns data change notifications into one delayed background refresh of the rollup"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self._reset()
+
+    def _reset(self):
+        # Timer threads do not survive fork
+        self._lock = threading.Lock()
+        self._timer = None
+        self._counters = defaultdict(int)
+
+    def on_change(self, tables):
+        if tables is not None and not tables & set(ROLLUP_TABLES):
+            return
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self._run)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _run(self):
+        # Writes that land while refreshing schedule the next refresh
+        with self._lock:
+            self._timer = None
+        try:
+            self._counters['refreshes' if refresh_project_cost_rollup() else 'skipped'] += 1
+        except Exception as e:
+            self._counters['failures'] += 1
+            print(f"Rollup refresh failed: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'delay': self.delay,
+                'pending': self._timer is not None,
+                'refreshes': self._counters['refreshes'],
+                'skipped': self._counters['skipped'],
+                'failures': self._counters['failures']
+            }
+
+
+rollup_refresher = RollupRefresher(RollupConfig.REFRESH_DELAY)
+os.register_at_fork(after_in_child=rollup_refresher._reset)
+data_listener.subscribe(rollup_refresher.on_change)
+
+
+# API Endpoint for pre-aggregated element costs per project, folder type and chapter
+@app.route('/api/rollups/project-costs', methods=['GET'])
+@app.route('/api/rollups/project-costs/<project_name>', methods=['GET'])
+def get_project_cost_rollup(project_name=None):
+    filters = {
+        key: request.args[key] for key in ('folder_type', 'chapter_code', 'subchapter_code')
+        if request.args.get(key)
+    }
+    if project_name:
+        filters = {'project_name': project_name, **filters}
+    level = request.args.get('level', 'project')
+
+    try:
+        response_format = get_response_format(request.args)
+        query, params = build_rollup_query(level, filters)
+    except (ResponseFormatError, RollupError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    current_version = data_listener.versions(ROLLUP_TABLES)
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        columns = [desc[0] for desc in cur.description]
+        cur.execute("SELECT data_version, refreshed_at FROM rollup_refreshes WHERE view_name = 'project_cost_rollup'")
+        refreshed = cur.fetchone()
+        if current_version is None:
+            current_version = data_version(conn, ROLLUP_TABLES)
+
+    return jsonify({
+        'level': level,
+        'refreshed_at': refreshed[1].isoformat() if refreshed else None,
+        # Writes since the last refresh are picked up after ROLLUP_REFRESH_DELAY
+        'stale': refreshed is None or refreshed[0] != current_version,
+        'items': shape_rows(columns, rows, response_format)
+    })
+
+
+@app.route('/api/admin/rollups/refresh', methods=['POST'])
+@token_required
+def refresh_rollups_endpoint():
+    # Get token data
+    token = request.headers['Authorization'].split(" ")[1]
+    user_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+
+    # Check if user is admin
+    if user_data.get('role') != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+
+    refreshed = refresh_project_cost_rollup(force=request.args.get('force') == 'true')
+    return jsonify({'refreshed': refreshed, 'refresher': rollup_refresher.stats()})
+
+
+EXPORT_ELEMENTS_QUERY = """
+    SELECT 
+        e.id,
+        e.chapter_title,
+        e.subchapter_code,
+        e.name,
+        e.unit,
+        e.quantity,
+        e.price_per_unit,
+        e.total_price,
+        e.description,
+        i.file_name AS invoice_name,
+        i.folder_type,
+        i.project_name
+    FROM elements e
+    LEFT JOIN invoices i ON e.invoice_id = i.id
+    WHERE e.id = ANY(%s::integer[])
+    ORDER BY i.file_name, e.id
+"""
+
+# Same WHERE and ORDER BY keys as EXPORT_ELEMENTS_QUERY so both cursors can be merged in one pass
+EXPORT_SUBELEMENTS_QUERY = """
+    SELECT 
+        s.element_id,
+        s.title,
+        s.unit,
+        s.n,
+        s.l,
+        s.h,
+        s.w,
+        s.unit_price,
+        s.total_price
+    FROM subelements s
+    JOIN elements e ON e.id = s.element_id
+    LEFT JOIN invoices i ON e.invoice_id = i.id
+    WHERE s.element_id = ANY(%s::integer[])
+    ORDER BY i.file_name, s.element_id, s.id
+"""
+
+EXPORT_QUERIES = {
+    'projects': """
+        SELECT *
+        FROM projects
+        WHERE name = ANY(%s)
+    """,
+    'invoices': """
+        SELECT
+            i.folder_type,
+            i.file_name,
+            i.project_name
+        FROM invoices i
+        WHERE i.id = ANY(%s::integer[])
+    """,
+}
+
+# Export row estimate for progress reporting: element rows plus their subelement rows
+EXPORT_ELEMENTS_ROW_COUNT_QUERY = """
+    SELECT count(*) + COALESCE(sum(subelement_count), 0)
+    FROM elements
+    WHERE id = ANY(%s::integer[])
+"""
+
+EXPORT_NUMBER_TYPES = (int, float, Decimal)
+EXPORT_HIGHLIGHTED_COLUMNS = {'name', 'price_per_unit', 'invoice_name', 'Sub Unit Price'}
+EXPORT_SUBELEMENT_COLUMNS = ['Sub Title', 'Sub Unit', 'N', 'L', 'H', 'W', 'Sub Unit Price', 'Sub Total Price']
+EXPORT_COLUMN_WIDTH = 19
+
+
+def open_export_cursor(conn, query, params):
+    """Execute an export query on a named (server-side) cursor and return it with its column names"""
+    cur = use_decimal_numeric(conn.cursor(name=f'export_{secrets.token_hex(8)}'))
+    cur.itersize = StreamConfig.DEFAULT_ITERSIZE
+    cur.execute(query, params)
+    rows = cur.fetchmany(cur.itersize)
+    columns = [desc[0] for desc in cur.description]
+    return cur, columns, rows
+
+
+def iter_export_rows(cur, first_rows):
+    """Yield every row of an export cursor, starting with the batch already fetched"""
+    rows = first_rows
+    while rows:
+        yield from rows
+        rows = cur.fetchmany(cur.itersize)
+
+
+class ExportOrderError(RuntimeError):
+    """Raised when the subelement cursor of an export no longer follows the element cursor's order"""
+
+
+def merge_subelements(elements, subelements):
+    """Pair each element row with its subelement rows; both iterators must share the same ordering.
+
+    A subelement whose element was already passed, or that is left over at the end, means the
+    two orderings drifted apart; that raises rather than silently dropping the remaining rows.
+    """
+    subelements = iter(subelements)
+    pending = next(subelements, None)
+    passed = set()
+    for element in elements:
+        if pending is not None and pending[0] in passed:
+            raise ExportOrderError(f"Subelements of element {pending[0]} arrived after the element")
+        children = []
+        while pending is not None and pending[0] == element[0]:
+            children.append(pending)
+            pending = next(subelements, None)
+        passed.add(element[0])
+        yield element, children
+    if pending is not None:
+        problem = 'arrived after the element' if pending[0] in passed else 'match no exported element'
+        raise ExportOrderError(f"Subelements of element {pending[0]} {problem}")
+
+
+def add_export_formats(workbook):
+    """Register the cell formats shared by every export sheet"""
+    return {
+        'header': workbook.add_format({
+            'bold': True,
+            'bg_color': '#4F81BD',
+            'font_color': 'white',
+            'border': 1,
+            'text_wrap': True,
+            'valign': 'vcenter',
+            'align': 'center'
+        }),
+        'number': workbook.add_format({
+            'num_format': '#,##0.00',
+            'border': 1,
+            'align': 'right'
+        }),
+        'highlighted_cell': workbook.add_format({
+            'bg_color': '#FFE5CC',  # Light orange color
+            'align': 'left'
+        }),
+        'highlighted_number': workbook.add_format({
+            'bg_color': '#FFE5CC',  # Light orange color
+            'num_format': '#,##0.00',
+            'align': 'right'
+        }),
+    }
+
+
+def write_export_header(worksheet, columns, formats):
+    """Size every column and write the header row"""
+    for col, header in enumerate(columns):
+        worksheet.set_column(col, col, EXPORT_COLUMN_WIDTH)
+        worksheet.write(0, col, header, formats['header'])
+
+
+def write_elements_sheet(workbook, formats, conn, selected_ids, progress=None):
+    """Stream elements and their subelements into an 'Elements' sheet; returns the last row written"""
+    worksheet = workbook.add_worksheet('Elements')
+    elements_cur, columns, element_rows = open_export_cursor(conn, EXPORT_ELEMENTS_QUERY, (selected_ids,))
+    subelements_cur, _, subelement_rows = open_export_cursor(conn, EXPORT_SUBELEMENTS_QUERY, (selected_ids,))
+    with elements_cur, subelements_cur:
+        element_columns = columns[1:]  # Skip the id column
+        all_columns = element_columns + EXPORT_SUBELEMENT_COLUMNS
+        write_export_header(worksheet, all_columns, formats)
+
+        col_offset = len(element_columns)
+        current_row = 0
+        rows = merge_subelements(
+            iter_export_rows(elements_cur, element_rows),
+            iter_export_rows(subelements_cur, subelement_rows),
+        )
+        for element, children in rows:
+            current_row += 1
+            if progress:
+                progress(current_row)
+            for col, value in enumerate(element[1:]):
+                highlighted = element_columns[col] in EXPORT_HIGHLIGHTED_COLUMNS
+                if isinstance(value, EXPORT_NUMBER_TYPES):
+                    cell_format = formats['highlighted_number' if highlighted else 'number']
+                    worksheet.write_number(current_row, col, value, cell_format)
+                elif highlighted:
+                    worksheet.write(current_row, col, value, formats['highlighted_cell'])
+                else:
+                    worksheet.write(current_row, col, value)
+
+            for _, title, unit, *amounts in children:
+                current_row += 1
+                worksheet.write(current_row, col_offset, title)
+                worksheet.write(current_row, col_offset + 1, unit)
+                for col, value in enumerate(amounts, start=col_offset + 2):
+                    if value:
+                        worksheet.write_number(current_row, col, value, formats['number'])
+
+    worksheet.freeze_panes(1, 0)
+    worksheet.autofilter(0, 0, current_row, len(all_columns) - 1)
+    return current_row
+
+
+def write_data_sheet(workbook, formats, conn, query, selected_ids, progress=None):
+    """Stream a flat export query into a 'Data' sheet; returns the last row written"""
+    cur, columns, first_rows = open_export_cursor(conn, query, (selected_ids,))
+    with cur:
+        if not first_rows:
+            return 0
+        worksheet = workbook.add_worksheet('Data')
+        write_export_header(worksheet, columns, formats)
+
+        current_row = 0
+        for row in iter_export_rows(cur, first_rows):
+            current_row += 1
+            if progress:
+                progress(current_row)
+            for col, value in enumerate(row):
+                if isinstance(value, EXPORT_NUMBER_TYPES):
+                    worksheet.write_number(current_row, col, value, formats['number'])
+                else:
+                    worksheet.write(current_row, col, value)
+
+    worksheet.freeze_panes(1, 0)
+    worksheet.autofilter(0, 0, current_row, len(columns) - 1)
+    return current_row
+
+
+# Flat (one row per subelement) element export for the CSV and Parquet formats
+EXPORT_ELEMENTS_FLAT_QUERY = """
+    SELECT 
+        e.id AS element_id,
+        e.chapter_title,
+        e.subchapter_code,
+        e.name,
+        e.unit,
+        e.quantity,
+        e.price_per_unit,
+        e.total_price,
+        e.description,
+        i.file_name AS invoice_name,
+        i.folder_type,
+        i.project_name,
+        s.title AS sub_title,
+        s.unit AS sub_unit,
+        s.n,
+        s.l,
+        s.h,
+        s.w,
+        s.unit_price AS sub_unit_price,
+        s.total_price AS sub_total_price
+    FROM elements e
+    LEFT JOIN invoices i ON e.invoice_id = i.id
+    LEFT JOIN subelements s ON s.element_id = e.id
+    WHERE e.id = ANY(%s::integer[])
+    ORDER BY i.file_name, e.id, s.id
+"""
+
+
+# Flat export configurations
+class FlatExportConfig:
+    CSV_CHUNK_SIZE = int(os.getenv('EXPORT_CSV_CHUNK_SIZE', 64 * 1024))  # Bytes per streamed CSV chunk
+    CSV_QUEUE_CHUNKS = 16  # Chunks buffered between COPY and a slow client
+    PARQUET_ROW_GROUP = int(os.getenv('EXPORT_PARQUET_ROW_GROUP', 50000))  # Rows per Parquet row group
+    PARQUET_COMPRESSION = os.getenv('EXPORT_PARQUET_COMPRESSION', 'zstd')
+
+
+EXPORT_MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+EXPORT_FORMAT_ALIASES = {'excel': 'xlsx'}
+
+
+def get_export_format(value):
+    """Normalise a requested export format; returns None when it is not supported"""
+    export_format = (value or 'xlsx').lower()
+    export_format = EXPORT_FORMAT_ALIASES.get(export_format, export_format)
+    return export_format if export_format in EXPORT_MIMETYPES else None
+
+
+def flat_export_query(entity_type):
+    return EXPORT_ELEMENTS_FLAT_QUERY if entity_type == 'elements' else EXPORT_QUERIES[entity_type]
+
+
+def copy_csv(cur, query, params, out):
+    """COPY a parameterised query to out as CSV with a header row; returns the row count"""
+    statement = cur.mogrify(query, params).decode().strip().rstrip(';')
+    # The statement sits on its own lines so nothing in it can reach the closing parenthesis
+    cur.copy_expert(f"COPY (\n{statement}\n) TO STDOUT WITH (FORMAT csv, HEADER true)", out)
+    return cur.rowcount
+
+
+class CopyStream:
+    """File-like COPY target that hands fixed-size chunks to a consuming thread through a bounded queue"""
+
+    _END = object()
+
+    def __init__(self, chunk_size, max_chunks):
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._queue = queue.Queue(max_chunks)
+        self._cancelled = threading.Event()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def _put(self, item):
+        # Block while the client is slow, but give up once the consumer has gone away
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        raise ConnectionAbortedError('Export stream was closed by the client')
+
+    def finish(self, error=None):
+        try:
+            if error is None and self._buffer:
+                self._put(bytes(self._buffer))
+            self._put(self._END if error is None else error)
+        except ConnectionAbortedError:
+            pass
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+def stream_copy_csv(query, params):
+    """Yield CSV bytes from COPY ... TO STDOUT; COPY runs on a helper thread so the response can stream"""
+    stream = CopyStream(FlatExportConfig.CSV_CHUNK_SIZE, FlatExportConfig.CSV_QUEUE_CHUNKS)
+
+    def run():
+        try:
+            with db_connection() as conn, conn.cursor() as cur:
+                copy_csv(cur, query, params, stream)
+        except BaseException as e:
+            print(f"Error in CSV export: {str(e)}")
+            stream.finish(e)
+        else:
+            stream.finish()
 
+    threading.Thread(target=run, name='csv-export', daemon=True).start()
+    try:
+        yield from stream
+    finally:
+        stream.cancel()
+
+
+# Arrow types for PostgreSQL type OIDs; anything not listed is exported as text
+ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1082: pa.date32(),
+    1114: pa.timestamp('us'),
+    1184: pa.timestamp('us', tz='UTC'),
+}
+def arrow_schema(description, numeric_type=pa.float64()):
+    """Arrow schema for a cursor description"""
+    fields = []
+    for column in description:
+        if column.type_code == NUMERIC_OID:
+            # NUMERIC(p, s) maps exactly; unconstrained NUMERIC has no fixed scale, so it gets numeric_type
+            if column.precision and column.precision <= 38:
+                arrow_type = pa.decimal128(column.precision, column.scale or 0)
+            else:
+                arrow_type = numeric_type
         else:
-            return jsonify({'reply': f"Error: Unrecognized action '{action}'.", 'format': 'markdown'}), 400
+            arrow_type = ARROW_TYPES.get(column.type_code, pa.string())
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
 
-    except Exception as e:
-        print(f"Error in chat function: {e}")
-        return jsonify({'reply': "An error occurred during processing. Please try again.", 'format': 'markdown'}), 500
 
-# Update the download endpoint
-@app.route('/api/download/<path:filename>', methods=['GET'])
-def download_file(filename):
+def arrow_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def arrow_decimals(values, arrow_type):
     try:
-        print(f"\n=== Download Request ===")
-        print(f"Download request received for file: {filename}")
-        print(f"Reports directory: {REPORTS_DIR}")
-        
-        # Clean the filename
-        filename = os.path.basename(filename)
-        filepath = os.path.join(REPORTS_DIR, filename)
-        
-        print(f"Full file path: {filepath}")
-        print(f"File exists: {os.path.exists(filepath)}")
-        print(f"Directory contents: {os.listdir(REPORTS_DIR)}")
-        
-        if not os.path.exists(filepath):
-            print(f"File not found at path: {filepath}")
-            return jsonify({'error': 'File not found'}), 404
-            
-        print(f"File exists, size: {os.path.getsize(filepath)} bytes")
-        
-        try:
-            return send_file(
-                filepath,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                as_attachment=True,
-                download_name=filename
-            )
-        except Exception as e:
-            print(f"Error sending file: {str(e)}")
-            return jsonify({'error': f'Error sending file: {str(e)}'}), 500
-            
-    except Exception as e:
-        print(f"Error in download_file: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return pa.array(values, type=arrow_type)
+    except pa.ArrowInvalid:
+        # A value has more decimal places than the column type; round it to the type's scale
+        exponent = Decimal(1).scaleb(-arrow_type.scale)
+        return pa.array([None if value is None else value.quantize(exponent) for value in values], type=arrow_type)
+
+
+def arrow_arrays(rows, schema):
+    """Convert a batch of cursor rows to one Arrow array per schema field"""
+    arrays = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in rows]
+        if pa.types.is_floating(field.type):
+            arrays.append(pa.array([None if value is None else float(value) for value in values], type=field.type))
+        elif pa.types.is_string(field.type):
+            arrays.append(pa.array([arrow_text(value) for value in values], type=field.type))
+        elif pa.types.is_decimal(field.type):
+            arrays.append(arrow_decimals(values, field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return arrays
+
+
+class ChunkSink:
+    """Write-only file object that collects output until drained, so a writer's bytes can be streamed"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_parquet_chunks(cur, progress=None, max_rows=None):
+    """Yield Parquet file bytes from an executed named cursor, one row group per fetched batch"""
+    def fetch(rows_written):
+        size = FlatExportConfig.PARQUET_ROW_GROUP
+        if max_rows is not None:
+            size = min(size, max_rows - rows_written)
+        return cur.fetchmany(size) if size > 0 else []
+
+    sink = ChunkSink()
+    rows = fetch(0)
+    schema = arrow_schema(cur.description)
+    writer = pq.ParquetWriter(sink, schema, compression=FlatExportConfig.PARQUET_COMPRESSION)
+    rows_written = 0
+    while rows:
+        writer.write_table(pa.Table.from_arrays(arrow_arrays(rows, schema), schema=schema))
+        rows_written += len(rows)
+        if progress:
+            progress(rows_written)
+        yield sink.drain()
+        rows = fetch(rows_written)
+    writer.close()
+    yield sink.drain()
+
+
+def stream_parquet(query, params):
+    """Yield a Parquet file for a query, fetched and encoded one row group at a time"""
+    with db_connection() as conn:
+        with use_decimal_numeric(conn.cursor(name=f'parquet_{secrets.token_hex(8)}')) as cur:
+            cur.execute(query, params)
+            yield from iter_parquet_chunks(cur)
 
-        
-@app.route('/api/test-download', methods=['GET'])
-def test_download():
+
+# Arrow IPC configurations
+class ArrowConfig:
+    BATCH_SIZE = int(os.getenv('ARROW_BATCH_SIZE', 50000))  # Rows per record batch
+    NUMERIC_SCALE = int(os.getenv('ARROW_NUMERIC_SCALE', 6))  # Decimal places kept for unconstrained NUMERIC
+
+
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+
+def stream_arrow_ipc(query, params):
+    """Yield an Arrow IPC stream for a query, one record batch per server-side fetch"""
+    numeric_type = pa.decimal128(38, ArrowConfig.NUMERIC_SCALE)
+    with db_connection() as conn:
+        with use_decimal_numeric(conn.cursor(name=f'arrow_{secrets.token_hex(8)}')) as cur:
+            cur.execute(query, params)
+            rows = cur.fetchmany(ArrowConfig.BATCH_SIZE)
+            schema = arrow_schema(cur.description, numeric_type)
+            sink = ChunkSink()
+            with pa.ipc.new_stream(sink, schema) as writer:
+                yield sink.drain()
+                while rows:
+                    writer.write_batch(pa.RecordBatch.from_arrays(arrow_arrays(rows, schema), schema=schema))
+                    yield sink.drain()
+                    rows = cur.fetchmany(ArrowConfig.BATCH_SIZE)
+            yield sink.drain()
+
+
+# Arrow IPC endpoints for analysis clients; same filters as /api/elements, no JSON involved
+@app.route('/api/arrow/elements', methods=['GET'])
+@app.route('/api/arrow/elements/<project_name>', methods=['GET'])
+@versioned('elements', 'invoices')
+def get_elements_arrow(project_name=None):
     try:
-        print("\n=== Test Download ===")
-        # Create a test Excel file
-        test_df = pd.DataFrame({'test': ['data1', 'data2'], 'column2': ['value1', 'value2']})
-        test_file = os.path.join(REPORTS_DIR, 'test.xlsx')
-        
-        # Ensure directory exists
-        os.makedirs(REPORTS_DIR, exist_ok=True)
-        
-        print(f"Creating test file at: {test_file}")
-        
-        # Write test file
-        with pd.ExcelWriter(test_file, engine='xlsxwriter') as writer:
-            test_df.to_excel(writer, index=False, sheet_name='Test')
-            workbook = writer.book
-            worksheet = writer.sheets['Test']
-            header_format = workbook.add_format({'bold': True, 'bg_color': '#D3D3D3'})
-            for col_num, value in enumerate(test_df.columns.values):
-                worksheet.write(0, col_num, value, header_format)
-            
-        # Set permissions
-        os.chmod(test_file, 0o666)
-        
-        print(f"Test file created successfully")
-        print(f"File exists: {os.path.exists(test_file)}")
-        print(f"File size: {os.path.getsize(test_file)} bytes")
-        print(f"File permissions: {oct(os.stat(test_file).st_mode)[-3:]}")
-        print(f"Directory contents: {os.listdir(REPORTS_DIR)}")
-        
-        return jsonify({
-            'message': 'Test file created successfully',
-            'download_url': '/api/download/test.xlsx'
-        })
-    except Exception as e:
-        print(f"Test download error: {str(e)}")
-        return jsonify({'error': str(e)}), 500
-    
-@app.route('/api/invoices', methods=['GET'])
-@app.route('/api/invoices/<project_name>', methods=['GET'])
-def get_invoices(project_name=None):
-    print("=== GET Invoices Request ===")
+        fields = parse_fields(request.args, ELEMENT_FIELDS)
+    except FieldSelectionError as e:
+        return jsonify({'error': str(e)}), 400
+    query, params = build_elements_query(request.args, project_name, fields)
+    query += " ORDER BY elements.id"
+    return Response(stream_arrow_ipc(query, params), mimetype=ARROW_STREAM_MIMETYPE)
+
+
+@app.route('/api/arrow/subelements', methods=['GET'])
+@app.route('/api/arrow/subelements/<project_name>', methods=['GET'])
+@versioned('subelements', 'elements', 'invoices')
+def get_subelements_arrow(project_name=None):
+    """Subelements of every element matching the elements filters"""
     try:
-        conn = connect_to_db()
-        cur = conn.cursor()
+        fields = parse_fields(request.args, SUBELEMENT_FIELDS)
+    except FieldSelectionError as e:
+        return jsonify({'error': str(e)}), 400
+    elements_query, params = build_elements_query(request.args, project_name, ['id'])
+    query = f"""
+        SELECT {select_list(fields, SUBELEMENT_FIELDS) if fields else 'subelements.*'}
+        FROM subelements
+        JOIN ({elements_query}) AS filtered ON filtered.id = subelements.element_id
+        ORDER BY subelements.element_id, subelements.id
+    """
+    return Response(stream_arrow_ipc(query, params), mimetype=ARROW_STREAM_MIMETYPE)
 
-        # Debug logging
-        print("Received request args:", request.args)
-        print("Folder type filters:", {
-            'adicionals': request.args.get('folderTypeFilters[adicionals]'),
-            'pressupost': request.args.get('folderTypeFilters[pressupost]')
-        })
 
-        # Build base query
-        query = """
-            SELECT
-                id,
-                file_name,
-                folder_type,
-                project_name
-            FROM invoices
-        """
-        params = []
+def write_flat_export(conn, export_format, query, params, out, progress=None, max_rows=None):
+    """Write a CSV or Parquet export of a query to a binary file; returns the rows written"""
+    if export_format == 'csv':
+        if max_rows is not None:
+            query = f"SELECT * FROM (\n{query}\n) AS export LIMIT {int(max_rows)}"
+        with conn.cursor() as cur:
+            rows_written = copy_csv(cur, query, params, out)
+        if progress:
+            progress(rows_written)
+        return rows_written
 
-        # Start WHERE clause
-        if project_name:
-            query += " WHERE project_name = %s"
-            params.append(project_name)
-        else:
-            query += " WHERE 1=1"
-
-        # Get folder type filters
-        folder_type_adicionals = request.args.get('folderTypeFilters[adicionals]') == 'true'
-        folder_type_pressupost = request.args.get('folderTypeFilters[pressupost]') == 'true'
-
-        # Apply folder type filters if either checkbox is checked
-        if folder_type_adicionals or folder_type_pressupost:
-            filter_values = []
-            if folder_type_adicionals:
-                filter_values.append('Adicionals')
-            if folder_type_pressupost:
-                filter_values.append('Pressupost contracte')
-            if filter_values:
-                placeholders = ', '.join(['%s'] * len(filter_values))
-                query += f" AND folder_type IN ({placeholders})"
-                params.extend(filter_values)
-
-        # Apply additional filters
-        start_date = request.args.get('startDate')
-        if start_date:
-            query += " AND date >= %s"
-            params.append(start_date)
-
-        end_date = request.args.get('endDate')
-        if end_date:
-            query += " AND date <= %s"
-            params.append(end_date)
-
-        file_name_keyword = request.args.get('FileNameKeyword')
-        if file_name_keyword:
-            query += " AND file_name ILIKE %s"
-            params.append(f'%{file_name_keyword}%')
+    rows_written = 0
 
-        print(f"Query: {query}")
-        print(f"Params: {params}")
+    def track(count):
+        nonlocal rows_written
+        rows_written = count
+        if progress:
+            progress(count)
 
-        # Execute query
+    with use_decimal_numeric(conn.cursor(name=f'parquet_{secrets.token_hex(8)}')) as cur:
         cur.execute(query, params)
-        invoices = cur.fetchall()
-        print(f"Found {len(invoices)} invoices")
+        for chunk in iter_parquet_chunks(cur, track, max_rows):
+            out.write(chunk)
+    return rows_written
 
-        # Get column names from cursor description
-        columns = ['id', 'file_name', 'folder_type', 'project_name']
-        
-        # Convert to list of dictionaries
-        invoices_list = [dict(zip(columns, invoice)) for invoice in invoices]
-        
-        return jsonify(invoices_list)
 
-    except Exception as e:
-        print(f"Error in get_invoices: {str(e)}")
-        return jsonify({"error": str(e)}), 500
-        
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
+def export_row_estimate(conn, entity_type, selected_ids):
+    """Rough number of rows an export will write, for progress reporting"""
+    if entity_type != 'elements':
+        return len(selected_ids)
+    with conn.cursor() as cur:
+        cur.execute(EXPORT_ELEMENTS_ROW_COUNT_QUERY, (selected_ids,))
+        return int(cur.fetchone()[0])
 
-# API Endpoint to get subelements by element ID
-@app.route('/api/subelements/<element_id>', methods=['GET'])
-def get_subelements(element_id):
-    conn = connect_to_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM subelements WHERE element_id = %s;", (element_id,))
-    subelements = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    conn.close()
-    subelements_list = [dict(zip(columns, subelement)) for subelement in subelements]
-    return jsonify(subelements_list)
 
-# API Endpoint to get all elements or elements by project name
-@app.route('/api/elements', methods=['GET'])
-@app.route('/api/elements/<project_name>', methods=['GET'])
-def get_elements(project_name=None):
-    conn = connect_to_db()
-    cur = conn.cursor()
+def write_selection_report(entity_type, selected_ids, progress=None, export_format='xlsx'):
+    """Write the export for the selected items to REPORTS_DIR; returns (filename, rows_written).
 
-    print("Received request args:", request.args)
-    print("Folder type filters:", {
-        'adicionals': request.args.get('folderTypeFilters[adicionals]'),
-        'pressupost': request.args.get('folderTypeFilters[pressupost]')
-    })
-    
-    # Get filters from query parameters
-    nameKeyword = request.args.get('nameKeyword')
-    invoiceNameKeyword = request.args.get('invoiceNameKeyword')
-    invoiceid = request.args.get('invoiceid')
-    min_price = request.args.get('minPrice')
-    max_price = request.args.get('maxPrice')
-    quantity = request.args.get('quantity')
-    
-# Base query with JOIN to get invoice information
-    query = """
-        SELECT 
-            elements.*,
-            EXISTS (
-                SELECT 1 
-                FROM subelements 
-                WHERE subelements.element_id = elements.id
-            ) AS has_subelements,
-            invoices.file_name as invoice_name,
-            invoices.folder_type as folder_type,
-            invoices.project_name as project_name
-        FROM elements
-        LEFT JOIN invoices ON elements.invoice_id = invoices.id
+    rows_written is None when an identical report was already cached.
     """
+    filename = selection_report_filename(entity_type, selected_ids, export_format)
+    if lookup_cached_report(filename):
+        return filename, None
 
-    params = []
-
-    # Start WHERE clause
-    if project_name:
-        query += " WHERE invoices.project_name = %s"
-        params.append(project_name)
-    else:
-        query += " WHERE 1=1"  # This ensures we can always add AND conditions
-
-    # Get folder type filters
-    folder_type_adicionals = request.args.get('folderTypeFilters[adicionals]') == 'true'
-    folder_type_pressupost = request.args.get('folderTypeFilters[pressupost]') == 'true'
-    
-    # Apply folder type filter if either checkbox is checked
-    if folder_type_adicionals or folder_type_pressupost:
-        filter_values = []
-        if folder_type_adicionals:
-            filter_values.append('Adicionals')
-        if folder_type_pressupost:
-            filter_values.append('Pressupost contracte')
-        if filter_values:
-            query += " AND invoices.folder_type IN %s"  # Changed from IN ({placeholders})
-            params.append(tuple(filter_values))  # Keep as tuple      
+    filepath = os.path.join(REPORTS_DIR, filename)
+    tmp_path = report_tmp_path(filepath)
 
-    # Apply additional filters
-    if nameKeyword:
-        query += " AND elements.name ILIKE %s"
-        params.append(f'%{nameKeyword}%')
-    if invoiceNameKeyword:
-        query += " AND invoices.file_name ILIKE %s"
-        params.append(f'%{invoiceNameKeyword}%')
-    if invoiceid:
-        query += " AND elements.invoice_id = %s"
-        params.append(invoiceid)
-    if min_price:
-        query += " AND elements.price_per_unit >= %s"
-        params.append(min_price)
-    if max_price:
-        query += " AND elements.price_per_unit <= %s"
-        params.append(max_price)
-    if quantity:
-        query += " AND elements.quantity = %s"
-        params.append(quantity)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
+    try:
+        if export_format != 'xlsx':
+            with db_connection() as conn, open(tmp_path, 'wb') as out:
+                if progress:
+                    progress(0, export_row_estimate(conn, entity_type, selected_ids))
+                rows_written = write_flat_export(
+                    conn, export_format, flat_export_query(entity_type), (selected_ids,), out, progress
+                )
+        else:
+            # constant_memory flushes each row to disk as soon as the next one starts
+            workbook = xlsxwriter.Workbook(tmp_path, {'constant_memory': True})
+            try:
+                formats = add_export_formats(workbook)
+                with db_connection() as conn:
+                    # One snapshot for the estimate and both element cursors, which must see the same rows
+                    with conn.cursor() as cur:
+                        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                    if progress:
+                        progress(0, export_row_estimate(conn, entity_type, selected_ids))
+                    if entity_type == 'elements':
+                        rows_written = write_elements_sheet(workbook, formats, conn, selected_ids, progress)
+                    else:
+                        rows_written = write_data_sheet(
+                            workbook, formats, conn, EXPORT_QUERIES[entity_type], selected_ids, progress
+                        )
+            finally:
+                workbook.close()
+    except BaseException:
+        discard_report(tmp_path)
+        raise
 
-    cur.execute(query, params)
-    elements = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    conn.close()
+    if rows_written == 0 and entity_type != 'elements':
+        discard_report(tmp_path)
+    else:
+        publish_report(tmp_path, filepath)
+    return filename, rows_written
 
-    elements_list = [dict(zip(columns, elem)) for elem in elements]
-    return jsonify(elements_list)
 
 @app.route('/api/download_selected/<entity_type>', methods=['POST'])
 def download_selected(entity_type):
@@ -1310,216 +4371,364 @@ def download_selected(entity_type):
         selected_ids = request.json.get('selectedIds', [])
         if not selected_ids:
             return jsonify({'error': 'No items selected'}), 400
+        if entity_type != 'elements' and entity_type not in EXPORT_QUERIES:
+            return jsonify({'error': 'Invalid entity type'}), 400
+        export_format = get_export_format(request.args.get('format') or request.json.get('format'))
+        if export_format is None:
+            return jsonify({'error': 'Unsupported export format'}), 400
 
-        conn = connect_to_db()
-        cur = conn.cursor()
-
-        if entity_type == 'elements':
-            elements_query = """
-                SELECT 
-                    e.id,
-                    e.chapter_title,
-                    e.subchapter_code,
-                    e.name,
-                    e.unit,
-                    e.quantity,
-                    e.price_per_unit,
-                    e.total_price,
-                    e.description,
-                    i.file_name AS invoice_name,
-                    i.folder_type,
-                    i.project_name
-                FROM elements e
-                LEFT JOIN invoices i ON e.invoice_id = i.id
-                WHERE e.id = ANY(%s::integer[])
-                ORDER BY i.file_name
-            """
-            
-            subelements_query = """
-                SELECT 
-                    s.element_id,
-                    s.title,
-                    s.unit,
-                    s.n,
-                    s.l,
-                    s.h,
-                    s.w,
-                    s.unit_price,
-                    s.total_price
-                FROM subelements s
-                WHERE s.element_id = ANY(%s::integer[])
-                ORDER BY s.element_id, s.id
-            """
-            
-            cur.execute(elements_query, (selected_ids,))
-            elements_data = cur.fetchall()
-            elements_columns = [desc[0] for desc in cur.description]
-            
-            cur.execute(subelements_query, (selected_ids,))
-            subelements_data = cur.fetchall()
-            subelements_columns = [desc[0] for desc in cur.description]
-            
-            df = pd.DataFrame(elements_data, columns=elements_columns)
-            subelements_df = pd.DataFrame(subelements_data, columns=subelements_columns)
-            
-        else:
-            if entity_type == 'projects':
-                query = """
-                    SELECT *
-                    FROM projects
-                    WHERE name = ANY(%s)
-                """
-            elif entity_type == 'invoices':
-                query = """
-                    SELECT 
-                        i.folder_type,
-                        i.file_name,
-                        i.project_name,
-                        p.name AS project_name
-                    FROM invoices i
-                    LEFT JOIN projects p ON i.project_name = p.name
-                    WHERE i.id = ANY(%s::integer[])
-                """
-            else:
-                return jsonify({'error': 'Invalid entity type'}), 400
+        timestamp = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
+        download_name = f"{entity_type}_report_{timestamp}.{export_format}"
+
+        filename = selection_report_filename(entity_type, selected_ids, export_format)
+        if lookup_cached_report(filename):
+            return send_report(filename, download_name)
+
+        if export_format != 'xlsx':
+            # CSV and Parquet are streamed to the client as they are produced, and cached on completion
+            query = flat_export_query(entity_type)
+            stream = stream_copy_csv if export_format == 'csv' else stream_parquet
+            return Response(
+                cache_report_stream(stream(query, (selected_ids,)), os.path.join(REPORTS_DIR, filename)),
+                mimetype=EXPORT_MIMETYPES[export_format],
+                headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+            )
 
-            cur.execute(query, (selected_ids,))
-            rows = cur.fetchall()
-            columns = [desc[0] for desc in cur.description]
-            
-            if not rows:
-                return jsonify({'error': 'No data found for selected items'}), 404
-            
-            df = pd.DataFrame(rows, columns=columns)
+        # Workbooks cannot be streamed, so they are built by the report job queue; poll the Location
+        job = submit_selection_report(entity_type, selected_ids, export_format)
+        status = report_job_status(job)
+        return jsonify(status), 202, {'Location': status['status_url']}
 
-        timestamp = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{entity_type}_report_{timestamp}.xlsx"
-        filepath = os.path.join(REPORTS_DIR, filename)
-        
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        
-        with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
-            workbook = writer.book
-            
-            header_format = workbook.add_format({
-                'bold': True,
-                'bg_color': '#4F81BD',
-                'font_color': 'white',
-                'border': 1,
-                'text_wrap': True,
-                'valign': 'vcenter',
-                'align': 'center'
-            })
-            
-            number_format = workbook.add_format({
-                'num_format': '#,##0.00',
-                'border': 1,
-                'align': 'right'
-            })
-            
-            highlighted_cell_format = workbook.add_format({
-                'bg_color': '#FFE5CC',  # Light orange color
-                'align': 'left'
-            })
+    except ReportJobAuthError as e:
+        return jsonify({'error': str(e)}), 401
+    except ReportJobLimitError as e:
+        return jsonify({'error': str(e)}), 429
+    except Exception as e:
+        print(f"Error in download_selected: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-            
-            highlighted_number_format = workbook.add_format({
-                'bg_color': '#FFE5CC',  # Light orange color
-                'num_format': '#,##0.00',
-                'align': 'right'
-            })
 
+# Report job configurations
+class ReportJobConfig:
+    WORKERS = int(os.getenv('REPORT_JOB_WORKERS', 2))  # Report threads per gunicorn worker
+    MAX_ACTIVE_PER_USER = int(os.getenv('REPORT_JOB_MAX_PER_USER', 2))  # Queued + running jobs per user
+    RETENTION = int(os.getenv('REPORT_JOB_RETENTION', 24 * 60 * 60))  # Seconds finished job records are kept
+    PROGRESS_INTERVAL = 1.0  # Minimum seconds between progress writes
+    HEARTBEAT_INTERVAL = int(os.getenv('REPORT_JOB_HEARTBEAT_INTERVAL', 15))  # Seconds between liveness writes
+    STALE_AFTER = int(os.getenv('REPORT_JOB_STALE_AFTER', 120))  # Active jobs without a heartbeat this long failed
 
-            if entity_type == 'elements':
-                worksheet = workbook.add_worksheet('Elements')
-                current_row = 0
 
-                element_columns = list(df.columns)
-                element_columns = element_columns[1:]  # Skip the id column
-                subelement_columns = ['Sub Title', 'Sub Unit', 'N', 'L', 'H', 'W', 'Sub Unit Price', 'Sub Total Price']
-                all_columns = element_columns + subelement_columns
-                
-                # Set consistent column width for all columns
-                for col in range(len(all_columns)):
-                    worksheet.set_column(col, col, 19)  # Set default width to 15, VERY IMPORTANT
-
-                # Write headers
-                for col, header in enumerate(all_columns):
-                    worksheet.write(current_row, col, header, header_format)
-
-
-                current_row = 1
-                for _, row in df.iterrows():
-                    # Write element data with conditional formatting
-                    for col, value in enumerate(row.values[1:]):
-                        header = element_columns[col]
-                        if header in ['name', 'price_per_unit', 'invoice_name','Sub Unit Price']:
-                            if isinstance(value, (int, float)):
-                                worksheet.write_number(current_row, col, value, highlighted_number_format)
-                            else:
-                                worksheet.write(current_row, col, value, highlighted_cell_format)
-                        else:
-                            if isinstance(value, (int, float)):
-                                worksheet.write_number(current_row, col, value, number_format)
-                            else:
-                                worksheet.write(current_row, col, value)
-                    
-                    # Add subelements if they exist
-                    element_subs = subelements_df[subelements_df['element_id'] == row.iloc[0]]
-                    if not element_subs.empty:
-                        for _, sub_row in element_subs.iterrows():
-                            current_row += 1
-                            for col in range(len(element_columns)):
-                                worksheet.write(current_row, col, '')
-                            
-                            col_offset = len(element_columns)
-                            worksheet.write(current_row, col_offset, sub_row['title'])
-                            worksheet.write(current_row, col_offset + 1, sub_row['unit'])
-                            if sub_row['n']: worksheet.write_number(current_row, col_offset + 2, sub_row['n'], number_format)
-                            if sub_row['l']: worksheet.write_number(current_row, col_offset + 3, sub_row['l'], number_format)
-                            if sub_row['h']: worksheet.write_number(current_row, col_offset + 4, sub_row['h'], number_format)
-                            if sub_row['w']: worksheet.write_number(current_row, col_offset + 5, sub_row['w'], number_format)
-                            if sub_row['unit_price']:
-                                worksheet.write_number(current_row, col_offset + 6, sub_row['unit_price'], number_format)
-                            if sub_row['total_price']: 
-                                worksheet.write_number(current_row, col_offset + 7, sub_row['total_price'], number_format)
-                    
-                    current_row += 1
-                    
-            else:
-                worksheet = workbook.add_worksheet('Data')
-                
-                for col in range(len(df.columns)):
-                    worksheet.set_column(col, col, 19)
-
-                for col, header in enumerate(df.columns):
-                    worksheet.write(0, col, header, header_format)
-
-                for row_idx, row in df.iterrows():
-                    for col_idx, value in enumerate(row):
-                        if isinstance(value, (int, float)):
-                            worksheet.write_number(row_idx + 1, col_idx, value, number_format)
-                        else:
-                            worksheet.write(row_idx + 1, col_idx, value)
-
-            worksheet.freeze_panes(1, 0)
-            worksheet.autofilter(0, 0, len(df), len(df.columns) - 1)
-
-        return send_file(
-            filepath,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+# Job records live next to the reports so every gunicorn worker sees the same state
+REPORT_JOBS_DIR = os.path.join(REPORTS_DIR, 'jobs')
+os.makedirs(REPORT_JOBS_DIR, exist_ok=True)
+
+ACTIVE_JOB_STATES = ('queued', 'running')
+
+
+class ReportJobLimitError(Exception):
+    """Raised when a user already has the maximum number of active report jobs"""
+
+
+class ReportJobAuthError(Exception):
+    """Raised when a report job is requested without a valid token"""
+
+
+def report_job_path(job_id):
+    return os.path.join(REPORT_JOBS_DIR, f'{job_id}.json')
+
+
+def save_report_job(job):
+    """Atomically replace a job record, so readers never see a half-written file"""
+    path = report_job_path(job['id'])
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+
+
+def load_report_job(job_id):
+    """Read a job record; active jobs whose worker stopped writing heartbeats are marked failed.
+
+    Liveness is not judged by pid, which may be reused or belong to another instance.
+    """
+    if not re.fullmatch(r'[A-Za-z0-9_-]+', job_id):
+        return None
+    try:
+        with open(report_job_path(job_id)) as f:
+            job = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    now = time.time()
+    heartbeat_at = job.get('heartbeat_at', job['created_at'])
+    if job['status'] in ACTIVE_JOB_STATES and now - heartbeat_at > ReportJobConfig.STALE_AFTER:
+        job.update(status='failed', error='The worker running this job stopped responding', finished_at=now)
+        save_report_job(job)
+    return job
+
+
+def list_report_jobs():
+    """Load every job record, deleting finished ones older than the retention window"""
+    cutoff = time.time() - ReportJobConfig.RETENTION
+    jobs = []
+    for name in os.listdir(REPORT_JOBS_DIR):
+        if not name.endswith('.json'):
+            continue
+        job = load_report_job(name[:-len('.json')])
+        if job is None:
+            continue
+        if job['status'] not in ACTIVE_JOB_STATES and job['created_at'] < cutoff:
+            try:
+                os.remove(report_job_path(job['id']))
+            except FileNotFoundError:
+                pass
+            continue
+        jobs.append(job)
+    return jobs
+
+
+@contextmanager
+def owner_job_lock(owner):
+    """Exclusive lock on one owner's jobs across every gunicorn worker on this node, so the
+    active-job count and the new job record are checked and written atomically"""
+    owner_key = hashlib.sha256(owner.encode('utf-8')).hexdigest()[:32]
+    fd = os.open(os.path.join(REPORT_JOBS_DIR, f'.{owner_key}.lock'), os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        # Released by the kernel if the process dies, so a crash never leaves the owner locked out
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class ReportJobQueue:
+    """Per-process bounded thread pool for report jobs; state is shared through job files"""
+
+    def __init__(self, workers, max_active_per_user):
+        self.workers = workers
+        self.max_active_per_user = max_active_per_user
+        self._reset()
+
+    def _reset(self):
+        # Executor and heartbeat threads do not survive fork, so each worker process builds its own lazily
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._executor = None
+        self._heartbeat_thread = None
+        self._active = {}  # id -> job record of this process's queued and running jobs
+
+    def _save(self, job):
+        # Job threads and the heartbeat share each record dict, so writes are serialised
+        with self._save_lock:
+            save_report_job(job)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(ReportJobConfig.HEARTBEAT_INTERVAL)
+            with self._lock:
+                jobs = list(self._active.values())
+            for job in jobs:
+                job['heartbeat_at'] = time.time()
+                self._save(job)
+
+    def submit(self, owner, kind, params, run):
+        """Record a queued job and schedule run(progress), which must return the report filename"""
+        if owner is None:
+            raise ReportJobAuthError("Sign in to generate reports")
+        with self._lock, owner_job_lock(owner):
+            active = [
+                job for job in list_report_jobs()
+                if job['owner'] == owner and job['status'] in ACTIVE_JOB_STATES
+            ]
+            if len(active) >= self.max_active_per_user:
+                raise ReportJobLimitError(
+                    f"You already have {len(active)} reports in progress. Wait for one to finish."
+                )
+
+            job = {
+                'id': secrets.token_urlsafe(16),
+                'kind': kind,
+                'params': params,
+                'owner': owner,
+                'status': 'queued',
+                'rows_written': 0,
+                'total_rows': None,
+                'filename': None,
+                'error': None,
+                'created_at': time.time(),
+                'heartbeat_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+            }
+            self._save(job)
+            self._active[job['id']] = job
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='report-job')
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(
+                    target=self._heartbeat, name='report-job-heartbeat', daemon=True
+                )
+                self._heartbeat_thread.start()
+            self._executor.submit(self._run, job, run)
+        return job
+
+    def _run(self, job, run):
+        job.update(status='running', started_at=time.time())
+        self._save(job)
+        last_saved = time.monotonic()
+
+        def progress(rows_written, total_rows=None):
+            nonlocal last_saved
+            job['rows_written'] = rows_written
+            if total_rows is not None:
+                job['total_rows'] = total_rows
+            now = time.monotonic()
+            if total_rows is not None or now - last_saved >= ReportJobConfig.PROGRESS_INTERVAL:
+                self._save(job)
+                last_saved = now
+
+        try:
+            job['filename'] = run(progress)
+            job['status'] = 'done'
+        except Exception as e:
+            print(f"Report job {job['id']} failed: {str(e)}")
+            job.update(status='failed', error=str(e))
+        job['finished_at'] = time.time()
+        with self._lock:
+            self._active.pop(job['id'], None)
+        self._save(job)
+
+
+report_jobs = ReportJobQueue(ReportJobConfig.WORKERS, ReportJobConfig.MAX_ACTIVE_PER_USER)
+os.register_at_fork(after_in_child=report_jobs._reset)
+
+
+def report_job_owner():
+    """Who a report job belongs to: the token's username, or None without a valid token for a
+    user that still exists (the same check as token_required).
+
+    Never the client address: behind Cloud Run or nginx that is the proxy, shared by everyone.
+    """
+    try:
+        token = request.headers.get('Authorization', '').split(" ")[1]
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+    except (IndexError, jwt.InvalidTokenError):
+        return None
+    user = find_token_user(data)
+    return f"user:{user['username']}" if user else None
+
+
+def report_job_status(job):
+    """Public view of a job record, with an ETA extrapolated from the rows written so far"""
+    status = {key: job[key] for key in (
+        'id', 'kind', 'status', 'rows_written', 'total_rows', 'error', 'created_at', 'started_at', 'finished_at'
+    )}
+    status['status_url'] = f"/api/reports/jobs/{job['id']}"
+    status['eta_seconds'] = None
+    if job['status'] == 'running' and job['rows_written'] and job['total_rows']:
+        elapsed = time.time() - job['started_at']
+        remaining = max(job['total_rows'] - job['rows_written'], 0)
+        status['eta_seconds'] = round(elapsed / job['rows_written'] * remaining, 1)
+    if job['status'] == 'done':
+        status['download_url'] = f"/api/reports/jobs/{job['id']}/download"
+        status['format'] = os.path.splitext(job['filename'])[1].lstrip('.')
+        status['truncated'] = report_truncated(job['filename'])
+    return status
+
+
+def selection_report_job(entity_type, selected_ids, export_format):
+    def run(progress):
+        filename, rows_written = write_selection_report(entity_type, selected_ids, progress, export_format)
+        if rows_written == 0 and entity_type != 'elements':
+            raise ValueError('No data found for selected items')
+        if rows_written is not None:
+            progress(rows_written)
+        return filename
+    return run
+
+
+def submit_selection_report(entity_type, selected_ids, export_format):
+    """Queue the export of the selected items for the requesting user"""
+    return report_jobs.submit(
+        report_job_owner(),
+        'selection',
+        {'entity_type': entity_type, 'count': len(selected_ids), 'format': export_format},
+        selection_report_job(entity_type, selected_ids, export_format)
+    )
+
+
+def chat_report_job(sql_query, report_type):
+    def run(progress):
+        report_url, _ = generate_chat_report(sql_query, progress, report_type)
+        return os.path.basename(report_url)
+    return run
+
 
+def enqueue_chat_report(sql_query, owner, report_type='excel'):
+    """Validate a model-generated report query and hand it to the job queue"""
+    if not sql_query:
+        raise UnsafeQueryError("No SQL query provided.")
+    validate_generated_sql(sql_query)
+    report_type = report_type if report_type in ('csv', 'parquet') else 'excel'
+    return report_jobs.submit(
+        owner, 'chat', {'sql_query': sql_query, 'format': report_type}, chat_report_job(sql_query, report_type)
+    )
+
+
+def get_owned_report_job(job_id):
+    owner = report_job_owner()
+    job = load_report_job(job_id) if owner else None
+    if job is None or job['owner'] != owner:
+        return None
+    return job
+
+
+@app.route('/api/reports/jobs', methods=['POST'])
+def create_report_job():
+    try:
+        data = request.get_json(silent=True) or {}
+        entity_type = data.get('entity_type')
+        selected_ids = data.get('selectedIds', [])
+        if not selected_ids:
+            return jsonify({'error': 'No items selected'}), 400
+        if entity_type != 'elements' and entity_type not in EXPORT_QUERIES:
+            return jsonify({'error': 'Invalid entity type'}), 400
+        export_format = get_export_format(data.get('format'))
+        if export_format is None:
+            return jsonify({'error': 'Unsupported export format'}), 400
+
+        job = submit_selection_report(entity_type, selected_ids, export_format)
+        return jsonify(report_job_status(job)), 202
+
+    except ReportJobAuthError as e:
+        return jsonify({'error': str(e)}), 401
+    except ReportJobLimitError as e:
+        return jsonify({'error': str(e)}), 429
     except Exception as e:
-        print(f"Error in download_selected: {str(e)}")
+        print(f"Error creating report job: {str(e)}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
+
+
+@app.route('/api/reports/jobs/<job_id>', methods=['GET'])
+def get_report_job(job_id):
+    job = get_owned_report_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(report_job_status(job))
+
+
+@app.route('/api/reports/jobs/<job_id>/download', methods=['GET'])
+def download_report_job(job_id):
+    job = get_owned_report_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': f"Report is not ready (status: {job['status']})", **report_job_status(job)}), 409
+
+    if not os.path.exists(os.path.join(REPORTS_DIR, job['filename'])):
+        return jsonify({'error': 'Report file no longer exists'}), 410
+    return send_report(job['filename'])
 
 # Run the Flask app
 if __name__ == '__main__':
@@ -0,0 +1,306 @@
+"""SSE contract of /api/chat/stream, run against a fake OpenAI HTTP server.
+
+Needs a reachable PostgreSQL (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD); the module is
+skipped otherwise. Generated queries are constant SELECTs, so any schema will do.
+"""
+import importlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import psycopg2
+import pytest
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    """Serves /v1/chat/completions: function calls return `interpretation`,
+    streamed calls return `answer_tokens`, and `answer_status` fails the answer call."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeOpenAIHandler)
+        self.reset()
+
+    def reset(self):
+        self.interpretation = {'action': 'conversation', 'message': 'Hola'}
+        self.answer_tokens = ['Hi', ' there']
+        self.answer_status = 200
+        self.requests = []
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        fake = self.server
+        fake.requests.append(body)
+
+        if body.get('functions'):
+            self.send_json(200, completion({
+                'role': 'assistant',
+                'content': None,
+                'function_call': {
+                    'name': 'interpret_user_request',
+                    'arguments': json.dumps(fake.interpretation)
+                }
+            }, 'function_call'))
+        elif fake.answer_status != 200:
+            self.send_json(fake.answer_status, {'error': {'message': 'fake failure', 'type': 'invalid_request_error'}})
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for token in fake.answer_tokens:
+                self.wfile.write(f"data: {json.dumps(chunk({'content': token}))}\n\n".encode('utf-8'))
+            self.wfile.write(f"data: {json.dumps(chunk({}, 'stop'))}\n\n".encode('utf-8'))
+            self.wfile.write(b"data: [DONE]\n\n")
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def completion(message, finish_reason):
+    return {
+        'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o-mini',
+        'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}]
+    }
+
+
+def chunk(delta, finish_reason=None):
+    return {
+        'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'gpt-4o-mini',
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+    }
+
+
+def database_reachable():
+    try:
+        psycopg2.connect(
+            dbname=os.getenv('DB_NAME', 'ServitecInvoiceDataBase'),
+            user=os.getenv('DB_USER', 'postgres'),
+            password=os.getenv('DB_PASSWORD'),
+            host=os.getenv('DB_HOST', 'localhost'),
+            connect_timeout=3
+        ).close()
+        return True
+    except psycopg2.OperationalError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not database_reachable(), reason='PostgreSQL is not reachable')
+
+
+@pytest.fixture(scope='module')
+def fake_openai():
+    fake = FakeOpenAI()
+    thread = threading.Thread(target=fake.serve_forever, daemon=True)
+    thread.start()
+    yield fake
+    fake.shutdown()
+    fake.server_close()
+
+
+@pytest.fixture(scope='module')
+def server(fake_openai, tmp_path_factory):
+    os.environ['OPENAI_BASE_URL'] = fake_openai.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+    os.environ.setdefault('SECRET_KEY', 'test-secret')
+    # Keep the pickled chat sessions out of the source tree
+    os.environ['SESSION_FILE_DIR'] = str(tmp_path_factory.mktemp('session'))
+    return importlib.import_module('backend.server')
+
+
+@pytest.fixture
+def chat(server, fake_openai):
+    fake_openai.reset()
+    client = server.app.test_client()
+    token = jwt.encode(
+        {'username': 'user', 'role': 'user', 'exp': datetime.utcnow() + timedelta(hours=1)},
+        server.app.config['SECRET_KEY'], algorithm='HS256'
+    )
+
+    def post(message, authenticated=True):
+        headers = {'Authorization': f'Bearer {token}'} if authenticated else {}
+        response = client.post('/api/chat/stream', json={'message': message}, headers=headers)
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        return parse_events(response.get_data(as_text=True))
+    return post
+
+
+def parse_events(body):
+    events = []
+    for block in body.split('\n\n'):
+        if not block.strip():
+            continue
+        fields = dict(line.split(': ', 1) for line in block.splitlines())
+        events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+def names(events):
+    return [event for event, _ in events]
+
+
+def test_query_data_streams_phases_rows_tokens_and_done(chat, fake_openai):
+    fake_openai.interpretation = {'action': 'query_data', 'sql_query': 'SELECT 1 AS answer, 2 AS other;'}
+    fake_openai.answer_tokens = ['The', ' answer', ' is 1']
+
+    events = chat('stream test: what is the answer?')
+
+    assert names(events) == ['phase', 'phase', 'rows', 'phase', 'token', 'token', 'token', 'done']
+    assert [data['phase'] for event, data in events if event == 'phase'] == ['interpreting', 'querying', 'answering']
+    assert events[2][1] == {'count': 1, 'truncated': False}
+    assert [data['text'] for event, data in events if event == 'token'] == ['The', ' answer', ' is 1']
+    assert events[-1][1] == {'format': 'markdown', 'reply': 'The answer is 1'}
+
+    # The answer call streams and carries the query result in its prompt
+    answer_request = fake_openai.requests[-1]
+    assert answer_request['stream'] is True
+    assert 'Answer: 1, Other: 2' in answer_request['messages'][-1]['content']
+
+
+def test_conversation_streams_reply_as_one_token(chat, fake_openai):
+    fake_openai.interpretation = {'action': 'conversation', 'message': 'Bon dia!'}
+
+    events = chat('stream test: hello')
+
+    assert events == [
+        ('phase', {'phase': 'interpreting'}),
+        ('token', {'text': 'Bon dia!'}),
+        ('done', {'format': 'markdown', 'reply': 'Bon dia!'})
+    ]
+
+
+def test_unsafe_sql_is_rejected_before_running(chat, fake_openai):
+    fake_openai.interpretation = {'action': 'query_data', 'sql_query': 'DELETE FROM projects'}
+
+    events = chat('stream test: delete everything')
+
+    assert names(events) == ['phase', 'phase', 'error']
+    assert events[-1][1] == {'reply': 'Error: Only SELECT statements are allowed', 'format': 'markdown'}
+    # Nothing reached the answer call
+    assert len(fake_openai.requests) == 1
+
+
+@pytest.mark.parametrize('sql_query', [
+    "SELECT set_config('statement_timeout', '0', false)",
+    'SELECT pg_sleep(30)',
+    'SELECT pg_catalog.pg_advisory_lock(1)',
+])
+def test_session_changing_functions_are_rejected(chat, fake_openai, sql_query):
+    fake_openai.interpretation = {'action': 'query_data', 'sql_query': sql_query}
+
+    events = chat(f'stream test: {sql_query}')
+
+    assert names(events) == ['phase', 'phase', 'error']
+    assert 'is not allowed in generated queries' in events[-1][1]['reply']
+
+
+def test_missing_sql_is_rejected(chat, fake_openai):
+    fake_openai.interpretation = {'action': 'query_data'}
+
+    events = chat('stream test: query without sql')
+
+    assert events == [
+        ('phase', {'phase': 'interpreting'}),
+        ('error', {'reply': 'Error: No SQL query provided.', 'format': 'markdown'})
+    ]
+
+
+def test_unrecognized_action_is_rejected(chat, fake_openai):
+    fake_openai.interpretation = {'action': 'launch_rockets'}
+
+    events = chat('stream test: unknown action')
+
+    assert events[-1] == ('error', {'reply': "Error: Unrecognized action 'launch_rockets'.", 'format': 'markdown'})
+
+
+def test_upstream_failure_ends_the_stream_with_an_error(chat, fake_openai):
+    fake_openai.interpretation = {'action': 'query_data', 'sql_query': 'SELECT 1 AS answer'}
+    fake_openai.answer_status = 400
+
+    events = chat('stream test: answer call fails')
+
+    assert names(events) == ['phase', 'phase', 'rows', 'phase', 'error']
+    assert events[-1][1] == {
+        'reply': 'An error occurred during processing. Please try again.',
+        'format': 'markdown'
+    }
+
+
+def test_empty_answer_is_an_error(chat, fake_openai):
+    fake_openai.interpretation = {'action': 'query_data', 'sql_query': 'SELECT 1 AS answer'}
+    fake_openai.answer_tokens = []
+
+    events = chat('stream test: empty answer')
+
+    assert names(events) == ['phase', 'phase', 'rows', 'phase', 'error']
+    assert events[-1][1] == {'reply': 'Error: No content in final response.', 'format': 'markdown'}
+
+
+def test_large_result_queues_the_full_report(chat, fake_openai, server):
+    rows = server.ChatResultConfig.MAX_ROWS_TO_MODEL + 10
+    fake_openai.interpretation = {'action': 'query_data', 'sql_query': f'SELECT g FROM generate_series(1, {rows}) AS g'}
+
+    events = chat('stream test: many rows')
+
+    assert names(events) == ['phase', 'phase', 'rows', 'job', 'phase', 'token', 'token', 'done']
+    job = events[3][1]
+    assert job['job_url'] == f"/api/reports/jobs/{job['job_id']}"
+    assert {key: events[-1][1][key] for key in ('job_id', 'job_url')} == job
+    assert 'downloadable Excel report' in fake_openai.requests[-1]['messages'][-1]['content']
+
+
+def test_large_result_without_a_token_queues_no_report(chat, fake_openai, server):
+    rows = server.ChatResultConfig.MAX_ROWS_TO_MODEL + 10
+    fake_openai.interpretation = {'action': 'query_data', 'sql_query': f'SELECT g FROM generate_series(1, {rows}) AS g'}
+
+    events = chat('stream test: many rows, signed out', authenticated=False)
+
+    assert names(events) == ['phase', 'phase', 'rows', 'phase', 'token', 'token', 'done']
+    assert 'job_id' not in events[-1][1]
+    assert 'not signed in' in fake_openai.requests[-1]['messages'][-1]['content']
+
+
+def test_report_request_without_a_token_is_rejected(chat, fake_openai):
+    fake_openai.interpretation = {'action': 'generate_report', 'sql_query': 'SELECT 1 AS answer'}
+
+    events = chat('stream test: report, signed out', authenticated=False)
+
+    assert events == [
+        ('phase', {'phase': 'interpreting'}),
+        ('error', {'reply': 'Error: Sign in to generate reports', 'format': 'markdown'})
+    ]
+
+
+def test_token_for_a_removed_user_cannot_queue_reports(chat, fake_openai, server):
+    fake_openai.interpretation = {'action': 'generate_report', 'sql_query': 'SELECT 1 AS answer'}
+    removed = jwt.encode(
+        {'username': 'former', 'role': 'user', 'exp': datetime.utcnow() + timedelta(hours=1)},
+        server.app.config['SECRET_KEY'], algorithm='HS256'
+    )
+
+    response = server.app.test_client().post(
+        '/api/chat/stream', json={'message': 'stream test: report, removed user'},
+        headers={'Authorization': f'Bearer {removed}'}
+    )
+
+    assert parse_events(response.get_data(as_text=True))[-1] == (
+        'error', {'reply': 'Error: Sign in to generate reports', 'format': 'markdown'}
+    )
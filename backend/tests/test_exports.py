@@ -0,0 +1,71 @@
+"""Flat (CSV / Parquet) exports of EXPORT_QUERIES, written against a temporary table.
+
+Needs a reachable PostgreSQL (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD); the module is
+skipped otherwise. The temporary table shadows any real one for the test connection only.
+"""
+import importlib
+import io
+import os
+
+import pandas as pd
+import psycopg2
+import pytest
+
+from backend.tests.test_chat_stream import database_reachable
+
+
+pytestmark = pytest.mark.skipif(not database_reachable(), reason='PostgreSQL is not reachable')
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+    os.environ.setdefault('SECRET_KEY', 'test-secret')
+    os.environ.setdefault('SESSION_FILE_DIR', str(tmp_path_factory.mktemp('session')))
+    return importlib.import_module('backend.server')
+
+
+@pytest.fixture
+def invoices_conn():
+    conn = psycopg2.connect(
+        dbname=os.getenv('DB_NAME', 'ServitecInvoiceDataBase'),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD'),
+        host=os.getenv('DB_HOST', 'localhost')
+    )
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE invoices (
+                id integer PRIMARY KEY, folder_type text, file_name text, project_name text
+            ) ON COMMIT DROP
+        """)
+        cur.execute("""
+            INSERT INTO invoices VALUES
+                (1, 'received', 'a.pdf', 'Alpha'),
+                (2, 'issued', 'b.pdf', NULL),
+                (3, 'issued', 'c.pdf', 'Gamma')
+        """)
+    yield conn
+    conn.rollback()
+    conn.close()
+
+
+def test_invoices_parquet_export_reads_back(server, invoices_conn):
+    out = io.BytesIO()
+
+    rows_written = server.write_flat_export(
+        invoices_conn, 'parquet', server.EXPORT_QUERIES['invoices'], ([1, 2],), out
+    )
+
+    frame = pd.read_parquet(io.BytesIO(out.getvalue()))
+    assert rows_written == 2
+    assert list(frame.columns) == ['folder_type', 'file_name', 'project_name']
+    assert sorted(frame['file_name']) == ['a.pdf', 'b.pdf']
+
+
+def test_invoices_csv_export_has_one_project_column(server, invoices_conn):
+    out = io.BytesIO()
+
+    server.write_flat_export(invoices_conn, 'csv', server.EXPORT_QUERIES['invoices'], ([3],), out)
+
+    assert out.getvalue().decode('utf-8').splitlines() == ['folder_type,file_name,project_name', 'issued,c.pdf,Gamma']
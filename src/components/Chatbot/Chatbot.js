@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import {
   Drawer,
   IconButton,
@@ -12,7 +12,7 @@ import {
 } from '@mui/material';
 import ChatIcon from '@mui/icons-material/Chat';
 import ReactMarkdown from 'react-markdown';
-import { api, sendMessage, downloadFile } from '../../services/api';
+import { api, sendMessage, downloadFile, waitForReportJob, REPORT_MIMETYPES } from '../../services/api';
 
 const Chatbot = () => {
   const [open, setOpen] = useState(false);
@@ -22,9 +22,45 @@ const Chatbot = () => {
   const [error, setError] = useState(null);
   const [reportAvailable, setReportAvailable] = useState(false);
   const [reportUrl, setReportUrl] = useState(null);
+  const [reportFormat, setReportFormat] = useState(null);
+  const [reportJobUrl, setReportJobUrl] = useState(null);
 
   const toggleDrawer = () => setOpen(!open);
 
+  // Reports are built in the background; poll the latest job and enable the download once it finishes.
+  // A newer message (or unmounting) cancels the poll, so an old job never updates the current report.
+  useEffect(() => {
+    if (!reportJobUrl) return undefined;
+    let cancelled = false;
+
+    waitForReportJob(reportJobUrl, { isCancelled: () => cancelled })
+      .then(job => {
+        if (cancelled || !job) return;
+        setReportAvailable(true);
+        setReportUrl(job.download_url);
+        setReportFormat(job.format);
+        if (job.truncated) {
+          const notice = {
+            text: 'The report reached its row limit and may be incomplete. Narrow the question to get every row.',
+            sender: 'bot'
+          };
+          setMessages(prevMessages => [...prevMessages, notice]);
+        }
+      })
+      .catch(err => {
+        if (cancelled) return;
+        console.error('Report job error:', err);
+        setError(`The report could not be generated: ${err.response?.data?.error || err.message}`);
+      })
+      .finally(() => {
+        if (!cancelled) setReportJobUrl(null);
+      });
+
+    return () => {
+      cancelled = true;
+    };
+  }, [reportJobUrl]);
+
   const handleSend = async () => {
     if (input.trim() === '') return;
 
@@ -35,6 +71,8 @@ const Chatbot = () => {
     setError(null);
     setReportAvailable(false);
     setReportUrl(null);
+    setReportFormat(null);
+    setReportJobUrl(null);
 
     try {
       const response = await sendMessage(input);
@@ -47,6 +85,10 @@ const Chatbot = () => {
         setReportAvailable(true);
         setReportUrl(response.data.report_url);
       }
+
+      if (response.data.job_url) {
+        setReportJobUrl(response.data.job_url);
+      }
     } catch (err) {
       console.error('Chat error:', err);
       setError(err.response?.data?.reply || 'Failed to get response from the chat server.');
@@ -61,13 +103,19 @@ const Chatbot = () => {
         console.log('Initiating download from URL:', reportUrl);
         const response = await downloadFile(reportUrl);
         
-        // Create timestamp for filename
+        // Prefer the server's filename; otherwise name it after the job's format (xlsx for legacy report URLs)
+        const contentType = (response.headers['content-type'] || '').split(';')[0].trim();
+        const format = reportFormat
+          || Object.keys(REPORT_MIMETYPES).find(key => REPORT_MIMETYPES[key] === contentType)
+          || 'xlsx';
+        const disposition = response.headers['content-disposition'] || '';
+        const serverFilename = disposition.match(/filename="?([^";]+)"?/)?.[1];
         const timestamp = new Date().toISOString().replace(/[:.]/g, '-').slice(0, -5);
-        const filename = `chat_report_${timestamp}.xlsx`;
+        const filename = serverFilename || `chat_report_${timestamp}.${format}`;
         
         // Create blob and trigger download
         const blob = new Blob([response.data], {
-          type: 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+          type: contentType || REPORT_MIMETYPES[format]
         });
         
         // Use the same download mechanism as downloadSelected
@@ -195,7 +243,7 @@ const Chatbot = () => {
               disabled={!reportAvailable}
               sx={{ ml: 1 }}
             >
-              Download
+              {reportJobUrl ? 'Preparing...' : 'Download'}
             </Button>
           </Box>
         </Box>
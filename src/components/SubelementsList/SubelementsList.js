@@ -9,7 +9,7 @@ import {
   TableBody,
   Typography,
 } from '@mui/material';
-import { api } from '../../services/api';
+import { loadSubelements } from '../../services/api';
 
 const SubelementsList = ({ elementId }) => {
   const [subelements, setSubelements] = useState([]);
@@ -18,8 +18,7 @@ const SubelementsList = ({ elementId }) => {
   useEffect(() => {
     const fetchSubelements = async () => {
       try {
-        const response = await api.get(`/subelements/${elementId}`);
-        setSubelements(response.data);
+        setSubelements(await loadSubelements(elementId));
       } catch (error) {
         console.error('Error fetching subelements:', error);
       } finally {
@@ -21,6 +21,12 @@ export { api };
 // Simplified request interceptor
 api.interceptors.request.use(
   (config) => {
+    // The token set up in App.js only covers the global axios instance
+    const token = localStorage.getItem('token');
+    if (token) {
+      config.headers.Authorization = `Bearer ${token}`;
+    }
+
     // Don't modify URLs that are already absolute
     if (!config.url.startsWith('http')) {
       // Make sure we don't double-add /api
@@ -99,30 +105,60 @@ export const getElements = async (invoiceId) => {
   }
 };
 
+// Whole project drill-down in one request; depth is project | invoices | elements | subelements
+export const getProjectTree = async (projectName, params = {}) => {
+  const queryString = new URLSearchParams(params).toString();
+  const response = await api.get(
+    `/api/projects/${encodeURIComponent(projectName)}/tree${queryString ? `?${queryString}` : ''}`
+  );
+  return response.data;
+};
+
 export const getSubelements = (elementId) =>
   api.get(`/api/subelements/${elementId}`);
 
+// Subelement lookups made in the same tick (e.g. expanding every row of an
+// invoice) are sent as one /api/subelements/batch request
+let pendingSubelements = null;
+
+export const loadSubelements = (elementId) => {
+  if (!pendingSubelements) {
+    const batch = new Map();
+    pendingSubelements = batch;
+    setTimeout(async () => {
+      pendingSubelements = null;
+      try {
+        const response = await api.post('/api/subelements/batch', { elementIds: [...batch.keys()] });
+        batch.forEach((waiters, id) => waiters.forEach(({ resolve }) => resolve(response.data[id] || [])));
+      } catch (error) {
+        batch.forEach((waiters) => waiters.forEach(({ reject }) => reject(error)));
+      }
+    }, 0);
+  }
+  return new Promise((resolve, reject) => {
+    const waiters = pendingSubelements.get(elementId) || [];
+    waiters.push({ resolve, reject });
+    pendingSubelements.set(elementId, waiters);
+  });
+};
+
+// Workbooks are built by a background report job: queue it, poll until it is done,
+// then fetch the file
 export const downloadSelected = async (entityType, selectedIds) => {
   console.log('downloadSelected called with:', { entityType, selectedIds });
-  
+
   try {
-    console.log('Making API request to:', `/download_selected/${entityType}`);
-    console.log('Request payload:', { selectedIds });
-    
-    const response = await api.post(
-      `/download_selected/${entityType}`,
-      { selectedIds },
-      {
-        responseType: 'blob',
-        headers: {
-          'Accept': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-          'Content-Type': 'application/json'
-        }
-      }
-    );
+    const { data: job } = await api.post('/reports/jobs', {
+      entity_type: entityType,
+      selectedIds,
+      format: 'xlsx'
+    });
+    console.log('Report job queued:', job);
+
+    const finished = await waitForReportJob(job.status_url);
+    const response = await downloadFile(finished.download_url);
 
     console.log('Response received:', response);
-    console.log('Response type:', response.data.type);
     console.log('Response size:', response.data.size);
 
     // Check if the response is an error message in JSON format
@@ -163,16 +199,51 @@ export const sendMessage = async (message) => {
   }
 };
 
+// Poll a background report job until it finishes; resolves with the final job status,
+// or null once isCancelled() turns true. Gives up after timeoutMs.
+export const REPORT_JOB_TIMEOUT_MS = 15 * 60 * 1000;
+
+export const waitForReportJob = async (
+  jobUrl,
+  { intervalMs = 2000, timeoutMs = REPORT_JOB_TIMEOUT_MS, isCancelled = () => false } = {}
+) => {
+  const cleanUrl = jobUrl.startsWith('/api') ? jobUrl.substring(4) : jobUrl;
+  const deadline = Date.now() + timeoutMs;
+  while (!isCancelled()) {
+    const response = await api.get(cleanUrl);
+    const job = response.data;
+    if (job.status === 'done') {
+      return job;
+    }
+    if (job.status === 'failed') {
+      throw new Error(job.error || 'Report generation failed');
+    }
+    if (Date.now() + intervalMs > deadline) {
+      throw new Error('The report is taking too long to generate. Try again later.');
+    }
+    await new Promise(resolve => setTimeout(resolve, intervalMs));
+  }
+  return null;
+};
+
+// MIME types of the report formats the backend exports (status.format of a finished job)
+export const REPORT_MIMETYPES = {
+  xlsx: 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+  csv: 'text/csv',
+  parquet: 'application/vnd.apache.parquet'
+};
+
 // Add a new function for handling downloads
 export const downloadFile = async (url) => {
   try {
     // If the URL starts with /api, remove it since baseURL already includes it
     const cleanUrl = url.startsWith('/api') ? url.substring(4) : url;
     
+    // Reports may be Excel, CSV or Parquet; the response's Content-Type says which
     const response = await api.get(cleanUrl, {
       responseType: 'blob',
       headers: {
-        'Accept': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        'Accept': '*/*'
       }
     });
     return response;